@@ -13,4 +13,10 @@ from .httputil import BZIP2
 from .httputil import DEFLATE
 from .httputil import GZIP
 
+from .httputil import FLUSH
+
+from .httputil import StreamDecompressor
+
+from .httputil import compression_from_header
+from .httputil import encode_body_stream
 from .httputil import read_body_stream
@@ -0,0 +1,289 @@
+"""Asyncio counterparts of body stream functions: dechunking and
+decompressing body read from asyncio.StreamReader or async iterator of bytes.
+
+Requires Python 3.6+ for asynchronous generators, so the module is not
+imported by the package and must be imported explicitly:
+
+    from httputil import aio
+
+    async for block in aio.aread_body_stream(reader, chunked=True):
+        ...
+"""
+
+__author__ = 'vovanec@gmail.com'
+
+import asyncio
+
+from .httputil import CHUNK_SIZE
+from .httputil import CRLF
+from .httputil import DechunkError
+from .httputil import StreamDecompressor
+from .httputil import parse_chunk_size
+
+
+# Decompressing a block of this size or larger is done in executor.
+OFFLOAD_SIZE = 1024 * 256
+
+
+class IteratorReader(object):
+
+    """Adapter providing StreamReader-like read() over async iterator of
+    bytes.
+
+    """
+
+    def __init__(self, chunks):
+        """Constructor.
+
+        :param collections.AsyncIterable[bytes] chunks: data chunks.
+        """
+
+        self._chunks = chunks.__aiter__()
+        self._pending = b''
+
+    async def read(self, size=-1):
+        """Read up to size bytes.
+
+        :param int size: maximum number of bytes to return, if negative -
+               the next available block.
+
+        :return: data block, empty at the end of data.
+        :rtype: bytes
+        """
+
+        while not self._pending:
+            try:
+                self._pending = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                return b''
+
+        if size < 0:
+            size = len(self._pending)
+
+        block, self._pending = self._pending[:size], self._pending[size:]
+
+        return block
+
+
+def make_reader(reader_or_iterator):
+    """Get object with StreamReader-like read() coroutine.
+
+    :param asyncio.StreamReader|collections.AsyncIterable[bytes]
+           reader_or_iterator: stream reader or async iterator.
+
+    :rtype: asyncio.StreamReader|IteratorReader
+    :raise: TypeError
+    """
+
+    if hasattr(reader_or_iterator, 'read'):
+        return reader_or_iterator
+    elif hasattr(reader_or_iterator, '__aiter__'):
+        return IteratorReader(reader_or_iterator)
+
+    raise TypeError('Input must be either asyncio.StreamReader or '
+                    'async iterator.')
+
+
+async def aread_until(reader, delimiter, max_bytes=16):
+    """Read until we have found the given delimiter.
+
+    :param asyncio.StreamReader|IteratorReader reader: stream reader.
+    :param bytes delimiter: delimiter.
+    :param int max_bytes: maximum bytes to read.
+
+    :return: read data without delimiter or None if delimiter was not found
+             within max_bytes.
+    :rtype: bytes|None
+    """
+
+    buf = bytearray()
+    delim_len = len(delimiter)
+
+    while len(buf) < max_bytes:
+        c = await reader.read(1)
+
+        if not c:
+            break
+
+        buf += c
+        if buf[-delim_len:] == delimiter:
+            return bytes(buf[:-delim_len])
+
+
+async def aread_exactly(reader, size):
+    """Read exactly size bytes unless data ends earlier.
+
+    :param asyncio.StreamReader|IteratorReader reader: stream reader.
+    :param int size: the number of bytes to read.
+
+    :rtype: bytes
+    """
+
+    buf = bytearray()
+    while len(buf) < size:
+        block = await reader.read(size - len(buf))
+        if not block:
+            break
+
+        buf += block
+
+    return bytes(buf)
+
+
+async def adechunk(reader_or_iterator):
+    """De-chunk HTTP body stream.
+
+    :param asyncio.StreamReader|collections.AsyncIterable[bytes]
+           reader_or_iterator: stream reader or async iterator.
+
+    :rtype: collections.AsyncIterator[bytes]
+    :raise: TypeError, DechunkError
+    """
+
+    reader = make_reader(reader_or_iterator)
+
+    while True:
+        chunk_len = parse_chunk_size(await aread_until(reader, CRLF))
+        if chunk_len == 0:
+            break
+
+        bytes_to_read = chunk_len
+        while bytes_to_read:
+            chunk = await reader.read(bytes_to_read)
+            if not chunk:
+                raise DechunkError('Unexpected end of data within chunk.')
+
+            bytes_to_read -= len(chunk)
+            yield chunk
+
+        # chunk ends with \r\n
+        if await aread_exactly(reader, 2) != CRLF:
+            raise DechunkError('No CR+LF at the end of chunk!')
+
+
+async def ato_chunks(reader_or_iterator):
+    """Read stream reader or async iterator by blocks.
+
+    :param asyncio.StreamReader|collections.AsyncIterable[bytes]
+           reader_or_iterator: stream reader or async iterator.
+
+    :rtype: collections.AsyncIterator[bytes]
+    :raise: TypeError
+    """
+
+    reader = make_reader(reader_or_iterator)
+
+    while True:
+        chunk = await reader.read(CHUNK_SIZE)
+        if not chunk:
+            break  # no more data
+
+        yield chunk
+
+
+async def adecompress(chunks, compression, executor=None,
+                      offload_size=OFFLOAD_SIZE):
+    """Decompress
+
+    :param collections.AsyncIterable[bytes] chunks: compressed body chunks.
+    :param str compression: compression constant.
+    :param concurrent.futures.Executor|None executor: executor to
+           decompress large chunks in, if None - loop default executor.
+    :param int offload_size: minimum size of chunk to decompress in
+           executor.
+
+    :rtype: collections.AsyncIterator[bytes]
+    :return: decompressed chunks.
+
+    :raise: TypeError, DecompressError
+    """
+
+    de_compressor = StreamDecompressor(compression)
+    loop = asyncio.get_event_loop()
+
+    async for chunk in chunks:
+        if len(chunk) >= offload_size:
+            # zlib and bz2 release GIL while decompressing
+            yield await loop.run_in_executor(
+                executor, de_compressor.decompress, chunk)
+        else:
+            yield de_compressor.decompress(chunk)
+
+    yield de_compressor.flush()
+
+
+def aread_body_stream(reader_or_iterator, chunked=False, compression=None,
+                      executor=None, offload_size=OFFLOAD_SIZE):
+    """Read HTTP body stream, yielding blocks of bytes. De-chunk and
+    de-compress data if needed.
+
+    :param asyncio.StreamReader|collections.AsyncIterable[bytes]
+           reader_or_iterator: stream reader or async iterator.
+    :param bool chunked: whether stream is chunked.
+    :param str|None compression: compression type is stream is
+           compressed, otherwise None.
+    :param concurrent.futures.Executor|None executor: executor to
+           decompress large chunks in, if None - loop default executor.
+    :param int offload_size: minimum size of chunk to decompress in
+           executor.
+
+    :rtype: collections.AsyncIterator[bytes]
+    :raise: TypeError, BodyStreamError
+    """
+
+    reader = make_reader(reader_or_iterator)
+
+    generator = adechunk(reader) if chunked else ato_chunks(reader)
+    if compression:
+        generator = adecompress(generator, compression, executor,
+                                offload_size)
+
+    return generator
+
+
+async def abatched(records, batch_size):
+    """Group records into lists.
+
+    :param collections.AsyncIterable records: records.
+    :param int batch_size: maximum number of records in list, the last
+           list may be shorter.
+
+    :rtype: collections.AsyncIterator[list]
+    """
+
+    batch = []
+    async for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def aparse_records(chunks, parser, batch_size=None):
+    """Parse records from data blocks, see records.parse_records().
+
+    :param collections.AsyncIterable[bytes] chunks: data blocks, e.g.
+           returned by aread_body_stream().
+    :param records.RecordParser parser: record parser.
+    :param int|None batch_size: if set, records are yielded in lists of
+           this size.
+
+    :rtype: collections.AsyncIterator
+    :raise: RecordError
+    """
+
+    async def generate():
+        async for chunk in chunks:
+            for record in parser.feed(chunk):
+                yield record
+
+        for record in parser.close():
+            yield record
+
+    if batch_size:
+        return abatched(generate(), batch_size)
+
+    return generate()
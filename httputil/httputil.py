@@ -12,6 +12,8 @@ import zlib
 
 
 CHUNK_SIZE = 1024 * 16
+CRLF = b'\r\n'
+LAST_CHUNK = b'0\r\n\r\n'
 
 GZIP = 'gzip'
 DEFLATE = 'deflate'
@@ -26,7 +28,9 @@ class DeflateDecompressor(object):
     def __init__(self):
 
         self._decompressobj = zlib.decompressobj()
-        self._first_chunk = True
+        # zlib header is checked once its two bytes are received, they may
+        # arrive in separate chunks.
+        self._head = b''
 
     def decompress(self, chunk):
         """Decompress the chunk of data.
@@ -36,6 +40,11 @@ class DeflateDecompressor(object):
         :rtype: bytes
         """
 
+        head = self._head
+        if head is not None:
+            head += chunk
+            self._head = head if len(head) < 2 else None
+
         try:
             return self._decompressobj.decompress(chunk)
         except zlib.error:
@@ -44,13 +53,12 @@ class DeflateDecompressor(object):
             # http://carsten.codimi.de/gzip.yaws/
             # http://www.port80software.com/200ok/archive/2005/10/31/868.aspx
             # http://www.gzip.org/zlib/zlib_faq.html#faq38
-            if self._first_chunk:
+            if head is not None:
+                self._head = None
                 self._decompressobj = zlib.decompressobj(-zlib.MAX_WBITS)
-                return self._decompressobj.decompress(chunk)
+                return self._decompressobj.decompress(head)
 
             raise
-        finally:
-            self._first_chunk = False
 
     def flush(self):
         """All pending input is processed, and a string containing the
@@ -66,6 +74,40 @@ DECOMPRESSOR_FACTORIES = {
     BZIP2: bz2.BZ2Decompressor
 }
 
+CONTENT_ENCODINGS = {
+    'gzip': GZIP,
+    'x-gzip': GZIP,
+    'deflate': DEFLATE,
+    'bzip2': BZIP2
+}
+
+COMPRESSOR_FACTORIES = {
+    DEFLATE: lambda level: zlib.compressobj(level),
+    GZIP: lambda level: zlib.compressobj(level, zlib.DEFLATED,
+                                         16 + zlib.MAX_WBITS),
+    BZIP2: lambda level: bz2.BZ2Compressor(level)
+}
+
+DEFAULT_COMPRESSION_LEVELS = {
+    DEFLATE: zlib.Z_DEFAULT_COMPRESSION,
+    GZIP: zlib.Z_DEFAULT_COMPRESSION,
+    BZIP2: 9
+}
+
+
+class _Flush(object):
+
+    """Flush marker type."""
+
+    def __repr__(self):
+
+        return 'FLUSH'
+
+
+# Put FLUSH into stream passed to encode_body_stream() to make everything
+# written so far available to the receiver right away.
+FLUSH = _Flush()
+
 
 class BodyStreamError(Exception):
 
@@ -115,6 +157,26 @@ def read_until(stream, delimiter, max_bytes=16):
             return bytes(buf[:-delim_len])
 
 
+def parse_chunk_size(line):
+    """Parse chunk size line of chunked HTTP body.
+
+    :param bytes|None line: chunk size line without trailing CR+LF, None if
+           stream ended before the line was read.
+
+    :rtype: int
+    :raise: DechunkError
+    """
+
+    if line is None:
+        raise DechunkError(
+            'Could not extract chunk size: unexpected end of data.')
+
+    try:
+        return int(line.strip(), 16)
+    except (ValueError, TypeError) as err:
+        raise DechunkError('Could not parse chunk size: %s' % (err,))
+
+
 def dechunk(stream):
     """De-chunk HTTP body stream.
 
@@ -130,15 +192,7 @@ def dechunk(stream):
     while True:
         chunk_len = read_until(stream, b'\r\n')
 
-        if chunk_len is None:
-            raise DechunkError(
-                'Could not extract chunk size: unexpected end of data.')
-
-        try:
-            chunk_len = int(chunk_len.strip(), 16)
-        except (ValueError, TypeError) as err:
-            raise DechunkError('Could not parse chunk size: %s' % (err,))
-
+        chunk_len = parse_chunk_size(chunk_len)
         if chunk_len == 0:
             break
 
@@ -180,6 +234,78 @@ def to_chunks(stream_or_generator):
         raise TypeError('Input must be either readable or generator.')
 
 
+class StreamDecompressor(object):
+
+    """Incremental decompressor: data is pushed into it block by block.
+    """
+
+    def __init__(self, compression):
+        """Constructor.
+
+        :param str compression: compression constant.
+
+        :raise: TypeError
+        """
+
+        if compression not in SUPPORTED_COMPRESSIONS:
+            raise TypeError(
+                'Unsupported compression type: %s' % (compression,))
+
+        self._de_compressor = DECOMPRESSOR_FACTORIES[compression]()
+
+    def decompress(self, chunk):
+        """Decompress the chunk of data.
+
+        :param bytes chunk: compressed data chunk.
+
+        :rtype: bytes
+        :raise: DecompressError
+        """
+
+        try:
+            return self._de_compressor.decompress(chunk)
+        except (OSError, zlib.error) as err:
+            # BZ2Decompressor raises OSError on invalid data stream
+            raise DecompressError(err) from None
+
+    def flush(self):
+        """Return the remaining decompressed data.
+
+        :rtype: bytes
+        :raise: DecompressError
+        """
+
+        # BZ2Decompressor does not support flush() method.
+        if not hasattr(self._de_compressor, 'flush'):
+            return b''
+
+        try:
+            return self._de_compressor.flush()
+        except zlib.error as err:
+            raise DecompressError(err) from None
+
+
+def compression_from_header(content_encoding):
+    """Get compression constant for Content-Encoding header value.
+
+    :param str|None content_encoding: header value.
+
+    :return: compression constant or None if content is not compressed.
+    :rtype: str|None
+    :raise: TypeError
+    """
+
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('', 'identity'):
+        return None
+
+    try:
+        return CONTENT_ENCODINGS[content_encoding]
+    except KeyError:
+        raise TypeError('Unsupported content encoding: %s' %
+                        (content_encoding,)) from None
+
+
 def decompress(chunks, compression):
     """Decompress
 
@@ -192,24 +318,11 @@ def decompress(chunks, compression):
     :raise: TypeError, DecompressError
     """
 
-    if compression not in SUPPORTED_COMPRESSIONS:
-        raise TypeError('Unsupported compression type: %s' % (compression,))
+    de_compressor = StreamDecompressor(compression)
+    for chunk in chunks:
+        yield de_compressor.decompress(chunk)
 
-    de_compressor = DECOMPRESSOR_FACTORIES[compression]()
-    try:
-        for chunk in chunks:
-            try:
-                yield de_compressor.decompress(chunk)
-            except OSError as err:
-                # BZ2Decompressor: invalid data stream
-                raise DecompressError(err) from None
-
-        # BZ2Decompressor does not support flush() method.
-        if hasattr(de_compressor, 'flush'):
-            yield de_compressor.flush()
-
-    except zlib.error as err:
-        raise DecompressError(err) from None
+    yield de_compressor.flush()
 
 
 def read_body_stream(stream, chunked=False, compression=None):
@@ -236,3 +349,114 @@ def read_body_stream(stream, chunked=False, compression=None):
         generator = decompress(to_chunks(generator), compression)
 
     return generator
+
+
+def compress(chunks, compression, level=None):
+    """Compress data. FLUSH markers are passed through, zlib compressor
+    is sync-flushed before each of them.
+
+    :param collections.Iterable[bytes] chunks: data chunks.
+    :param str compression: compression constant.
+    :param int|None level: compression level, if None - compressor default.
+
+    :rtype: __generator[bytes]
+    :return: compressed chunks.
+
+    :raise: TypeError
+    """
+
+    if compression not in SUPPORTED_COMPRESSIONS:
+        raise TypeError('Unsupported compression type: %s' % (compression,))
+
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[compression]
+
+    compressor = COMPRESSOR_FACTORIES[compression](level)
+    for chunk in chunks:
+        if chunk is FLUSH:
+            # BZ2Compressor can only flush at the end of stream.
+            if compression != BZIP2:
+                yield compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield FLUSH
+        else:
+            yield compressor.compress(chunk)
+
+    yield compressor.flush()
+
+
+def coalesce(chunks, min_size=CHUNK_SIZE):
+    """Join small chunks into blocks of at least min_size bytes. FLUSH
+    marker makes the data collected so far to be yielded immediately.
+
+    :param collections.Iterable[bytes] chunks: data chunks.
+    :param int min_size: minimum block size.
+
+    :rtype: __generator[bytes]
+    """
+
+    buf = bytearray()
+    for chunk in chunks:
+        if chunk is FLUSH:
+            if buf:
+                yield bytes(buf)
+                buf = bytearray()
+            continue
+
+        buf += chunk
+        if len(buf) >= min_size:
+            yield bytes(buf)
+            buf = bytearray()
+
+    if buf:
+        yield bytes(buf)
+
+
+def enchunk(chunks):
+    """Encode data with chunked transfer encoding.
+
+    :param collections.Iterable[bytes] chunks: data chunks.
+
+    :rtype: __generator[bytes]
+    """
+
+    for chunk in chunks:
+        if chunk:
+            yield b''.join(
+                [('%x' % (len(chunk),)).encode('ascii'), CRLF, chunk, CRLF])
+
+    yield LAST_CHUNK
+
+
+def encode_body_stream(stream, chunked=True, compression=GZIP, level=None,
+                       chunk_size=CHUNK_SIZE):
+    """Encode HTTP body stream, yielding blocks of bytes. Compress and
+    chunk data if needed. This is the reverse of read_body_stream().
+
+    Small writes are coalesced into blocks of chunk_size bytes. Put FLUSH
+    into the stream to send everything written so far without waiting for
+    the block to fill up.
+
+    :param file|collections.Iterable[bytes] stream: readable stream or
+           iterable of data chunks and FLUSH markers.
+    :param bool chunked: whether to use chunked transfer encoding.
+    :param str|None compression: compression type or None for no
+           compression.
+    :param int|None level: compression level, if None - compressor default.
+    :param int chunk_size: size of data blocks to produce.
+
+    :rtype: __generator[bytes]
+    :raise: TypeError
+    """
+
+    if hasattr(stream, 'read'):
+        stream = to_chunks(stream)
+
+    generator = iter(stream)
+    if compression:
+        generator = compress(generator, compression, level)
+
+    generator = coalesce(generator, chunk_size)
+    if chunked:
+        generator = enchunk(generator)
+
+    return generator
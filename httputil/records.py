@@ -0,0 +1,405 @@
+"""Incremental parsing of record streams: newline delimited JSON, JSON text
+sequences (RFC 7464) and CSV.
+
+Parsers are fed body blocks as they arrive and return the records completed
+so far. Only the unterminated tail of the last record is kept between
+blocks, so peak memory is bounded by block and record size rather than body
+size:
+
+    for batch in records.read_ndjson(stream, chunked=True, batch_size=100):
+        ...
+"""
+
+__author__ = 'vovanec@gmail.com'
+
+import csv
+import io
+import json
+
+from .httputil import BodyStreamError
+from .httputil import read_body_stream
+
+
+LF = b'\n'
+RS = b'\x1e'
+
+
+class RecordError(BodyStreamError):
+
+    """Raised when record could not be parsed.
+    """
+
+    pass
+
+
+class RecordParser(object):
+
+    """Base incremental record parser. Subclasses define record delimiter
+    and implement _parse().
+
+    """
+
+    delimiter = LF
+
+    def __init__(self, encoding='utf-8', max_record_size=None):
+        """Constructor.
+
+        :param str encoding: text encoding of records.
+        :param int|None max_record_size: maximum size of a record in bytes,
+               if None - unlimited.
+        """
+
+        self.encoding = encoding
+        self.max_record_size = max_record_size
+
+        self._tail = bytearray()
+
+    def feed(self, chunk):
+        """Parse data block.
+
+        :param bytes chunk: data block.
+
+        :return: records completed by the block.
+        :rtype: list
+        :raise: RecordError
+        """
+
+        end = self._boundary(chunk)
+        if end < 0:
+            self._tail += chunk
+            self._check_tail()
+            return []
+
+        data = chunk[:end]
+        if self._tail:
+            data = bytes(self._tail) + data
+        self._tail = bytearray(chunk[end:])
+        self._check_tail()
+
+        return self._parse(data)
+
+    def close(self):
+        """Parse the last record, not terminated by delimiter.
+
+        :rtype: list
+        :raise: RecordError
+        """
+
+        data, self._tail = bytes(self._tail), bytearray()
+
+        return self._parse(data) if data.strip() else []
+
+    def _check_tail(self):
+        """Check that unterminated record does not exceed size limit.
+
+        :raise: RecordError
+        """
+
+        if self.max_record_size is not None and \
+                len(self._tail) > self.max_record_size:
+            raise RecordError('Record is larger than %d bytes.' %
+                              (self.max_record_size,))
+
+    def _boundary(self, chunk):
+        """Find the end of the last complete record in block.
+
+        :param bytes chunk: data block.
+
+        :return: position after the last complete record, -1 if block
+                 does not complete any record.
+        :rtype: int
+        """
+
+        end = chunk.rfind(self.delimiter)
+
+        return end if end < 0 else end + len(self.delimiter)
+
+    def _parse(self, data):
+        """Parse complete records.
+
+        :param bytes data: one or more complete records.
+
+        :rtype: list
+        :raise: RecordError
+        """
+
+        raise NotImplementedError
+
+    def _decode_json(self, data):
+
+        try:
+            return json.loads(data.decode(self.encoding))
+        except ValueError as err:
+            raise RecordError('Malformed JSON record: %s' % (err,)) from None
+
+
+class NDJSONParser(RecordParser):
+
+    """Newline delimited JSON parser. Blank lines are skipped."""
+
+    def _parse(self, data):
+
+        return [self._decode_json(line)
+                for line in data.split(LF) if line.strip()]
+
+
+class JSONSeqParser(RecordParser):
+
+    """JSON text sequence (RFC 7464) parser. Each record is preceded by
+    RS character, so it is only complete once the next record starts or the
+    stream ends.
+
+    """
+
+    delimiter = RS
+
+    def _parse(self, data):
+
+        return [self._decode_json(text)
+                for text in data.split(RS) if text.strip()]
+
+
+class CSVParser(RecordParser):
+
+    """CSV parser. Quoted fields may contain line breaks. Records are lists
+    of fields, or dicts keyed by column names if header is set.
+
+    """
+
+    def __init__(self, header=False, encoding='utf-8', max_record_size=None,
+                 **fmtparams):
+        """Constructor.
+
+        :param bool header: whether the first record contains column names.
+        :param str encoding: text encoding.
+        :param int|None max_record_size: maximum size of a record in bytes,
+               if None - unlimited.
+        :param fmtparams: csv.reader formatting parameters.
+        """
+
+        super().__init__(encoding, max_record_size)
+
+        self.fields = None
+        self._header = header
+        self._fmtparams = fmtparams
+        # Whether the tail ends within a quoted field.
+        self._quoted = False
+
+        quotechar = csv.reader([], **fmtparams).dialect.quotechar
+        self._quote = quotechar.encode(encoding) if quotechar else None
+
+    def _boundary(self, chunk):
+
+        quote = self._quote
+        if quote is None or not self._quoted and quote not in chunk:
+            return super()._boundary(chunk)
+
+        quoted = self._quoted
+        end = -1
+        pos = 0
+        while True:
+            nl = chunk.find(LF, pos)
+            if nl < 0:
+                break
+
+            quoted ^= bool(chunk.count(quote, pos, nl) & 1)
+            pos = nl + 1
+            if not quoted:
+                end = pos
+
+        self._quoted = (self._quoted if end < 0 else False) ^ \
+            bool(chunk.count(quote, max(end, 0)) & 1)
+
+        return end
+
+    def close(self):
+
+        self._quoted = False
+
+        return super().close()
+
+    def _parse(self, data):
+
+        try:
+            rows = list(csv.reader(io.StringIO(data.decode(self.encoding),
+                                               newline=''),
+                                   **self._fmtparams))
+        except (csv.Error, ValueError) as err:
+            raise RecordError('Malformed CSV record: %s' % (err,)) from None
+
+        if not self._header:
+            return rows
+
+        if self.fields is None and rows:
+            self.fields = rows.pop(0)
+
+        return [dict(zip(self.fields, row)) for row in rows]
+
+
+def batched(records, batch_size):
+    """Group records into lists.
+
+    :param collections.Iterable records: records.
+    :param int batch_size: maximum number of records in list, the last
+           list may be shorter.
+
+    :rtype: __generator[list]
+    """
+
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def parse_records(chunks, parser, batch_size=None):
+    """Parse records from data blocks.
+
+    :param collections.Iterable[bytes] chunks: data blocks.
+    :param RecordParser parser: record parser.
+    :param int|None batch_size: if set, records are yielded in lists of
+           this size.
+
+    :rtype: __generator
+    :raise: RecordError
+    """
+
+    def generate():
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+
+        yield from parser.close()
+
+    if batch_size:
+        return batched(generate(), batch_size)
+
+    return generate()
+
+
+def read_ndjson(stream, chunked=False, compression=None, batch_size=None,
+                **kwargs):
+    """Read newline delimited JSON records from HTTP body stream.
+
+    :param file stream: readable stream.
+    :param bool chunked: whether stream is chunked.
+    :param str|None compression: compression type is stream is
+           compressed, otherwise None.
+    :param int|None batch_size: if set, records are yielded in lists of
+           this size.
+    :param kwargs: NDJSONParser options.
+
+    :rtype: __generator
+    :raise: TypeError, BodyStreamError
+    """
+
+    return parse_records(read_body_stream(stream, chunked, compression),
+                         NDJSONParser(**kwargs), batch_size)
+
+
+def read_json_seq(stream, chunked=False, compression=None, batch_size=None,
+                  **kwargs):
+    """Read JSON text sequence records from HTTP body stream.
+
+    :param file stream: readable stream.
+    :param bool chunked: whether stream is chunked.
+    :param str|None compression: compression type is stream is
+           compressed, otherwise None.
+    :param int|None batch_size: if set, records are yielded in lists of
+           this size.
+    :param kwargs: JSONSeqParser options.
+
+    :rtype: __generator
+    :raise: TypeError, BodyStreamError
+    """
+
+    return parse_records(read_body_stream(stream, chunked, compression),
+                         JSONSeqParser(**kwargs), batch_size)
+
+
+def read_csv(stream, chunked=False, compression=None, batch_size=None,
+             **kwargs):
+    """Read CSV records from HTTP body stream.
+
+    :param file stream: readable stream.
+    :param bool chunked: whether stream is chunked.
+    :param str|None compression: compression type is stream is
+           compressed, otherwise None.
+    :param int|None batch_size: if set, records are yielded in lists of
+           this size.
+    :param kwargs: CSVParser options.
+
+    :rtype: __generator
+    :raise: TypeError, BodyStreamError
+    """
+
+    return parse_records(read_body_stream(stream, chunked, compression),
+                         CSVParser(**kwargs), batch_size)
+
+
+class RecordCallback(object):
+
+    """Streaming callback for request engines, passing parsed records to
+    record callback as body blocks arrive. Call close() once request is
+    complete to pass the last record and the last batch:
+
+        on_body = records.RecordCallback(records.NDJSONParser(), consume)
+        engine.request(url, streaming_callback=on_body)
+        on_body.close()
+
+    """
+
+    def __init__(self, parser, callback, batch_size=None):
+        """Constructor.
+
+        :param RecordParser parser: record parser.
+        :param object -> None callback: called with each record, or with
+               lists of records if batch_size is set.
+        :param int|None batch_size: number of records to pass at once.
+        """
+
+        self.count = 0
+
+        self._parser = parser
+        self._callback = callback
+        self._batch_size = batch_size
+        self._batch = []
+
+    def __call__(self, chunk):
+        """Consume body block.
+
+        :param bytes chunk: body block.
+
+        :raise: RecordError
+        """
+
+        self._emit(self._parser.feed(chunk), False)
+
+    def close(self):
+        """Pass the remaining records.
+
+        :raise: RecordError
+        """
+
+        self._emit(self._parser.close(), True)
+
+    def _emit(self, records, final):
+
+        self.count += len(records)
+        if not self._batch_size:
+            for record in records:
+                self._callback(record)
+            return
+
+        self._batch.extend(records)
+        while len(self._batch) >= self._batch_size:
+            self._callback(self._batch[:self._batch_size])
+            del self._batch[:self._batch_size]
+
+        if final and self._batch:
+            self._callback(self._batch)
+            self._batch = []
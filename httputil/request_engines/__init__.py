@@ -1,4 +1,61 @@
 """HTTP request engine implementations.
+
+Engine modules are imported lazily, so importing this package does not pull
+in requests, tornado or pycurl:
+
+    engine = request_engines.create_engine(
+        'sync', api_base_url, connect_timeout, request_timeout, conn_retries)
 """
 
 __author__ = 'vovanec@gmail.com'
+
+import importlib
+
+
+ENGINES = {
+    'sync': 'httputil.request_engines.sync.SyncRequestEngine',
+    'async': 'httputil.request_engines.async.AsyncRequestEngine'
+}
+
+
+def register_engine(name, engine):
+    """Register request engine.
+
+    :param str name: engine name.
+    :param str|type engine: engine class or its dotted path, which is
+           imported on first use.
+    """
+
+    ENGINES[name] = engine
+
+
+def get_engine_class(name):
+    """Get request engine class by name, importing its module if needed.
+
+    :param str name: engine name.
+
+    :rtype: type
+    :raise: KeyError
+    """
+
+    engine = ENGINES[name]
+    if isinstance(engine, str):
+        module_name, _, class_name = engine.rpartition('.')
+        engine = getattr(importlib.import_module(module_name), class_name)
+        ENGINES[name] = engine
+
+    return engine
+
+
+def create_engine(name, *args, **kwargs):
+    """Create request engine.
+
+    :param str name: engine name.
+    :param args: engine constructor arguments.
+    :param kwargs: engine constructor keyword arguments.
+
+    :rtype: base.BaseRequestEngine
+    :raise: KeyError
+    """
+
+    return get_engine_class(name)(*args, **kwargs)
@@ -3,33 +3,68 @@
 __author__ = 'vovanec@gmail.com'
 
 
+import asyncio
+import functools
+import http.client
+import io
+import pycurl
+import time
+
+from concurrent import futures
+from tornado import concurrent
 from tornado import curl_httpclient
 from tornado import gen
 from tornado import httpclient
+from tornado import httputil as tornado_httputil
+from tornado import ioloop
+from tornado import iostream
+from tornado.platform import asyncio as tornado_asyncio
 
+from . import body
+from . import download as downloads
+from . import response as responses
+from . import scheduler as schedulers
+from . import streaming
+from . import transport
+from .. import httputil
+from .base import OVERLOAD_CODES
+from .base import SLASH
 from .base import BaseRequestEngine
+from .base import host_and_port
 from .errors import ClientError
 from .errors import CommunicationError
+from .errors import ContentChangedError
 from .errors import MalformedResponse
+from .errors import RangeError
+from .errors import RequestCancelled
 from .errors import ServerError
 
 
-# Configure async engine to use CURL client whenever possible.
-httpclient.AsyncHTTPClient.configure(curl_httpclient.CurlAsyncHTTPClient)
+RESOLVER_THREADS = 2
+DEF_HTTP2_MAX_CLIENTS = 100
+
+HTTP2_SUPPORTED = bool(
+    pycurl.version_info()[4] & getattr(pycurl, 'VERSION_HTTP2', 0))
+
+# Tornado curl client internals transfers are aborted with.
+CURL_CLIENT_INTERNALS = ('_requests', '_curls', '_finish', '_process_queue')
 
 
 class AsyncRequestEngine(BaseRequestEngine):
 
     """Asynchronous request engine.
 
-    Uses Tornado asynchronous client to make HTTP requests.
+    Uses Tornado CURL asynchronous client to make HTTP requests. The client
+    is instantiated directly rather than configured as the process-wide
+    AsyncHTTPClient implementation, so other tornado users are not affected.
 
     """
 
     def __init__(self, api_base_url, connect_timeout, request_timeout,
                  conn_retries, username=None, password=None,
                  client_cert=None, client_key=None, verify_cert=True,
-                 ca_certs=None):
+                 ca_certs=None, http2=False, http2_prior_knowledge=False,
+                 max_clients=None, scheduler=None, **kwargs):
         """Constructor.
 
         :param str api_base_url: API base URL.
@@ -43,37 +78,307 @@ class AsyncRequestEngine(BaseRequestEngine):
         :param str|None client_key: client key.
         :param bool verify_cert: whether to verify server cert.
         :param str|None ca_certs: path to CA certificate chain.
+        :param bool http2: whether to use HTTP/2 multiplexing concurrent
+               requests over a single connection per host. Engine gets its
+               own client instance in this mode. Curl needs a handle per
+               request, so max_clients caps concurrent streams too.
+        :param bool http2_prior_knowledge: whether to speak HTTP/2 to
+               plain HTTP endpoints right away (h2c with prior knowledge).
+               Otherwise curl asks to upgrade plain HTTP connections to
+               HTTP/2, which many servers do not support.
+        :param int|None max_clients: maximum number of concurrent requests,
+               if None - tornado default, or DEF_HTTP2_MAX_CLIENTS in
+               HTTP/2 mode.
+        :param scheduler.FairScheduler|None scheduler: if set, requests
+               wait for a slot in the scheduler before they are handed to
+               curl, so that priority classes share the slots fairly rather
+               than in order of arrival. Its max_concurrency should not
+               exceed max_clients. Engine with concurrency_limit gets
+               scheduler by default, and its limit follows the adaptive
+               limit. Adaptive limit is capped by max_clients, or the
+               engine gets a client of its own with max_clients equal to
+               the maximum limit.
+        :param kwargs: other options, see BaseRequestEngine.
         """
 
         super().__init__(
             api_base_url, connect_timeout, request_timeout, conn_retries,
             username=username, password=password,
             client_cert=client_cert, client_key=client_key,
-            verify_cert=verify_cert, ca_certs=ca_certs)
+            verify_cert=verify_cert, ca_certs=ca_certs, **kwargs)
+
+        if http2 and not HTTP2_SUPPORTED:
+            raise ValueError('libcurl is built without HTTP/2 support.')
+
+        if http2 and http2_prior_knowledge and \
+                not hasattr(pycurl, 'CURL_HTTP_VERSION_2_PRIOR_KNOWLEDGE'):
+            raise ValueError('pycurl does not support HTTP/2 with prior '
+                             'knowledge.')
+
+        if self._concurrency_limit is not None:
+            # Requests over the limit must wait in the scheduler rather than
+            # in curl's queue, where waiting would count as latency.
+            if max_clients is None:
+                max_clients = self._concurrency_limit.max_limit
+            elif max_clients < self._concurrency_limit.max_limit:
+                self._concurrency_limit.set_max_limit(max_clients)
+
+            if scheduler is None:
+                scheduler = schedulers.FairScheduler(
+                    self._concurrency_limit.limit)
+
+        self._http2 = http2
+        self._http2_prior_knowledge = http2_prior_knowledge
+        self._max_clients = max_clients
+        self._scheduler = scheduler
+        self._client = self._make_client()
+        self._unix_client = None
+
+        self._curl_share = None
+        self.reload_certs()
+
+        self._resolver_executor = None
+        if self._resolver is not None:
+            self._resolver_executor = futures.ThreadPoolExecutor(
+                RESOLVER_THREADS)
+
+    def warm_up(self, n_connections=1):
+        """Open connections to every API endpoint with concurrent HEAD
+        requests to its base URL. Curl keeps the connections alive for
+        subsequent requests.
 
-        self._client = httpclient.AsyncHTTPClient()
+        :param int n_connections: the number of connections per endpoint,
+               up to max_clients.
+
+        :return: future resolved with the number of connections opened.
+        :rtype: tornado.concurrent.Future
+        """
+
+        self._check_fork()
+
+        return gen.coroutine(self._warm_up)(n_connections)
+
+    def _warm_up(self, n_connections):
+
+        open_connection = gen.coroutine(self._open_connection)
+        opened = yield [open_connection(base_url)
+                        for base_url in self._warm_up_urls()
+                        for _ in range(n_connections)]
+
+        return sum(opened)
+
+    def _open_connection(self, base_url):
+        """Open connection with HEAD request, any HTTP response will do.
+
+        :param str base_url: endpoint base URL.
+
+        :return: whether connection was opened.
+        :rtype: bool
+        """
+
+        request = self._prepare_request(base_url + SLASH, 'HEAD', None, None)
+        try:
+            yield from self._fetch(request, None)
+        except httpclient.HTTPError as err:
+            if err.code == 599:
+                self._log.warning('Could not open connection to %s: %s',
+                                  base_url, err)
+                return False
+
+        return True
+
+    def _after_fork(self):
+
+        # Inherited clients are dropped rather than closed, closing would
+        # shut down connections still used by the parent process.
+        self._client = self._make_client(force_instance=True)
+        self._unix_client = None
+        self.reload_certs()
+
+        if self._scheduler is not None:
+            # Slots of parent's requests would never be released.
+            self._scheduler.reset()
+
+        if self._resolver is not None:
+            self._resolver_executor = futures.ThreadPoolExecutor(
+                RESOLVER_THREADS)
+
+    def _make_client(self, force_instance=False):
+        """Create curl client. Client is shared with other tornado users
+        unless engine needs one of its own.
+
+        :param bool force_instance: whether to create a client of its own.
+
+        :rtype: curl_httpclient.CurlAsyncHTTPClient
+        """
+
+        kwargs = {}
+        if self._http2 or self._max_clients:
+            force_instance = True
+            kwargs['max_clients'] = self._max_clients or DEF_HTTP2_MAX_CLIENTS
+
+        if self._resolver is not None:
+            # Addresses pinned by the engine go to DNS cache of the client's
+            # multi handle, other users of the client must not see them.
+            force_instance = True
+
+        client = curl_httpclient.CurlAsyncHTTPClient(
+            force_instance=force_instance, **kwargs)
+        if self._http2:
+            _curl_multi(client).setopt(pycurl.M_PIPELINING,
+                                       pycurl.PIPE_MULTIPLEX)
+
+        return client
+
+    def reload_certs(self):
+        """Drop TLS sessions shared between curl handles of the engine.
+        Curl reads certificate files itself when it opens a connection, so
+        new connections use the current files.
+        """
+
+        self._curl_share = pycurl.CurlShare()
+        self._curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
 
     def _request(self, url, *,
-                 method='GET', headers=None, data=None, result_callback=None):
+                 method='GET', headers=None, data=None, result_callback=None,
+                 streaming_callback=None, header_callback=None,
+                 return_response=False, priority=None, cancel_token=None):
         """Perform asynchronous request.
 
-        :param str url: request URL.
+        :param str url: request URL relative to API base URL.
         :param str method: request method.
         :param dict headers: request headers.
-        :param object data: JSON-encodable object.
+        :param object data: request body: bytes, file object, iterator of
+               bytes or async iterable of bytes, or tornado-style body
+               producer, a callable which takes a write function and returns
+               Future. Async iterables require IOLoop running on asyncio
+               loop, e.g. tornado.platform.asyncio.AsyncIOMainLoop.
         :param object -> object result_callback: result callback.
+        :param bytes -> None streaming_callback: if set, response body is
+               passed to it in blocks as they arrive instead of being
+               returned. Request is not retried once a block was passed.
+        :param (int, collections.Mapping) -> None header_callback: called
+               with HTTP code and headers of successful response before
+               its body is processed.
+        :param bool return_response: whether to return response.Response
+               rather than body. Its headers are parsed on demand and body
+               is not copied.
+        :param str|None priority: priority class name to queue the request
+               in when engine has scheduler.
+        :param cancel.CancelToken|None cancel_token: token to cancel the
+               request with. Cancellation aborts curl transfer, or removes
+               request from the queue, and stops retries.
 
-        :rtype: dict
-        :raise: APIError
+        :rtype: dict|response.Response
+        :raise: APIError, QueueFullError, RequestCancelled,
+               TypeError
         """
 
-        request = self._prepare_request(url, method, headers, data)
+        if callable(data):
+            data = BodyProducer(data)
+        elif body.is_async_iterable(data):
+            data = BodyProducer(_async_iterable_producer(data))
+        elif body.is_streaming(data):
+            data = body.StreamingBody(data)
+
+        body_stream = None
+        if streaming_callback is not None:
+            body_stream = streaming.ResumableBodyStream(
+                streaming_callback, header_callback,
+                resumable='Range' not in tornado_httputil.HTTPHeaders(
+                    headers or {}))
 
         retries_left = self._conn_retries
+        tried = set()
 
         while True:
+            if cancel_token is not None:
+                cancel_token.check()
+
+            delay = self._rate_limit_delay(url)
+            if delay:
+                yield from _wait_cancellable(gen.sleep(delay), cancel_token)
+
+            acquired = False
+            if self._scheduler is not None:
+                # Slot is held for a single attempt, not over retry back-off.
+                waiter = self._scheduler.acquire(priority)
+                yield from _wait_cancellable(
+                    waiter, cancel_token,
+                    functools.partial(self._scheduler.cancel, waiter))
+                acquired = True
+
+            # Endpoint is selected once the request may be sent, so that
+            # every selection is matched by balancer.finish().
+            endpoint = None
+            started_at = time.time()
+            started = time.monotonic()
+
             try:
-                response = yield self._client.fetch(request)
+                failed = False
+                cancelled = False
+                code = None
+                try:
+                    endpoint = self._balancer.select(tried)
+                    tried.add(endpoint)
+
+                    response_stream = None
+                    request_headers = headers
+                    if body_stream is not None:
+                        response_stream = ResponseStream(body_stream)
+                        request_headers = body_stream.request_headers(
+                            headers)
+
+                    header_lines = [] if return_response else None
+
+                    request = self._prepare_request(
+                        self._make_full_url(url, endpoint.base_url),
+                        method, request_headers, data, response_stream,
+                        header_lines)
+
+                    response = yield from self._fetch(request, data,
+                                                      cancel_token)
+                    code = response.code
+                except httpclient.HTTPError as err:
+                    failed = err.code == 599
+                    code = err.code
+                    if err.response is not None:
+                        self._update_rate_limit(
+                            url, err.code, err.response.headers
+                            if header_lines is None else
+                            responses.parse_header_lines(header_lines))
+                    raise
+                except RequestCancelled:
+                    cancelled = True
+                    raise
+                finally:
+                    latency = time.monotonic() - started
+                    if acquired:
+                        self._release_slot(latency, code)
+                    if endpoint is not None:
+                        # Cancelled request tells nothing of endpoint.
+                        self._balancer.finish(
+                            endpoint, None if cancelled else latency, failed)
+
+                result = None
+                if return_response:
+                    result = self._make_response(
+                        response, header_lines, started_at, started)
+
+                self._update_rate_limit(url, response.code,
+                                        result or response.headers)
+
+                if response_stream is not None:
+                    response_stream.finish()
+                    return None
+
+                if header_callback is not None:
+                    header_callback(response.code, response.headers
+                                    if result is None else result.headers)
+
+                if result is not None:
+                    return result
+
                 try:
                     if result_callback:
                         return result_callback(response.body)
@@ -85,34 +390,217 @@ class AsyncRequestEngine(BaseRequestEngine):
             except httpclient.HTTPError as err:
                 resp_body = err.response.body \
                     if err.response is not None else None
+                if response_stream is not None:
+                    response_stream.raise_error()
+                    resp_body = _decode_error_body(
+                        bytes(response_stream.error_body),
+                        response_stream.headers)
+                elif header_lines is not None and resp_body is not None:
+                    resp_body = _decode_error_body(
+                        resp_body, responses.parse_header_lines(header_lines))
+
                 if err.code == 599:
-                    if self._conn_retries is None or retries_left <= 0:
+                    if self._conn_retries is None or retries_left <= 0 or \
+                            (body_stream is not None and
+                             body_stream.started and
+                             not body_stream.can_resume) or \
+                            not _rewind(data):
                         raise CommunicationError(err) from None
                     else:
                         retries_left -= 1
-                        retry_in = (self._conn_retries - retries_left) * 2
+                        retry_in = self._retry_in(retries_left, tried)
+                        if body_stream is not None and body_stream.started:
+                            # Connection was fine, no need to back off.
+                            retry_in = 0
+                            self._log.warning('Resuming response body at '
+                                              'byte %d.', body_stream.offset)
                         self._log.warning('Server communication error: %s. '
                                           'Retrying in %s seconds.', err,
                                           retry_in)
-                        yield gen.sleep(retry_in)
+                        yield from _wait_cancellable(gen.sleep(retry_in),
+                                                     cancel_token)
                         continue
                 elif 400 <= err.code < 500:
                     raise ClientError(err.code, resp_body) from None
 
                 raise ServerError(err.code, resp_body) from None
 
-    def _prepare_request(self, url, method, headers, data):
+    def _release_slot(self, latency, code):
+        """Release scheduler slot, adapting the number of slots to the
+        concurrency limit.
+
+        :param float latency: request latency.
+        :param int|None code: response HTTP code, None if request did not
+               complete.
+        """
+
+        if self._concurrency_limit is not None and code is not None:
+            self._scheduler.set_max_concurrency(self._concurrency_limit.sample(
+                latency, self._scheduler.in_flight, code in OVERLOAD_CODES))
+
+        self._scheduler.release()
+
+    def download(self, url, dest, *, segments=downloads.DEF_SEGMENTS,
+                 segment_size=None, headers=None):
+        """Download content into file, fetching segments concurrently.
+        Segments are validated by If-Range against ETag or Last-Modified
+        date of content, content without either is downloaded in one go.
+
+        :param str url: request URL.
+        :param str dest: destination file path.
+        :param int segments: the number of segments to download in parallel.
+        :param int|None segment_size: segment size, takes precedence over the
+               number of segments.
+        :param dict headers: request headers.
+
+        :return: the number of bytes downloaded.
+        :rtype: int
+        :raise: APIError, ContentChangedError
+        """
+
+        probe = {}
+        yield from self.request(
+            url, method='HEAD', headers=self._download_headers(headers),
+            header_callback=lambda _, hdrs: probe.update(headers=hdrs))
+        size, accepts_ranges = downloads.probe_ranges(probe['headers'])
+        # Segments must be taken from the same version of content.
+        validator = streaming.strong_validator(probe['headers'])
+
+        # File is written by executor thread, not to block IOLoop on disk.
+        with futures.ThreadPoolExecutor(1) as executor:
+            if not accepts_ranges or not size or segments <= 1 or \
+                    validator is None:
+                with open(dest, 'wb') as fh:
+                    writer = downloads.BackgroundWriter(
+                        downloads.FileWriter(fh), executor)
+                    yield from self.request(
+                        url, headers=self._download_headers(headers),
+                        streaming_callback=writer.write)
+                    yield writer.flush()
+                return writer.position
+
+            yield executor.submit(downloads.preallocate, dest, size)
+            ranges = downloads.plan_segments(size, segments, segment_size)
+            download_segment = gen.coroutine(self._download_segment)
+            with open(dest, 'r+b') as fh:
+                remaining = iter(ranges)
+                failures = []
+
+                @gen.coroutine
+                def download_segments():
+                    # Each worker takes the next segment as soon as its
+                    # previous one is done, until the first failure.
+                    for start, end in remaining:
+                        if failures:
+                            break
+                        try:
+                            yield download_segment(
+                                url, downloads.BackgroundWriter(
+                                    downloads.FileWriter(fh, start),
+                                    executor),
+                                start, end, headers, validator)
+                        except Exception as err:
+                            failures.append(err)
+
+                # Wait for all segments in flight before failing, so that
+                # file is not closed under them.
+                yield [download_segments()
+                       for _ in range(min(segments, len(ranges)))]
+                if failures:
+                    raise failures[0]
+
+        return size
+
+    def _download_segment(self, url, writer, start, end, headers, validator):
+        """Download byte range into file, resuming from the last byte
+        written on errors.
+
+        :param str url: request URL.
+        :param downloads.BackgroundWriter writer: writer positioned at the
+               first byte of segment.
+        :param int start: first byte position.
+        :param int end: last byte position.
+        :param dict headers: request headers.
+        :param str validator: ETag or Last-Modified date of content.
+
+        :raise: APIError, ContentChangedError
+        """
+
+        retries_left = self._conn_retries or 0
+
+        while True:
+            yield writer.flush()
+            position = writer.position
+            if position > end:
+                break
+
+            try:
+                yield from self.request(
+                    url, headers=self._download_headers(
+                        headers, position, end, validator),
+                    header_callback=functools.partial(
+                        downloads.check_range_response, position),
+                    streaming_callback=writer.write)
+                yield writer.flush()
+                if writer.position <= end:
+                    raise RangeError('Segment %d-%d ended at %d' %
+                                     (start, end, writer.position))
+            except ContentChangedError:
+                raise
+            except ClientError as err:
+                if err.code == http.client.PRECONDITION_FAILED:
+                    raise ContentChangedError(str(err)) from None
+                raise
+            except (CommunicationError, RangeError) as err:
+                if retries_left <= 0:
+                    raise
+                retries_left -= 1
+                self._log.warning('Segment %d-%d download error: %s. '
+                                  'Resuming at %d.', start, end, err,
+                                  writer.position)
+
+    @staticmethod
+    def _make_response(response, header_lines, started_at, started):
+        """Make Response sharing body buffer with tornado response.
+
+        :param httpclient.HTTPResponse response: tornado response.
+        :param list[str] header_lines: collected header lines.
+        :param float started_at: UNIX time the request was sent at.
+        :param float started: monotonic time the request was sent at.
+
+        :rtype: response.Response
+        """
+
+        raw = b''
+        if response.buffer is not None:
+            raw = response.buffer.getbuffer()
+
+        return responses.Response(
+            response.code, header_lines, raw, url=response.effective_url,
+            started=started_at, elapsed=time.monotonic() - started)
+
+    def _prepare_request(self, url, method, headers, data,
+                         response_stream=None, header_lines=None):
         """Prepare HTTP request.
 
         :param str url: request URL.
         :param str method: request method.
         :param dict headers: request headers.
-        :param object data: JSON-encodable object.
+        :param object data: request body, bytes, body.StreamingBody or
+               BodyProducer.
+        :param ResponseStream|None response_stream: response body consumer
+               if response is to be streamed.
+        :param list|None header_lines: list to collect raw header lines into
+               if response.Response is to be returned.
 
         :rtype: httpclient.HTTPRequest
 
         """
 
+        stream = None
+        if isinstance(data, (body.StreamingBody, BodyProducer)):
+            stream, data = data, b''
+
         request = httpclient.HTTPRequest(
             url=url, method=method, headers=headers, body=data,
             connect_timeout=self._connect_timeout,
@@ -121,4 +609,732 @@ class AsyncRequestEngine(BaseRequestEngine):
             client_cert=self._client_cert, client_key=self._client_key,
             ca_certs=self._ca_certs, validate_cert=self._verify_cert)
 
+        if response_stream is not None:
+            # Body is decoded by the stream, so that transfer can be resumed
+            # at raw byte offset.
+            request.headers.setdefault('Accept-Encoding', 'gzip, deflate')
+            request.decompress_response = False
+            request.header_callback = response_stream.on_header_line
+            request.streaming_callback = response_stream.on_chunk
+        elif header_lines is not None:
+            # Headers are parsed and body is decoded by response.Response
+            # on demand.
+            request.headers.setdefault('Accept-Encoding', 'gzip, deflate')
+            request.decompress_response = False
+            request.header_callback = header_lines.append
+
+        request.prepare_curl_callback = _chain_curl_callbacks(
+            _reset_curl,
+            functools.partial(_setup_curl_share, self._curl_share),
+            functools.partial(
+                _setup_curl_http2,
+                self._http2_prior_knowledge and
+                transport.scheme(url) != 'https')
+            if self._http2 else None,
+            functools.partial(_setup_curl_body, method, stream)
+            if stream is not None else None,
+            response_stream.attach if response_stream is not None else None,
+            _disable_curl_decoding if header_lines is not None else None)
+
         return request
+
+    def _fetch(self, request, data, cancel_token=None):
+        """Send request with the transport selected by URL scheme.
+
+        :param httpclient.HTTPRequest request: HTTP request.
+        :param object data: request body as passed to _prepare_request().
+        :param cancel.CancelToken|None cancel_token: cancellation token.
+
+        :rtype: httpclient.HTTPResponse
+        :raise: httpclient.HTTPError, RequestCancelled
+        """
+
+        url_scheme = transport.scheme(request.url)
+        if url_scheme == transport.MEMORY_SCHEME:
+            if isinstance(data, BodyProducer):
+                data = yield from data.collect()
+
+            return self._fetch_memory(request, data)
+
+        if url_scheme == transport.UNIX_SCHEME:
+            socket_path, request.url = transport.split_unix_url(request.url)
+            request.prepare_curl_callback = _chain_curl_callbacks(
+                request.prepare_curl_callback,
+                functools.partial(_setup_curl_unix, socket_path))
+            client = self._get_unix_client()
+        else:
+            yield from self._pin_addresses(request)
+            client = self._client
+
+        if isinstance(data, BodyProducer):
+            data.run_callback = functools.partial(_run_curl, client)
+
+        future = client.fetch(request)
+        if isinstance(data, BodyProducer):
+            # Tornado futures run callbacks right away, so producer is
+            # detached before curl handle is reused by another request.
+            future.add_done_callback(lambda _: data.detach())
+
+        response = yield from _wait_cancellable(
+            future, cancel_token,
+            functools.partial(_abort_fetch, client, request))
+
+        return response
+
+    def _fetch_memory(self, request, data):
+        """Serve request with in-memory transport, passing response to
+        request callbacks the same way curl client does.
+
+        :param httpclient.HTTPRequest request: HTTP request.
+        :param object data: request body.
+
+        :rtype: httpclient.HTTPResponse
+        :raise: httpclient.HTTPError
+        """
+
+        if not isinstance(data, body.StreamingBody):
+            data = request.body
+
+        started = time.monotonic()
+        try:
+            resp = self._memory_transport.handle(
+                request.method, request.url, request.headers, data)
+        except OSError as err:
+            raise httpclient.HTTPError(599, str(err)) from None
+
+        headers = tornado_httputil.HTTPHeaders(resp.headers)
+        resp_body = resp.body
+
+        if request.header_callback is not None:
+            request.header_callback('HTTP/1.1 %d %s\r\n' %
+                                    (resp.code, resp.reason))
+            for name, value in headers.get_all():
+                request.header_callback('%s: %s\r\n' % (name, value))
+            request.header_callback('\r\n')
+
+        buffer = None
+        if request.streaming_callback is not None:
+            if resp_body:
+                request.streaming_callback(resp_body)
+        else:
+            if request.decompress_response and resp_body:
+                try:
+                    compression = httputil.compression_from_header(
+                        headers.get('Content-Encoding'))
+                except TypeError:
+                    compression = None
+                if compression is not None:
+                    resp_body = b''.join(
+                        httputil.decompress([resp_body], compression))
+            buffer = io.BytesIO(resp_body)
+
+        response = httpclient.HTTPResponse(
+            request, resp.code, reason=resp.reason, headers=headers,
+            buffer=buffer, effective_url=request.url,
+            request_time=time.monotonic() - started)
+        if not 200 <= resp.code < 300:
+            raise httpclient.HTTPError(resp.code, resp.reason, response)
+
+        return response
+
+    def _get_unix_client(self):
+        """Get client for requests over Unix domain sockets. Those get a
+        client of their own, as curl handles can't be switched back to TCP
+        once socket path is set.
+
+        :rtype: curl_httpclient.CurlAsyncHTTPClient
+        """
+
+        if self._unix_client is None:
+            self._unix_client = self._make_client(force_instance=True)
+
+        return self._unix_client
+
+    def _pin_addresses(self, request):
+        """Resolve request host with engine resolver and make curl connect to
+        the resolved addresses, bypassing its own lookup. Cache misses are
+        resolved in a thread pool, so that IOLoop is not blocked.
+
+        :param httpclient.HTTPRequest request: HTTP request.
+
+        :raise: httpclient.HTTPError
+        """
+
+        if self._resolver is None:
+            return
+
+        host, port = host_and_port(request.url)
+        addresses = self._resolver.cached(host, port)
+        if addresses is None:
+            try:
+                addresses = yield self._resolver_executor.submit(
+                    self._resolver.resolve, host, port)
+            except OSError as err:
+                raise httpclient.HTTPError(599, 'Could not resolve host %s: %s'
+                                           % (host, err)) from None
+
+        request.prepare_curl_callback = _chain_curl_callbacks(
+            request.prepare_curl_callback,
+            functools.partial(_setup_curl_resolve, host, port, addresses,
+                              self._resolver.happy_eyeballs_delay))
+
+
+def _decode_error_body(raw, headers):
+    """Decode error response body received undecoded, as curl and requests
+    decode error bodies of other requests. Body which can't be decoded is
+    left as is.
+
+    :param bytes raw: body as received.
+    :param collections.Mapping headers: response headers.
+
+    :rtype: bytes
+    """
+
+    try:
+        return bytes(responses.decode_body(raw, headers))
+    except MalformedResponse:
+        return raw
+
+
+def _wait_cancellable(future, cancel_token, on_cancel=None):
+    """Wait for future unless cancel token is cancelled first.
+
+    :param tornado.concurrent.Future future: future to wait for.
+    :param cancel.CancelToken|None cancel_token: cancellation token.
+    :param () -> None on_cancel: called on the IOLoop thread if future is
+           not done when token is cancelled, to abort what it waits for.
+
+    :return: future result.
+    :raise: RequestCancelled
+    """
+
+    if cancel_token is None:
+        return (yield future)
+
+    io_loop = ioloop.IOLoop.current()
+    waiter = concurrent.Future()
+
+    def copy(done):
+        exc_info = done.exc_info()
+        if waiter.done():
+            return  # cancelled, result is dropped
+        elif exc_info is not None:
+            waiter.set_exc_info(exc_info)
+        else:
+            waiter.set_result(done.result())
+
+    def cancel():
+        if not waiter.done():
+            waiter.set_exception(RequestCancelled())
+            if on_cancel is not None:
+                on_cancel()
+
+    future.add_done_callback(copy)
+    handle = cancel_token.add_callback(
+        functools.partial(io_loop.add_callback, cancel))
+    try:
+        return (yield waiter)
+    finally:
+        cancel_token.remove_callback(handle)
+
+
+def _abort_fetch(client, request):
+    """Abort curl transfer of request, or remove request from client queue
+    if it has not started yet, releasing its curl handle. Request fails with
+    599 error.
+
+    Tornado client has no API for this, so its internals are used. If they
+    are not there, e.g. tornado version differs or client is not curl one,
+    transfer goes on and its result is discarded.
+
+    :param curl_httpclient.CurlAsyncHTTPClient client: client the request
+           was sent by.
+    :param httpclient.HTTPRequest request: HTTP request.
+
+    :return: whether request was found.
+    :rtype: bool
+    """
+
+    if not all(hasattr(client, name) for name in CURL_CLIENT_INTERNALS):
+        return False
+
+    for queued in client._requests:
+        proxy, callback = queued[:2]
+        if proxy.request is request:
+            client._requests.remove(queued)
+            callback(httpclient.HTTPResponse(
+                proxy, 599, error=httpclient.HTTPError(599, 'Cancelled'),
+                request_time=time.time() - proxy.start_time))
+            return True
+
+    for curl in client._curls:
+        info = getattr(curl, 'info', None)  # not set until handle is used
+        if info is not None and info['request'].request is request:
+            # Handle is removed from multi before its connection is reused,
+            # so the connection is closed.
+            client._finish(curl, pycurl.E_ABORTED_BY_CALLBACK, 'Cancelled')
+            client._process_queue()
+            return True
+
+    return False
+
+
+def _setup_curl_resolve(host, port, addresses, happy_eyeballs_delay, curl):
+    """Pre-populate curl DNS cache with resolved addresses. When several
+    addresses are given, curl races IPv6 and IPv4 connection attempts itself.
+
+    :param str host: host name.
+    :param int port: port number.
+    :param list[tuple] addresses: (family, sockaddr) tuples.
+    :param float happy_eyeballs_delay: delay before trying the other
+           address family.
+    :param pycurl.Curl curl: curl handle.
+    """
+
+    ips = ','.join('[%s]' % sockaddr[0] if ':' in sockaddr[0] else sockaddr[0]
+                   for _, sockaddr in addresses)
+    curl.setopt(pycurl.RESOLVE, ['%s:%d:%s' % (host, port, ips)])
+
+    if hasattr(pycurl, 'HAPPY_EYEBALLS_TIMEOUT_MS'):
+        curl.setopt(pycurl.HAPPY_EYEBALLS_TIMEOUT_MS,
+                    int(happy_eyeballs_delay * 1000))
+
+
+def _setup_curl_unix(socket_path, curl):
+    """Make curl connect to Unix domain socket.
+
+    :param str socket_path: socket path.
+    :param pycurl.Curl curl: curl handle.
+    """
+
+    curl.setopt(pycurl.UNIX_SOCKET_PATH, socket_path)
+
+
+def _reset_curl(curl):
+    """Reset options set by other setup callbacks, as tornado reuses curl
+    handles between requests.
+
+    :param pycurl.Curl curl: curl handle.
+    """
+
+    curl.setopt(pycurl.HTTP_CONTENT_DECODING, 1)
+    curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_NONE)
+    curl.unsetopt(pycurl.SHARE)
+    curl.setopt(pycurl.RESOLVE, [])
+    if hasattr(pycurl, 'PIPEWAIT'):
+        curl.setopt(pycurl.PIPEWAIT, 0)
+
+
+def _setup_curl_share(share, curl):
+    """Make curl handle share TLS session cache with other handles, so that
+    a connection opened by any of them resumes sessions of the others.
+
+    :param pycurl.CurlShare share: share handle.
+    :param pycurl.Curl curl: curl handle.
+    """
+
+    curl.setopt(pycurl.SHARE, share)
+
+
+def _disable_curl_decoding(curl):
+    """Make curl pass body as received, without decoding Content-Encoding.
+
+    :param pycurl.Curl curl: curl handle.
+    """
+
+    curl.setopt(pycurl.HTTP_CONTENT_DECODING, 0)
+
+
+def _setup_curl_http2(prior_knowledge, curl):
+    """Make curl negotiate HTTP/2 and wait for connection to be multiplexed
+    on rather than opening a new one.
+
+    :param bool prior_knowledge: whether to speak HTTP/2 right away, without
+           upgrade of plain HTTP connection.
+    :param pycurl.Curl curl: curl handle.
+    """
+
+    curl.setopt(pycurl.HTTP_VERSION,
+                pycurl.CURL_HTTP_VERSION_2_PRIOR_KNOWLEDGE if prior_knowledge
+                else pycurl.CURL_HTTP_VERSION_2_0)
+    curl.setopt(pycurl.PIPEWAIT, 1)
+
+
+def _curl_multi(client):
+    """Get curl multi handle of tornado client, which has no public
+    accessor for it.
+
+    :param curl_httpclient.CurlAsyncHTTPClient client: curl client.
+
+    :rtype: pycurl.CurlMulti
+    :raise: RuntimeError
+    """
+
+    multi = getattr(client, '_multi', None)
+    if not isinstance(multi, pycurl.CurlMulti):
+        raise RuntimeError('Could not get curl multi handle of %s, HTTP/2 '
+                           'is not supported with this tornado version.' %
+                           (type(client).__name__,))
+
+    return multi
+
+
+def _chain_curl_callbacks(*callbacks):
+    """Combine curl setup callbacks.
+
+    :param callbacks: pycurl.Curl -> None callables or None.
+
+    :rtype: pycurl.Curl -> None|None
+    """
+
+    callbacks = [cb for cb in callbacks if cb is not None]
+    if not callbacks:
+        return None
+
+    def prepare_curl(curl):
+        for callback in callbacks:
+            callback(curl)
+
+    return prepare_curl
+
+
+def _run_curl(client):
+    """Make curl client run its transfers right away. Tornado client does
+    not learn that transfer unpaused with curl_easy_pause() has more body
+    to send, nor does libcurl ask for the next block of body right away, so
+    transfer would only proceed on client's periodic timeout, once a second.
+
+    :param curl_httpclient.CurlAsyncHTTPClient client: curl client.
+    """
+
+    client.io_loop.add_callback(client._handle_force_timeout)
+
+
+def _setup_curl_body(method, stream, curl):
+    """Make curl read request body from the stream. Body of unknown size is
+    sent with chunked transfer encoding.
+
+    :param str method: request method.
+    :param body.StreamingBody|BodyProducer stream: request body.
+    :param pycurl.Curl curl: curl handle.
+    """
+
+    size = -1 if stream.size is None else stream.size
+    if method == 'POST':
+        curl.setopt(pycurl.POSTFIELDSIZE, size)
+    else:
+        curl.setopt(pycurl.UPLOAD, True)
+        curl.setopt(pycurl.INFILESIZE, size)
+        curl.setopt(pycurl.CUSTOMREQUEST, method)
+
+    if isinstance(stream, BodyProducer):
+        stream.attach(curl)
+
+    curl.setopt(pycurl.READFUNCTION, stream.read)
+
+
+def _rewind(data):
+    """Prepare request body to be sent again.
+
+    :param object data: request body.
+
+    :return: whether body can be sent again.
+    :rtype: bool
+    """
+
+    if isinstance(data, (body.StreamingBody, BodyProducer)):
+        return data.rewind()
+
+    return True
+
+
+def _async_iterable_producer(source):
+    """Make body producer writing blocks of async iterable. The iterable is
+    run by asyncio loop IOLoop is running on.
+
+    :param collections.AsyncIterable source: body source.
+
+    :return: body producer.
+    :rtype: callable
+    :raise: TypeError
+    """
+
+    asyncio_loop = getattr(ioloop.IOLoop.current(), 'asyncio_loop', None)
+    if asyncio_loop is None:
+        raise TypeError('Async iterable body requires IOLoop running on '
+                        'asyncio loop.')
+
+    @gen.coroutine
+    def produce(write):
+        iterator = source.__aiter__()
+        while True:
+            try:
+                block = yield tornado_asyncio.to_tornado_future(
+                    asyncio.ensure_future(iterator.__anext__(),
+                                          loop=asyncio_loop))
+            except StopAsyncIteration:
+                break
+
+            if isinstance(block, str):
+                block = block.encode()
+            yield write(block)
+
+    return produce
+
+
+class BodyProducer(object):
+
+    """Feed curl with request body generated by tornado-style body producer.
+
+    Curl transfer is paused while the producer has nothing to send, and
+    futures returned by write function are resolved once curl has consumed
+    the data written, so at most one block is buffered.
+
+    """
+
+    def __init__(self, producer):
+        """Constructor.
+
+        :param callable producer: callable which takes a write function and
+               returns Future resolved at the end of body.
+        """
+
+        self.size = None
+        # Called to make curl run the transfer, see _run_curl().
+        self.run_callback = None
+
+        self._producer = producer
+        self._buffer = bytearray()
+        self._curl = None
+        self._started = False
+        self._paused = False
+        self._done = False
+        self._error = None
+        self._drained = None
+        self._detached = False
+        self._io_loop = ioloop.IOLoop.current()
+
+    def attach(self, curl):
+        """Start producing body for the curl handle.
+
+        :param pycurl.Curl curl: curl handle.
+        """
+
+        self._curl = curl
+        self._started = True
+        self._detached = False
+        self._io_loop.add_callback(self._start)
+
+    def detach(self):
+        """Stop feeding curl handle once transfer is over, successful or
+        not. Pending and further writes fail with StreamClosedError, so that
+        producer ends if transfer was aborted.
+        """
+
+        self._curl = None
+        self._detached = True
+        if self._drained is not None:
+            self._drained.set_exception(iostream.StreamClosedError())
+            self._drained = None
+
+    def read(self, size):
+        """Curl READFUNCTION.
+
+        :param int size: maximum number of bytes to return.
+
+        :rtype: bytes|int
+        """
+
+        if self._buffer:
+            block = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            if not self._buffer and self._drained is not None:
+                self._io_loop.add_callback(self._drained.set_result, None)
+                self._drained = None
+            self._run()
+
+            return block
+
+        if self._error is not None:
+            return pycurl.READFUNC_ABORT
+
+        if self._done:
+            return b''
+
+        self._paused = True
+
+        return pycurl.READFUNC_PAUSE
+
+    def rewind(self):
+        """Producers can't be replayed once started.
+
+        :rtype: bool
+        """
+
+        return not self._started
+
+    def collect(self):
+        """Run producer to completion, collecting the whole body.
+
+        :rtype: bytes
+        """
+
+        self._started = True
+        chunks = []
+
+        def write(chunk):
+            chunks.append(chunk)
+            future = concurrent.Future()
+            future.set_result(None)
+            return future
+
+        yield gen.maybe_future(self._producer(write))
+
+        return b''.join(chunks)
+
+    def _start(self):
+
+        try:
+            future = gen.maybe_future(self._producer(self._write))
+        except Exception as err:
+            future = concurrent.Future()
+            future.set_exception(err)
+
+        self._io_loop.add_future(future, self._on_done)
+
+    def _write(self, chunk):
+
+        if self._detached:
+            future = concurrent.Future()
+            future.set_exception(iostream.StreamClosedError())
+            return future
+
+        self._buffer += chunk
+        self._unpause()
+
+        if self._drained is None:
+            self._drained = concurrent.Future()
+
+        return self._drained
+
+    def _on_done(self, future):
+
+        self._error = future.exception()
+        self._done = True
+        self._unpause()
+
+    def _unpause(self):
+
+        if self._paused and self._curl is not None:
+            self._paused = False
+            self._curl.pause(pycurl.PAUSE_CONT)
+            self._run()
+
+    def _run(self):
+
+        if self.run_callback is not None:
+            self.run_callback()
+
+
+class ResponseStream(object):
+
+    """Route streamed response of a single request attempt to the body
+    stream. Error response bodies are collected rather than streamed. If
+    the body stream raises, the transfer is aborted and the exception is
+    kept to be re-raised by the engine.
+
+    """
+
+    def __init__(self, body_stream):
+        """Constructor.
+
+        :param streaming.ResumableBodyStream body_stream: body stream.
+        """
+
+        self.code = None
+        self.headers = tornado_httputil.HTTPHeaders()
+        self.error = None
+        self.error_body = bytearray()
+
+        self._body_stream = body_stream
+        self._io_loop = ioloop.IOLoop.current()
+
+    def attach(self, curl):
+        """Make curl pass raw body to the stream. Curl write function, like
+        tornado's own, passes body blocks to IOLoop, but aborts the
+        transfer once an error occurred.
+
+        :param pycurl.Curl curl: curl handle.
+        """
+
+        _disable_curl_decoding(curl)
+        curl.setopt(pycurl.WRITEFUNCTION, self._write)
+
+    def on_header_line(self, line):
+        """Process response header line.
+
+        :param str line: header line.
+        """
+
+        if line.startswith('HTTP/'):
+            # Status line starts a new response, e.g. after redirect.
+            self.code = int(line.split(' ', 2)[1])
+            self.headers = tornado_httputil.HTTPHeaders()
+            self.error_body = bytearray()
+        elif line.strip():
+            self.headers.parse_line(line)
+        elif self.code is not None and 200 <= self.code < 300:
+            self._call(self._body_stream.on_headers, self.code, self.headers)
+
+    def on_chunk(self, chunk):
+        """Process response body block.
+
+        :param bytes chunk: body block.
+        """
+
+        if self.error is not None:
+            return
+
+        if self.code is None or self.code >= 300:
+            self.error_body += chunk
+            return
+
+        self._call(self._body_stream.on_chunk, chunk)
+
+    def finish(self):
+        """Complete successful transfer.
+
+        :raise: Exception
+        """
+
+        self.raise_error()
+        self._call(self._body_stream.finish)
+        self.raise_error()
+
+    def raise_error(self):
+        """Re-raise error occurred while processing the response.
+
+        :raise: Exception
+        """
+
+        if self.error is None:
+            return
+
+        if isinstance(self.error, (httputil.BodyStreamError, TypeError)):
+            raise MalformedResponse(self.error)
+
+        raise self.error
+
+    def _call(self, callback, *args):
+
+        try:
+            callback(*args)
+        except Exception as err:
+            self.error = err
+
+    def _write(self, chunk):
+
+        if self.error is not None:
+            return 0  # abort transfer
+
+        self._io_loop.add_callback(self.on_chunk, chunk)
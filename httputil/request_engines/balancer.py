@@ -0,0 +1,202 @@
+"""Client-side load balancing across multiple API base URLs."""
+
+__author__ = 'vovanec@gmail.com'
+
+import itertools
+import random
+import threading
+import time
+
+
+DEF_EJECT_AFTER = 3
+DEF_EJECT_FOR = 30
+DEF_EWMA_DECAY = 10.0
+
+
+class Endpoint(object):
+
+    """API endpoint state."""
+
+    __slots__ = ('base_url', 'outstanding', 'ewma', 'last_update',
+                 'failures', 'ejected_until')
+
+    def __init__(self, base_url):
+        """Constructor.
+
+        :param str base_url: endpoint base URL.
+        """
+
+        self.base_url = base_url
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.last_update = None
+        self.failures = 0
+        self.ejected_until = 0
+
+    def __repr__(self):
+
+        return '<Endpoint %s>' % (self.base_url,)
+
+
+class BaseBalancer(object):
+
+    """Base class for load balancers.
+
+    Endpoints which fail to connect ``eject_after`` times in a row are
+    ejected from rotation for ``eject_for`` seconds. If all endpoints are
+    ejected, the balancer falls back to using all of them.
+
+    """
+
+    def __init__(self, base_urls, eject_after=DEF_EJECT_AFTER,
+                 eject_for=DEF_EJECT_FOR, ewma_decay=DEF_EWMA_DECAY):
+        """Constructor.
+
+        :param list[str] base_urls: endpoint base URLs.
+        :param int eject_after: number of consecutive connection failures
+               after which endpoint is ejected.
+        :param int|float eject_for: time to keep endpoint ejected.
+        :param float ewma_decay: latency EWMA decay time.
+        """
+
+        if not base_urls:
+            raise ValueError('At least one base URL is required.')
+
+        self.endpoints = [Endpoint(url) for url in base_urls]
+
+        self._eject_after = eject_after
+        self._eject_for = eject_for
+        self._ewma_decay = ewma_decay
+        self._lock = threading.Lock()
+
+    def select(self, exclude=()):
+        """Select endpoint for the next request and mark it busy. Caller must
+        call finish() once request is complete.
+
+        :param collections.Container[Endpoint] exclude: endpoints to avoid
+               if possible, e.g. those already tried for this request.
+
+        :rtype: Endpoint
+        """
+
+        with self._lock:
+            endpoint = self._choose(self._candidates(exclude))
+            endpoint.outstanding += 1
+
+        return endpoint
+
+    def finish(self, endpoint, latency=None, failed=False):
+        """Record request completion.
+
+        :param Endpoint endpoint: endpoint which served the request.
+        :param float|None latency: request latency, None if request outcome
+               is unknown, e.g. it was cancelled.
+        :param bool failed: whether endpoint failed to connect.
+        """
+
+        now = self._time()
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.failures += 1
+                if endpoint.failures >= self._eject_after:
+                    endpoint.ejected_until = now + self._eject_for
+                    endpoint.failures = 0
+                return
+
+            if latency is None:
+                return
+
+            endpoint.failures = 0
+            self._update_ewma(endpoint, latency, now)
+
+    def has_alternative(self, exclude):
+        """Check if there are healthy endpoints not in exclude.
+
+        :param collections.Container[Endpoint] exclude: endpoints to skip.
+
+        :rtype: bool
+        """
+
+        now = self._time()
+        with self._lock:
+            return any(e not in exclude and e.ejected_until <= now
+                       for e in self.endpoints)
+
+    def _candidates(self, exclude):
+
+        now = self._time()
+        healthy = [e for e in self.endpoints if e.ejected_until <= now]
+
+        return ([e for e in healthy if e not in exclude] or healthy or
+                self.endpoints)
+
+    def _choose(self, candidates):
+        """Choose endpoint from non-empty list of candidates. Subclasses must
+        implement this.
+
+        :param list[Endpoint] candidates: candidate endpoints.
+
+        :rtype: Endpoint
+        """
+
+        raise NotImplementedError
+
+    def _update_ewma(self, endpoint, latency, now):
+
+        if endpoint.last_update is None:
+            endpoint.ewma = latency
+        else:
+            elapsed = max(now - endpoint.last_update, 0)
+            weight = 2 ** (-elapsed / self._ewma_decay)
+            endpoint.ewma = endpoint.ewma * weight + latency * (1 - weight)
+
+        endpoint.last_update = now
+
+    @staticmethod
+    def _time():
+
+        return time.monotonic()
+
+
+class RoundRobinBalancer(BaseBalancer):
+
+    """Pick endpoints in turn."""
+
+    def __init__(self, base_urls, **kwargs):
+
+        super().__init__(base_urls, **kwargs)
+        self._counter = itertools.count()
+
+    def _choose(self, candidates):
+
+        return candidates[next(self._counter) % len(candidates)]
+
+
+class LeastOutstandingBalancer(BaseBalancer):
+
+    """Pick endpoint with the least number of requests in flight."""
+
+    def _choose(self, candidates):
+
+        return min(candidates, key=lambda e: e.outstanding)
+
+
+class PowerOfTwoChoicesBalancer(BaseBalancer):
+
+    """Pick two random endpoints and use the one with the lower latency
+    EWMA, weighted by the number of requests in flight.
+
+    """
+
+    def _choose(self, candidates):
+
+        if len(candidates) == 1:
+            return candidates[0]
+
+        return min(random.sample(candidates, 2), key=self._cost)
+
+    @staticmethod
+    def _cost(endpoint):
+
+        return endpoint.ewma * (endpoint.outstanding + 1)
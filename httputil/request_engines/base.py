@@ -3,9 +3,21 @@
 __author__ = 'vovanec@gmail.com'
 
 import logging
+import os
+import urllib.parse
+
+from . import balancer as balancers
+from . import download as downloads
+from . import response as responses
+from . import tls
+from . import transport
 
 
 SLASH = '/'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Responses showing upstream is overloaded, for adaptive concurrency limit.
+OVERLOAD_CODES = frozenset([503, 504, 599])
 
 
 class BaseRequestEngine(object):
@@ -15,10 +27,13 @@ class BaseRequestEngine(object):
     def __init__(self, api_base_url, connect_timeout, request_timeout,
                  conn_retries, username=None, password=None,
                  client_cert=None, client_key=None, verify_cert=True,
-                 ca_certs=None):
+                 ca_certs=None, resolver=None, pre_resolve=False,
+                 balancer=None, rate_limiter=None, memory_handler=None,
+                 cert_watch_interval=None, concurrency_limit=None):
         """Constructor.
 
-        :param str api_base_url: API base URL.
+        :param str|list[str] api_base_url: API base URL or list of
+               base URLs of API replicas to balance requests between.
         :param int connect_timeout: connection timeout.
         :param int request_timeout: request timeout.
         :param int|None conn_retries: The number of retries on connection
@@ -29,11 +44,35 @@ class BaseRequestEngine(object):
         :param str|None client_key: client key.
         :param bool verify_cert: whether to verify server cert.
         :param str|None ca_certs: path to CA certificate chain.
+        :param dns.CachingResolver|None resolver: resolver to cache host
+               name lookups with. If None - hosts are resolved by the
+               underlying HTTP client on every new connection.
+        :param bool pre_resolve: whether to resolve API base URL host
+               at construction time.
+        :param type|None balancer: balancer class or factory which takes
+               the list of base URLs, by default balancer.RoundRobinBalancer.
+        :param ratelimit.RateLimiter|None rate_limiter: request rate
+               limiter. If None - requests are not paced.
+        :param callable|None memory_handler: handler serving requests to
+               memory:// base URLs in process, see
+               transport.MemoryTransport.
+        :param int|float|None cert_watch_interval: if set, certificate
+               files are checked for changes at most once per this number
+               of seconds and reloaded if changed.
+        :param limits.AdaptiveLimit|None concurrency_limit: if set, the
+               number of requests in flight is limited, and the limit
+               follows upstream latency and overload responses.
+
+        :raise: ValueError
         """
 
         self._connect_timeout = connect_timeout
         self._request_timeout = request_timeout
-        self._api_base_url = api_base_url.rstrip(SLASH)
+        if isinstance(api_base_url, str):
+            api_base_url = [api_base_url]
+        base_urls = [url.rstrip(SLASH) for url in api_base_url]
+        self._api_base_url = base_urls[0]
+        self._balancer = (balancer or balancers.RoundRobinBalancer)(base_urls)
         self._username = username
         self._password = password
         self._conn_retries = conn_retries
@@ -41,53 +80,289 @@ class BaseRequestEngine(object):
         self._client_key = client_key
         self._ca_certs = ca_certs
         self._verify_cert = verify_cert
+        self._resolver = resolver
+        self._rate_limiter = rate_limiter
+        self._concurrency_limit = concurrency_limit
+
+        self._cert_watcher = None
+        if cert_watch_interval is not None:
+            self._cert_watcher = tls.CertWatcher(
+                [client_cert, client_key, ca_certs], cert_watch_interval)
+
+        self._memory_transport = None
+        if memory_handler is not None:
+            self._memory_transport = transport.MemoryTransport(memory_handler)
+        elif any(transport.scheme(url) == transport.MEMORY_SCHEME
+                 for url in base_urls):
+            raise ValueError('memory:// base URL requires memory_handler.')
 
         self._log = logging.getLogger(self.__class__.__name__)
+        self._pid = os.getpid()
+
+        if resolver is not None and pre_resolve:
+            self._pre_resolve()
 
     def request(self, url, *,
-                method='GET', headers=None, data=None, result_callback=None):
+                method='GET', headers=None, data=None, result_callback=None,
+                streaming_callback=None, header_callback=None,
+                return_response=False, priority=None, cancel_token=None):
         """Perform request.
 
         :param str url: request URL.
         :param str method: request method.
         :param dict headers: request headers.
-        :param object data: request data.
+        :param object data: request data. File objects and iterators of
+               bytes are streamed rather than read into memory.
         :param object -> object result_callback: result callback.
+        :param bytes -> None streaming_callback: if set, response body is
+               passed to it in blocks as they arrive instead of being
+               returned. Request is not retried once a block was passed.
+        :param (int, collections.Mapping) -> None header_callback: called
+               with HTTP code and headers of successful response before
+               its body is processed.
+        :param bool return_response: whether to return response.Response
+               rather than body. Result callback is not applied then.
+        :param str|None priority: priority class or tenant name, used by
+               engines which schedule requests, see scheduler.FairScheduler.
+        :param cancel.CancelToken|None cancel_token: token to cancel the
+               request with.
 
-        :rtype: dict
-        :raise: APIError
+        :rtype: dict|response.Response
+        :raise: APIError, ValueError
         """
 
-        url = self._make_full_url(url)
+        if return_response and streaming_callback is not None:
+            raise ValueError('return_response and streaming_callback are '
+                             'mutually exclusive.')
+
+        self._check_fork()
+
+        if self._cert_watcher is not None and self._cert_watcher.changed():
+            self._log.info('Certificate files changed, reloading.')
+            self.reload_certs()
 
         self._log.debug('Performing %s request to %s', method, url)
         return self._request(url, method=method, headers=headers, data=data,
-                             result_callback=result_callback)
+                             result_callback=result_callback,
+                             streaming_callback=streaming_callback,
+                             header_callback=header_callback,
+                             return_response=return_response,
+                             priority=priority, cancel_token=cancel_token)
+
+    @property
+    def concurrency_limit(self):
+        """Current adaptive concurrency limit, None if requests are not
+        limited.
+
+        :rtype: int|None
+        """
+
+        if self._concurrency_limit is None:
+            return None
+
+        return self._concurrency_limit.limit
 
     def _request(self, url, *,
-                 method='GET', headers=None, data=None, result_callback=None):
+                 method='GET', headers=None, data=None, result_callback=None,
+                 streaming_callback=None, header_callback=None,
+                 return_response=False, priority=None, cancel_token=None):
         """Perform request. Subclasses must implement this.
 
-        :param str url: request URL.
+        :param str url: request URL relative to API base URL.
         :param str method: request method.
         :param dict headers: request headers.
         :param object data: request data.
         :param object -> object result_callback: result callback.
+        :param bytes -> None streaming_callback: if set, response body is
+               passed to it in blocks as they arrive instead of being
+               returned. Request is not retried once a block was passed.
+        :param (int, collections.Mapping) -> None header_callback: called
+               with HTTP code and headers of successful response before
+               its body is processed.
+        :param bool return_response: whether to return response.Response
+               rather than body.
+        :param str|None priority: priority class name.
+        :param cancel.CancelToken|None cancel_token: cancellation token.
 
-        :rtype: dict
-        :raise: APIError
+        :rtype: dict|response.Response
+        :raise: APIError, RequestCancelled
+
+        """
+
+        raise NotImplementedError
+
+    def warm_up(self, n_connections=1):
+        """Open connections to every API endpoint in background and keep
+        them alive, so that first requests don't pay connection and TLS
+        handshake latency. Subclasses must implement this.
+
+        :param int n_connections: the number of connections per endpoint.
+
+        :return: future resolved with the number of connections opened.
+        :rtype: concurrent.futures.Future|tornado.concurrent.Future
+        """
+
+        raise NotImplementedError
+
+    def reload_certs(self):
+        """Reload client certificate, key and CA certificates from files.
+        New connections use the reloaded certificates. Subclasses must
+        implement this.
 
+        :raise: OSError, ssl.SSLError
         """
 
         raise NotImplementedError
 
-    def _make_full_url(self, url):
+    def download(self, url, dest, *, segments=downloads.DEF_SEGMENTS,
+                 segment_size=None, headers=None):
+        """Download content into file. If server supports byte ranges,
+        content is fetched in segments concurrently, each segment written
+        straight into its place in the preallocated file. Otherwise content
+        is downloaded in a single stream. Subclasses must implement this.
+
+        :param str url: request URL.
+        :param str dest: destination file path.
+        :param int segments: the number of segments to download in parallel.
+        :param int|None segment_size: segment size, takes precedence over the
+               number of segments.
+        :param dict headers: request headers.
+
+        :return: the number of bytes downloaded.
+        :rtype: int
+        :raise: APIError
+        """
+
+        raise NotImplementedError
+
+    def _download_headers(self, headers, start=None, end=None,
+                          validator=None):
+        """Make download request headers.
+
+        :param dict|None headers: request headers.
+        :param int|None start: first byte position, if None - whole content.
+        :param int|None end: last byte position.
+        :param str|None validator: ETag or Last-Modified date of content
+               the range is to be taken from.
+
+        :rtype: dict
+        """
+
+        # Ranges apply to encoded content, so ask for identity encoding.
+        headers = dict(headers or {}, **{'Accept-Encoding': 'identity'})
+        if start is not None:
+            headers['Range'] = downloads.range_header(start, end)
+            if validator is not None:
+                headers['If-Range'] = validator
+
+        return headers
+
+    def _check_fork(self):
+        """Drop state inherited from parent process if the engine is used in
+        a forked child for the first time.
+        """
+
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._log.debug('Process forked, resetting connections.')
+            self._after_fork()
+
+    def _after_fork(self):
+        """Drop process-bound state: connection pools, HTTP clients and
+        thread pools. They are rebuilt on demand. Subclasses which have such
+        state must override this.
+        """
+
+    def _warm_up_urls(self):
+        """Get base URLs of endpoints to open connections to.
+
+        :rtype: list[str]
+        """
+
+        return [endpoint.base_url for endpoint in self._balancer.endpoints
+                if transport.scheme(endpoint.base_url) !=
+                transport.MEMORY_SCHEME]
+
+    def _pre_resolve(self):
+        """Warm up resolver cache with API base URL host."""
+
+        for endpoint in self._balancer.endpoints:
+            if not transport.is_tcp(endpoint.base_url):
+                continue
+
+            host, port = host_and_port(endpoint.base_url)
+            try:
+                self._resolver.resolve(host, port)
+            except OSError as err:
+                self._log.warning('Could not resolve %s: %s', host, err)
+
+    def _rate_limit_delay(self, url):
+        """Reserve request slot with the rate limiter.
+
+        :param str url: request URL relative to API base URL.
+
+        :return: time in seconds to wait before sending the request.
+        :rtype: float
+        """
+
+        if self._rate_limiter is None:
+            return 0
+
+        return self._rate_limiter.reserve(url)
+
+    def _update_rate_limit(self, url, status_code, headers):
+        """Let the rate limiter adapt to server response.
+
+        :param str url: request URL relative to API base URL.
+        :param int status_code: response HTTP code.
+        :param collections.Mapping|response.Response|None headers: response
+               headers, or response to take them from if needed.
+        """
+
+        if self._rate_limiter is not None:
+            if isinstance(headers, responses.Response):
+                headers = headers.headers
+            self._rate_limiter.update(url, status_code, headers)
+
+    def _retry_in(self, retries_left, tried):
+        """Calculate delay before the next attempt after connection error.
+        There is no delay if there is an endpoint not tried yet.
+
+        :param int retries_left: the number of retries left.
+        :param set[balancer.Endpoint] tried: endpoints already tried.
+
+        :rtype: int
+        """
+
+        if self._balancer.has_alternative(tried):
+            return 0
+
+        return (self._conn_retries - retries_left) * 2
+
+    def _make_full_url(self, url, base_url=None):
         """Given base and relative URL, construct the full URL.
 
         :param str url: relative URL.
+        :param str|None base_url: base URL, by default the first API
+               base URL.
 
         :return: full URL.
         :rtype: str
         """
 
-        return SLASH.join([self._api_base_url, url.lstrip(SLASH)])
+        return SLASH.join([base_url or self._api_base_url, url.lstrip(SLASH)])
+
+
+def host_and_port(url):
+    """Extract host and port from URL.
+
+    :param str url: absolute URL.
+
+    :rtype: tuple[str, int]
+    """
+
+    parsed = urllib.parse.urlsplit(url)
+    port = parsed.port or DEFAULT_PORTS.get(parsed.scheme, 80)
+
+    return parsed.hostname, port
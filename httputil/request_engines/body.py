@@ -0,0 +1,149 @@
+"""Streaming request bodies."""
+
+__author__ = 'vovanec@gmail.com'
+
+import io
+import os
+
+from ..httputil import CHUNK_SIZE
+
+
+def is_streaming(data):
+    """Check if request data is to be streamed rather than sent at once.
+
+    :param object data: request data.
+
+    :rtype: bool
+    """
+
+    if data is None or isinstance(data, (bytes, bytearray, str, dict, list,
+                                         tuple)):
+        return False
+
+    return hasattr(data, 'read') or hasattr(data, '__next__')
+
+
+def is_async_iterable(data):
+    """Check if request data is an async iterable of bytes, which async
+    engine streams.
+
+    :param object data: request data.
+
+    :rtype: bool
+    """
+
+    return hasattr(data, '__aiter__')
+
+
+def body_size(source):
+    """Get the number of bytes left in the body source, if known.
+
+    :param file|collections.Iterator[bytes] source: body source.
+
+    :rtype: int|None
+    """
+
+    if not hasattr(source, 'read'):
+        return None
+
+    try:
+        return os.fstat(source.fileno()).st_size - source.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+
+    try:
+        position = source.tell()
+        size = source.seek(0, io.SEEK_END) - position
+        source.seek(position)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+    return size
+
+
+class StreamingBody(object):
+
+    """Request body read from a file object or an iterator of bytes.
+
+    Only one block of data is kept in memory at a time. File bodies are
+    rewound to their initial position on retry, iterator bodies can't be
+    replayed.
+
+    """
+
+    def __init__(self, source):
+        """Constructor.
+
+        :param file|collections.Iterator[bytes] source: body source.
+        """
+
+        self.source = source
+        self.size = body_size(source)
+
+        self._start = None
+        self._pending = b''
+        self._started = False
+
+        if hasattr(source, 'read'):
+            try:
+                self._start = source.tell()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                pass
+
+    @property
+    def seekable(self):
+        """Whether body is a file which can be rewound."""
+
+        return self._start is not None
+
+    def __iter__(self):
+
+        while True:
+            block = self.read()
+            if not block:
+                break
+
+            yield block
+
+    def read(self, size=CHUNK_SIZE):
+        """Read up to size bytes of body.
+
+        :param int size: maximum number of bytes to return.
+
+        :return: data block, empty at the end of body.
+        :rtype: bytes
+        """
+
+        self._started = True
+
+        if hasattr(self.source, 'read'):
+            return self.source.read(size)
+
+        while not self._pending:
+            try:
+                self._pending = next(self.source)
+            except StopIteration:
+                return b''
+
+            if isinstance(self._pending, str):
+                self._pending = self._pending.encode()
+
+        block, self._pending = self._pending[:size], self._pending[size:]
+
+        return block
+
+    def rewind(self):
+        """Prepare body to be sent again.
+
+        :return: whether body can be sent again.
+        :rtype: bool
+        """
+
+        if self._start is not None:
+            try:
+                self.source.seek(self._start)
+                return True
+            except (OSError, io.UnsupportedOperation):
+                return False
+
+        return not self._started
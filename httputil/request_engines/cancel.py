@@ -0,0 +1,95 @@
+"""Request cancellation."""
+
+__author__ = 'vovanec@gmail.com'
+
+import itertools
+import threading
+
+from .errors import RequestCancelled
+
+
+class CancelToken(object):
+
+    """Cancellation signal shared by caller and its requests. Once token is
+    cancelled, transfers of requests made with it are aborted, queued
+    requests leave the queue, retry loops stop, and requests raise
+    RequestCancelled. Token may be cancelled from any thread.
+
+    """
+
+    def __init__(self):
+
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._handles = itertools.count()
+
+    @property
+    def cancelled(self):
+        """Whether token is cancelled.
+
+        :rtype: bool
+        """
+
+        return self._event.is_set()
+
+    def cancel(self):
+        """Cancel requests. Cancelling token twice has no effect."""
+
+        with self._lock:
+            if self._event.is_set():
+                return
+
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """Add callback to be called on cancellation, in the thread calling
+        cancel(). It is called right away if token is already cancelled.
+
+        :param () -> None callback: callback.
+
+        :return: handle to remove callback with, None if already called.
+        :rtype: int|None
+        """
+
+        with self._lock:
+            if not self._event.is_set():
+                handle = next(self._handles)
+                self._callbacks[handle] = callback
+                return handle
+
+        callback()
+
+    def remove_callback(self, handle):
+        """Remove callback.
+
+        :param int|None handle: handle returned by add_callback().
+        """
+
+        with self._lock:
+            self._callbacks.pop(handle, None)
+
+    def check(self):
+        """Raise RequestCancelled if token is cancelled.
+
+        :raise: RequestCancelled
+        """
+
+        if self._event.is_set():
+            raise RequestCancelled()
+
+    def sleep(self, seconds):
+        """Sleep unless token is cancelled meanwhile.
+
+        :param int|float seconds: time to sleep.
+
+        :raise: RequestCancelled
+        """
+
+        if self._event.wait(seconds):
+            raise RequestCancelled()
@@ -0,0 +1,239 @@
+"""DNS resolution cache and happy eyeballs connection racing."""
+
+__author__ = 'vovanec@gmail.com'
+
+import errno
+import itertools
+import os
+import selectors
+import socket
+import threading
+import time
+
+
+DEF_TTL = 60
+DEF_NEGATIVE_TTL = 5
+DEF_HAPPY_EYEBALLS_DELAY = 0.25
+
+
+class CachingResolver(object):
+
+    """Resolve host names caching the results.
+
+    Successful lookups are cached for ``ttl`` seconds, failed lookups are
+    cached for ``negative_ttl`` seconds. The resolver is thread-safe and may
+    be shared between engines.
+
+    """
+
+    def __init__(self, ttl=DEF_TTL, negative_ttl=DEF_NEGATIVE_TTL,
+                 family=socket.AF_UNSPEC,
+                 happy_eyeballs_delay=DEF_HAPPY_EYEBALLS_DELAY):
+        """Constructor.
+
+        :param int|float ttl: time to keep successful lookups.
+        :param int|float negative_ttl: time to keep failed lookups.
+        :param int family: address family to resolve, by default both
+               IPv4 and IPv6.
+        :param float happy_eyeballs_delay: delay before starting connection
+               attempt to the next address.
+        """
+
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.family = family
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Resolve host name.
+
+        :param str host: host name.
+        :param int port: port number.
+
+        :return: list of (family, sockaddr) tuples, address families
+                 interleaved so that connection attempts alternate
+                 between IPv6 and IPv4.
+        :rtype: list[tuple]
+        :raise: socket.gaierror
+        """
+
+        key = (host, port)
+        now = self._time()
+
+        with self._lock:
+            entry = self._cache.get(key)
+
+        if entry is not None:
+            expires_at, addresses, error = entry
+            if expires_at > now:
+                if error is not None:
+                    raise error
+                return addresses
+
+        try:
+            addresses = interleave_families(
+                (family, sockaddr) for family, _, _, _, sockaddr in
+                self._getaddrinfo(host, port, self.family, socket.SOCK_STREAM))
+        except socket.gaierror as err:
+            with self._lock:
+                self._cache[key] = (now + self.negative_ttl, None, err)
+            raise
+
+        with self._lock:
+            self._cache[key] = (now + self.ttl, addresses, None)
+
+        return addresses
+
+    def cached(self, host, port):
+        """Return cached addresses if there is a fresh positive entry.
+
+        :param str host: host name.
+        :param int port: port number.
+
+        :rtype: list[tuple]|None
+        """
+
+        with self._lock:
+            entry = self._cache.get((host, port))
+
+        if entry is not None:
+            expires_at, addresses, _ = entry
+            if expires_at > self._time():
+                return addresses
+
+    def invalidate(self, host=None):
+        """Drop cached entries.
+
+        :param str|None host: host name to drop, if None - drop everything.
+        """
+
+        with self._lock:
+            if host is None:
+                self._cache.clear()
+            else:
+                for key in [k for k in self._cache if k[0] == host]:
+                    del self._cache[key]
+
+    @staticmethod
+    def _getaddrinfo(host, port, family, sock_type):
+
+        return socket.getaddrinfo(host, port, family, sock_type)
+
+    @staticmethod
+    def _time():
+
+        return time.monotonic()
+
+
+def interleave_families(addresses):
+    """Order addresses alternating the address families, as recommended by
+    RFC 8305. The family of the first address goes first.
+
+    :param collections.Iterable[tuple] addresses: (family, sockaddr) tuples.
+
+    :rtype: list[tuple]
+    """
+
+    by_family = {}
+    for address in addresses:
+        if address not in by_family.setdefault(address[0], []):
+            by_family[address[0]].append(address)
+
+    return [address for group in
+            itertools.zip_longest(*by_family.values())
+            for address in group if address is not None]
+
+
+def create_connection(resolver, address, timeout=None, source_address=None,
+                      socket_options=None):
+    """Connect to address racing connection attempts to resolved addresses.
+
+    The next connection attempt is started each time the resolver's happy
+    eyeballs delay expires without a connection being established, the
+    first successful connection wins.
+
+    :param CachingResolver resolver: resolver to use.
+    :param tuple address: (host, port) tuple.
+    :param float|None timeout: connection timeout.
+    :param tuple|None source_address: source address to bind to.
+    :param list|None socket_options: list of (level, option, value) tuples.
+
+    :rtype: socket.socket
+    :raise: OSError, socket.timeout
+    """
+
+    host, port = address
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+
+    addresses = list(resolver.resolve(host, port))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    last_error = None
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            while addresses or selector.get_map():
+                if addresses:
+                    family, sockaddr = addresses.pop(0)
+                    try:
+                        sock = _start_connect(family, sockaddr, source_address,
+                                              socket_options)
+                    except OSError as err:
+                        last_error = err
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE)
+
+                wait = None if deadline is None else \
+                    max(0, deadline - time.monotonic())
+                if addresses:
+                    wait = resolver.happy_eyeballs_delay if wait is None \
+                        else min(wait, resolver.happy_eyeballs_delay)
+
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err:
+                        last_error = OSError(err, 'Connection to %s failed' %
+                                             (host,))
+                        sock.close()
+                        continue
+
+                    sock.settimeout(timeout)
+                    return sock
+
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise socket.timeout('Connection to %s timed out' %
+                                         (host,))
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+
+    raise last_error or OSError('Could not connect to %s' % (host,))
+
+
+def _start_connect(family, sockaddr, source_address, socket_options):
+    """Create non-blocking socket and start connecting it.
+
+    :rtype: socket.socket
+    :raise: OSError
+    """
+
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        for opt in socket_options or ():
+            sock.setsockopt(*opt)
+        if source_address:
+            sock.bind(source_address)
+        sock.setblocking(False)
+        rc = sock.connect_ex(sockaddr)
+        if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(rc, os.strerror(rc))
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
@@ -0,0 +1,227 @@
+"""Helpers for segmented downloads with HTTP Range requests."""
+
+__author__ = 'vovanec@gmail.com'
+
+import http.client
+import os
+import re
+import threading
+
+from concurrent import futures
+
+from .errors import ContentChangedError
+from .errors import RangeError
+
+
+DEF_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def range_header(start, end=None):
+    """Make Range header value.
+
+    :param int start: first byte position.
+    :param int|None end: last byte position, inclusive. If None - till the
+           end of content.
+
+    :rtype: str
+    """
+
+    return 'bytes=%d-%s' % (start, '' if end is None else end)
+
+
+def parse_content_range(value):
+    """Parse Content-Range header value.
+
+    :param str|None value: header value.
+
+    :return: (first byte, last byte, total size or None) tuple or None if
+             could not parse.
+    :rtype: tuple|None
+    """
+
+    match = CONTENT_RANGE_RE.match((value or '').strip())
+    if match is None:
+        return None
+
+    start, end, total = match.groups()
+
+    return int(start), int(end), None if total == '*' else int(total)
+
+
+def probe_ranges(headers):
+    """Find out content size and range support from response headers.
+
+    :param collections.Mapping headers: response headers.
+
+    :return: (content size or None, whether server supports ranges) tuple.
+    :rtype: tuple
+    """
+
+    try:
+        size = int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        size = None
+
+    accepts_ranges = headers.get('Accept-Ranges', '').strip().lower() == \
+        'bytes'
+
+    return size, accepts_ranges
+
+
+def check_range_response(start, code, headers):
+    """Check that server responded with the requested range.
+
+    :param int start: requested first byte position.
+    :param int code: response HTTP code.
+    :param collections.Mapping headers: response headers.
+
+    :raise: RangeError
+    """
+
+    if code == http.client.OK:
+        # Range is validated by If-Range, so content has changed.
+        raise ContentChangedError('Expected HTTP %d for range request, got '
+                                  'the whole content' %
+                                  (http.client.PARTIAL_CONTENT,))
+
+    if code != http.client.PARTIAL_CONTENT:
+        raise RangeError('Expected HTTP %d for range request, got %d' %
+                         (http.client.PARTIAL_CONTENT, code))
+
+    content_range = parse_content_range(headers.get('Content-Range'))
+    if content_range is None or content_range[0] != start:
+        raise RangeError('Unexpected Content-Range: %s' %
+                         (headers.get('Content-Range'),))
+
+
+def plan_segments(size, segments=DEF_SEGMENTS, segment_size=None):
+    """Split content into byte ranges.
+
+    :param int size: content size.
+    :param int segments: the number of segments.
+    :param int|None segment_size: segment size, takes precedence over the
+           number of segments.
+
+    :return: list of (first byte, last byte) tuples.
+    :rtype: list[tuple]
+    """
+
+    if segment_size is None:
+        segment_size = max(MIN_SEGMENT_SIZE, -(-size // max(segments, 1)))
+
+    return [(start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)]
+
+
+def preallocate(path, size):
+    """Create file of the given size.
+
+    :param str path: file path.
+    :param int size: file size.
+    """
+
+    with open(path, 'wb') as fh:
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fh.fileno(), 0, size)
+                return
+            except OSError:
+                pass  # not supported by file system
+
+        fh.truncate(size)
+
+
+class FileWriter(object):
+
+    """Write data blocks into file at increasing offsets. Writers for
+    different regions of the same file may be used concurrently.
+
+    """
+
+    # Serializes seek() + write() where os.pwrite() is not available.
+    _seek_lock = threading.Lock()
+
+    def __init__(self, fh, offset=0):
+        """Constructor.
+
+        :param file fh: file opened for writing.
+        :param int offset: offset to start writing at.
+        """
+
+        self.position = offset
+
+        self._fh = fh
+
+    def write(self, block):
+        """Write block at current position.
+
+        :param bytes block: data block.
+        """
+
+        if hasattr(os, 'pwrite'):
+            view = memoryview(block)
+            while view:
+                written = os.pwrite(self._fh.fileno(), view, self.position)
+                self.position += written
+                view = view[written:]
+        else:
+            with self._seek_lock:
+                self._fh.seek(self.position)
+                self._fh.write(block)
+                self._fh.flush()
+            self.position += len(block)
+
+
+class BackgroundWriter(object):
+
+    """Write data blocks with FileWriter in executor, so that the caller
+    does not block on disk. Executor must have a single worker, so that
+    blocks are written in order.
+
+    """
+
+    def __init__(self, writer, executor):
+        """Constructor.
+
+        :param FileWriter writer: file writer.
+        :param concurrent.futures.Executor executor: single worker executor.
+        """
+
+        self._writer = writer
+        self._executor = executor
+        self._last = futures.Future()
+        self._last.set_result(None)
+
+    @property
+    def position(self):
+        """Position after the last block written, call flush() first to
+        account for the pending blocks.
+
+        :rtype: int
+        """
+
+        return self._writer.position
+
+    def write(self, block):
+        """Schedule block write.
+
+        :param bytes block: data block.
+        """
+
+        self._last = self._executor.submit(self._write, self._last, block)
+
+    def flush(self):
+        """Get future resolved once the blocks scheduled so far are written.
+
+        :rtype: concurrent.futures.Future
+        """
+
+        return self._last
+
+    def _write(self, previous, block):
+
+        previous.result()  # stop at the first error
+        self._writer.write(block)
@@ -20,6 +20,16 @@ class MalformedResponse(RequestError):
     """Server responded with data which client could not understand."""
 
 
+class RangeError(RequestError):
+
+    """Server did not respond with the requested byte range."""
+
+
+class ContentChangedError(RangeError):
+
+    """Content changed while it was being downloaded in parts."""
+
+
 class HTTPError(RequestError):
 
     """Server returned HTTP error."""
@@ -35,7 +45,8 @@ class HTTPError(RequestError):
         self.body = response_body
 
         super().__init__('HTTP %d: %s' % (
-            self.code, self.body or http.client.responses.get(code, 'Unknown')))
+            self.code,
+            self.body or http.client.responses.get(code, 'Unknown')))
 
 
 class ClientError(HTTPError):
@@ -46,3 +57,15 @@ class ClientError(HTTPError):
 class ServerError(HTTPError):
 
     """Server side error."""
+
+
+class QueueFullError(RequestError):
+
+    """Request could not be queued: too many requests are waiting to be
+    sent.
+    """
+
+
+class RequestCancelled(RequestError):
+
+    """Request was cancelled by caller."""
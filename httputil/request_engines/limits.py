@@ -0,0 +1,250 @@
+"""Adaptive concurrency limits, following upstream capacity by observed
+latency and load shedding, in the spirit of TCP congestion control.
+"""
+
+__author__ = 'vovanec@gmail.com'
+
+import math
+import threading
+import time
+
+
+DEF_INITIAL_LIMIT = 20
+DEF_MIN_LIMIT = 1
+DEF_MAX_LIMIT = 200
+
+# Number of samples the baseline latency average is taken over.
+DEF_BASELINE_WINDOW = 500
+
+
+class AdaptiveLimit(object):
+
+    """Base adaptive limit of requests in flight. Engine reports latency
+    of every request, and whether it was dropped by upstream, and the limit
+    is recalculated from these samples. Subclasses implement _update().
+
+    Baseline latency is a long-term moving average of latency samples.
+    Limit is thread-safe.
+
+    """
+
+    def __init__(self, initial_limit=DEF_INITIAL_LIMIT,
+                 min_limit=DEF_MIN_LIMIT, max_limit=DEF_MAX_LIMIT,
+                 baseline_window=DEF_BASELINE_WINDOW):
+        """Constructor.
+
+        :param int initial_limit: initial limit.
+        :param int min_limit: minimum limit.
+        :param int max_limit: maximum limit.
+        :param int baseline_window: the number of samples baseline latency
+               is averaged over.
+        """
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.baseline_rtt = None
+
+        self._limit = float(initial_limit)
+        self._alpha = 2.0 / (baseline_window + 1)
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """Current limit.
+
+        :rtype: int
+        """
+
+        return int(self._limit)
+
+    def set_max_limit(self, max_limit):
+        """Change the maximum limit, capping the current limit.
+
+        :param int max_limit: new maximum limit.
+        """
+
+        with self._lock:
+            self.max_limit = max_limit
+            self._limit = max(self.min_limit, min(self._limit, max_limit))
+
+    def sample(self, rtt, in_flight, dropped):
+        """Account request and recalculate limit.
+
+        :param float rtt: request latency in seconds.
+        :param int in_flight: the number of requests in flight when the
+               request completed, itself included.
+        :param bool dropped: whether request timed out or was rejected by
+               upstream as overloaded.
+
+        :return: new limit.
+        :rtype: int
+        """
+
+        with self._lock:
+            if self.baseline_rtt is None:
+                self.baseline_rtt = rtt
+
+            limit = self._update(self._limit, rtt, in_flight, dropped)
+            self._limit = max(self.min_limit, min(self.max_limit, limit))
+
+            if not dropped:
+                self.baseline_rtt += self._alpha * (rtt - self.baseline_rtt)
+
+            return int(self._limit)
+
+    def _update(self, limit, rtt, in_flight, dropped):
+        """Calculate new limit.
+
+        :param float limit: current limit.
+        :param float rtt: request latency.
+        :param int in_flight: the number of requests in flight.
+        :param bool dropped: whether request was dropped.
+
+        :rtype: float
+        """
+
+        raise NotImplementedError
+
+    def __repr__(self):
+
+        return '<%s %d>' % (self.__class__.__name__, self.limit)
+
+
+class AIMDLimit(AdaptiveLimit):
+
+    """Additive increase, multiplicative decrease. Limit grows by one per
+    request while latency stays within tolerance of baseline and is cut by
+    backoff ratio on drops or latency beyond that.
+
+    """
+
+    def __init__(self, initial_limit=DEF_INITIAL_LIMIT,
+                 min_limit=DEF_MIN_LIMIT, max_limit=DEF_MAX_LIMIT,
+                 backoff_ratio=0.9, tolerance=2.0, **kwargs):
+        """Constructor.
+
+        :param int initial_limit: initial limit.
+        :param int min_limit: minimum limit.
+        :param int max_limit: maximum limit.
+        :param float backoff_ratio: limit multiplier on overload.
+        :param float tolerance: latency to baseline ratio which is taken
+               as overload.
+        :param kwargs: other options, see AdaptiveLimit.
+        """
+
+        super().__init__(initial_limit, min_limit, max_limit, **kwargs)
+
+        self.backoff_ratio = backoff_ratio
+        self.tolerance = tolerance
+
+    def _update(self, limit, rtt, in_flight, dropped):
+
+        if dropped or rtt > self.baseline_rtt * self.tolerance:
+            return limit * self.backoff_ratio
+
+        # Don't grow the limit which is not reached anyway.
+        if in_flight * 2 >= limit:
+            return limit + 1
+
+        return limit
+
+
+class GradientLimit(AdaptiveLimit):
+
+    """Gradient limit: limit is scaled by the ratio of baseline to current
+    latency, so it shrinks as soon as requests start queueing upstream, and
+    grows by a queue allowance of square root of the limit otherwise.
+    Changes are smoothed.
+
+    """
+
+    def __init__(self, initial_limit=DEF_INITIAL_LIMIT,
+                 min_limit=DEF_MIN_LIMIT, max_limit=DEF_MAX_LIMIT,
+                 smoothing=0.2, tolerance=1.5, backoff_ratio=0.9, **kwargs):
+        """Constructor.
+
+        :param int initial_limit: initial limit.
+        :param int min_limit: minimum limit.
+        :param int max_limit: maximum limit.
+        :param float smoothing: weight of the new limit estimate.
+        :param float tolerance: latency to baseline ratio tolerated before
+               limit is reduced.
+        :param float backoff_ratio: limit multiplier on drop.
+        :param kwargs: other options, see AdaptiveLimit.
+        """
+
+        super().__init__(initial_limit, min_limit, max_limit, **kwargs)
+
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.backoff_ratio = backoff_ratio
+
+    def _update(self, limit, rtt, in_flight, dropped):
+
+        if dropped:
+            return limit * self.backoff_ratio
+
+        # Don't grow the limit which is not reached anyway.
+        if in_flight * 2 < limit:
+            return limit
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline_rtt /
+                                max(rtt, 1e-6)))
+        estimate = limit * gradient + math.sqrt(limit)
+
+        return limit * (1 - self.smoothing) + estimate * self.smoothing
+
+
+class LimitGate(object):
+
+    """Blocking gate letting at most limit threads through at once."""
+
+    def __init__(self, limit):
+        """Constructor.
+
+        :param AdaptiveLimit limit: concurrency limit.
+        """
+
+        self.limit = limit
+        self.in_flight = 0
+
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Wait until the number of requests in flight is under the limit.
+
+        :param int|float|None timeout: maximum time to wait, if None -
+               unlimited.
+
+        :return: whether slot was acquired.
+        :rtype: bool
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.in_flight >= self.limit.limit:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+
+                self._cond.wait(remaining)
+
+            self.in_flight += 1
+
+            return True
+
+    def release(self, rtt=None, dropped=False):
+        """Release slot, recalculating limit.
+
+        :param float|None rtt: request latency, None if request outcome is
+               unknown, e.g. it was cancelled, then limit is kept.
+        :param bool dropped: whether request was dropped.
+        """
+
+        with self._cond:
+            if rtt is not None:
+                self.limit.sample(rtt, self.in_flight, dropped)
+            self.in_flight -= 1
+            self._cond.notify_all()
@@ -0,0 +1,248 @@
+"""Client-side request rate limiting."""
+
+__author__ = 'vovanec@gmail.com'
+
+import email.utils
+import http.client
+import threading
+import time
+import urllib.parse
+
+
+DEF_BACKOFF = 1
+MIN_RATE_FRACTION = 0.05
+EPOCH_THRESHOLD = 10 ** 9
+
+RETRY_AFTER = 'Retry-After'
+RATELIMIT_REMAINING = 'X-RateLimit-Remaining'
+RATELIMIT_RESET = 'X-RateLimit-Reset'
+
+
+class TokenBucket(object):
+
+    """Token bucket.
+
+    Tokens are reserved rather than taken: reservation always succeeds and
+    tells the caller how long it must wait before proceeding, so the same
+    bucket paces both blocking and IOLoop based callers. The bucket is
+    thread-safe.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        """Constructor.
+
+        :param int|float rate: the number of tokens added per second.
+        :param int|None burst: bucket capacity, by default one second worth
+               of tokens.
+        """
+
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+
+        self._tokens = self.burst
+        self._updated = self._time()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Reserve tokens.
+
+        :param int tokens: the number of tokens to reserve.
+
+        :return: time in seconds to wait before using the tokens.
+        :rtype: float
+        """
+
+        with self._lock:
+            now = self._time()
+            self._refill(now)
+            self._tokens -= tokens
+
+            return (max(0, self._updated - now) +
+                    max(0, -self._tokens) / self.rate)
+
+    def set_rate(self, rate):
+        """Change the rate of adding tokens.
+
+        :param int|float rate: new rate.
+        """
+
+        with self._lock:
+            self._refill(self._time())
+            self.rate = rate
+
+    def block(self, seconds):
+        """Stop adding tokens and drain the bucket for the given time.
+
+        :param int|float seconds: time to block for.
+        """
+
+        with self._lock:
+            now = self._time()
+            self._refill(now)
+            self._tokens = min(self._tokens, 1)
+            self._updated = max(self._updated, now + seconds)
+
+    def _refill(self, now):
+
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+
+    @staticmethod
+    def _time():
+
+        return time.monotonic()
+
+
+class RateLimiter(object):
+
+    """Engine rate limiter.
+
+    Paces requests with an engine-wide token bucket and, optionally, with
+    per-route buckets matched by the longest URL prefix. In adaptive mode
+    the limiter follows server hints: it stops sending on 429 responses
+    until ``Retry-After`` expires and spreads the requests remaining in the
+    ``X-RateLimit-*`` window evenly until the window reset.
+
+    """
+
+    def __init__(self, rate=None, burst=None, routes=None, adaptive=False):
+        """Constructor.
+
+        :param int|float|None rate: engine-wide requests per second. If
+               None - only routes are limited.
+        :param int|None burst: engine-wide burst size.
+        :param dict|None routes: mapping of URL prefix to rate or
+               (rate, burst) tuple.
+        :param bool adaptive: whether to adapt to server rate limit hints.
+        """
+
+        self.adaptive = adaptive
+
+        self._buckets = {}
+        if rate is not None:
+            self._buckets[''] = TokenBucket(rate, burst)
+
+        for prefix, limit in (routes or {}).items():
+            if not isinstance(limit, tuple):
+                limit = (limit,)
+            self._buckets[prefix] = TokenBucket(*limit)
+
+        self._max_rates = {
+            prefix: bucket.rate for prefix, bucket in self._buckets.items()}
+        self._prefixes = sorted(
+            (p for p in self._buckets if p), key=len, reverse=True)
+
+    def reserve(self, url):
+        """Reserve a request slot for the URL.
+
+        :param str url: request URL, relative to API base URL or absolute.
+
+        :return: time in seconds to wait before sending the request.
+        :rtype: float
+        """
+
+        return max([bucket.reserve() for bucket in self._match(url)] or [0])
+
+    def update(self, url, status_code, headers):
+        """Adapt limits to the server response.
+
+        :param str url: request URL, relative to API base URL or absolute.
+        :param int status_code: response HTTP code.
+        :param collections.Mapping|None headers: response headers.
+        """
+
+        if not (self.adaptive and headers is not None):
+            return
+
+        for prefix, bucket in self._match_prefixes(url):
+            max_rate = self._max_rates[prefix]
+            if status_code == http.client.TOO_MANY_REQUESTS:
+                retry_after = parse_retry_after(headers.get(RETRY_AFTER))
+                if retry_after is None:
+                    retry_after = DEF_BACKOFF
+                    bucket.set_rate(max(bucket.rate / 2,
+                                        max_rate * MIN_RATE_FRACTION))
+                bucket.block(retry_after)
+                continue
+
+            rate = window_rate(headers.get(RATELIMIT_REMAINING),
+                               headers.get(RATELIMIT_RESET))
+            if rate is not None:
+                bucket.set_rate(min(max_rate, max(
+                    rate, max_rate * MIN_RATE_FRACTION)))
+            elif bucket.rate < max_rate:
+                bucket.set_rate(min(max_rate, bucket.rate * 2))
+
+    def _match(self, url):
+
+        return [bucket for _, bucket in self._match_prefixes(url)]
+
+    def _match_prefixes(self, url):
+
+        url = '/' + urllib.parse.urlsplit(url).path.lstrip('/')
+        matched = []
+        if '' in self._buckets:
+            matched.append(('', self._buckets['']))
+
+        for prefix in self._prefixes:
+            if url.startswith(prefix):
+                matched.append((prefix, self._buckets[prefix]))
+                break
+
+        return matched
+
+
+def parse_retry_after(value, now=None):
+    """Parse Retry-After header value.
+
+    :param str|None value: header value, delay seconds or HTTP date.
+    :param float|None now: current UNIX time.
+
+    :return: delay in seconds or None if could not parse.
+    :rtype: float|None
+    """
+
+    if not value:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+    return max(0, retry_at - (time.time() if now is None else now))
+
+
+def window_rate(remaining, reset, now=None):
+    """Calculate the rate which spreads remaining requests over the rest of
+    rate limit window.
+
+    :param str|None remaining: X-RateLimit-Remaining header value.
+    :param str|None reset: X-RateLimit-Reset header value, either seconds
+           until reset or UNIX time of reset.
+    :param float|None now: current UNIX time.
+
+    :rtype: float|None
+    """
+
+    try:
+        remaining = float(remaining)
+        reset = float(reset)
+    except (TypeError, ValueError):
+        return None
+
+    if reset > EPOCH_THRESHOLD:
+        reset -= time.time() if now is None else now
+
+    if reset <= 0:
+        return None
+
+    return remaining / reset
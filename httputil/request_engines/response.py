@@ -0,0 +1,127 @@
+"""Lightweight HTTP response."""
+
+__author__ = 'vovanec@gmail.com'
+
+import http.client
+import io
+
+from .. import httputil
+from .errors import MalformedResponse
+
+
+def parse_header_lines(lines):
+    """Parse response header lines. If there are several responses, e.g.
+    after redirect or 100 Continue, headers of the last one are parsed.
+
+    :param list[str] lines: header lines including status line.
+
+    :rtype: http.client.HTTPMessage
+    """
+
+    start = 0
+    for i, line in enumerate(lines):
+        if line.startswith('HTTP/'):
+            start = i + 1
+
+    return http.client.parse_headers(io.BytesIO(
+        ''.join(lines[start:]).encode('iso-8859-1')))
+
+
+def decode_body(raw, headers):
+    """Decode response body according to Content-Encoding.
+
+    :param bytes|memoryview raw: body as received.
+    :param collections.Mapping headers: response headers.
+
+    :rtype: bytes|memoryview
+    :raise: MalformedResponse
+    """
+
+    try:
+        compression = httputil.compression_from_header(
+            headers.get('Content-Encoding'))
+        if compression is None:
+            return raw
+
+        return b''.join(httputil.decompress([raw], compression))
+    except (httputil.BodyStreamError, TypeError) as err:
+        raise MalformedResponse(err) from None
+
+
+class Response(object):
+
+    """HTTP response. Headers are parsed and body is decoded according to
+    Content-Encoding only when accessed.
+
+    """
+
+    __slots__ = ('code', 'url', 'started', 'elapsed',
+                 '_headers', '_header_lines', '_raw', '_body')
+
+    def __init__(self, code, headers, raw, url=None, started=None,
+                 elapsed=None):
+        """Constructor.
+
+        :param int code: HTTP code.
+        :param collections.Mapping|list[str] headers: parsed headers or
+               raw header lines.
+        :param bytes|memoryview raw: body as received, possibly compressed.
+        :param str|None url: request URL.
+        :param float|None started: UNIX time the request was sent at.
+        :param float|None elapsed: time in seconds from sending the request
+               till the whole body was received.
+        """
+
+        self.code = code
+        self.url = url
+        self.started = started
+        self.elapsed = elapsed
+
+        self._headers = None
+        self._header_lines = None
+        if isinstance(headers, list):
+            self._header_lines = headers
+        else:
+            self._headers = headers
+
+        self._raw = memoryview(raw)
+        self._body = None
+
+    def __repr__(self):
+
+        return '<Response %d>' % (self.code,)
+
+    @property
+    def headers(self):
+        """Response headers.
+
+        :rtype: collections.Mapping
+        """
+
+        if self._headers is None:
+            self._headers = parse_header_lines(self._header_lines)
+            self._header_lines = None
+
+        return self._headers
+
+    @property
+    def raw(self):
+        """Body as received.
+
+        :rtype: memoryview
+        """
+
+        return self._raw
+
+    @property
+    def body(self):
+        """Body decoded according to Content-Encoding.
+
+        :rtype: memoryview
+        :raise: MalformedResponse
+        """
+
+        if self._body is None:
+            self._body = memoryview(decode_body(self._raw, self.headers))
+
+        return self._body
@@ -0,0 +1,206 @@
+"""Weighted fair scheduling of requests between priority classes."""
+
+__author__ = 'vovanec@gmail.com'
+
+import collections
+
+from tornado import concurrent
+
+from .errors import QueueFullError
+
+
+DEF_PRIORITY = 'default'
+DEF_WEIGHT = 1
+
+
+class PriorityClass(object):
+
+    """Priority class state."""
+
+    __slots__ = ('name', 'weight', 'max_queue', 'waiters', 'position')
+
+    def __init__(self, name, weight=DEF_WEIGHT, max_queue=None):
+        """Constructor.
+
+        :param str name: class name.
+        :param int|float weight: share of request slots relative to other
+               classes.
+        :param int|None max_queue: maximum number of waiting requests, if
+               None - unlimited.
+        """
+
+        self.name = name
+        self.weight = weight
+        self.max_queue = max_queue
+        self.waiters = collections.deque()
+        self.position = 0.0
+
+    def __repr__(self):
+
+        return '<PriorityClass %s>' % (self.name,)
+
+
+class FairScheduler(object):
+
+    """Limit the number of requests in flight. When all slots are busy,
+    requests wait in per-class queues, and slots are granted to classes in
+    proportion to their weights (stride scheduling), so that a busy class
+    can't starve the others. Class which has max_queue requests waiting
+    fails further requests right away.
+
+    Classes may be configured in advance or created on first use with the
+    default weight and queue limit, e.g. per tenant. Scheduler is meant to
+    be used on the IOLoop thread.
+
+    """
+
+    def __init__(self, max_concurrency, classes=None, max_queue=None,
+                 default_weight=DEF_WEIGHT):
+        """Constructor.
+
+        :param int max_concurrency: maximum number of requests in flight.
+        :param dict|None classes: mapping of class name to weight or
+               (weight, max_queue) tuple.
+        :param int|None max_queue: queue limit of classes not configured
+               explicitly, if None - unlimited.
+        :param int|float default_weight: weight of classes not configured
+               explicitly.
+        """
+
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be positive.')
+
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+
+        self._max_queue = max_queue
+        self._default_weight = default_weight
+        self._virtual_time = 0.0
+
+        self._classes = {}
+        for name, params in (classes or {}).items():
+            if not isinstance(params, tuple):
+                params = (params,)
+            self._classes[name] = PriorityClass(name, *params)
+
+    def acquire(self, priority=None):
+        """Wait for a request slot. Caller must call release() once request
+        is complete.
+
+        :param str|None priority: priority class name, if None -
+               DEF_PRIORITY.
+
+        :return: future resolved once slot is granted.
+        :rtype: tornado.concurrent.Future
+        :raise: QueueFullError
+        """
+
+        cls = self._get_class(priority)
+        future = concurrent.Future()
+
+        if self.in_flight < self.max_concurrency and not self.queued():
+            self.in_flight += 1
+            future.set_result(None)
+            return future
+
+        if cls.max_queue is not None and len(cls.waiters) >= cls.max_queue:
+            raise QueueFullError('%d requests of class %s are queued' %
+                                 (len(cls.waiters), cls.name))
+
+        if not cls.waiters:
+            # Idle class does not accumulate credit.
+            cls.position = max(cls.position, self._virtual_time)
+        cls.waiters.append(future)
+
+        return future
+
+    def release(self):
+        """Release request slot, granting it to the next waiting request."""
+
+        self.in_flight -= 1
+        self._dispatch()
+
+    def cancel(self, future):
+        """Remove request from the queue, future is left pending.
+
+        :param tornado.concurrent.Future future: future returned by
+               acquire().
+
+        :return: whether request was waiting, False if slot is already
+                 granted to it.
+        :rtype: bool
+        """
+
+        for cls in self._classes.values():
+            try:
+                cls.waiters.remove(future)
+                return True
+            except ValueError:
+                pass
+
+        return False
+
+    def set_max_concurrency(self, max_concurrency):
+        """Change the maximum number of requests in flight. Requests already
+        in flight over the new limit are not affected.
+
+        :param int max_concurrency: new limit.
+        """
+
+        self.max_concurrency = max(1, max_concurrency)
+        self._dispatch()
+
+    def reset(self):
+        """Forget requests in flight and waiting, e.g. those of the parent
+        process after fork. Classes are kept.
+        """
+
+        self.in_flight = 0
+        self._virtual_time = 0.0
+        for cls in self._classes.values():
+            cls.waiters.clear()
+            cls.position = 0.0
+
+    def queued(self, priority=None):
+        """Get the number of requests waiting for slot.
+
+        :param str|None priority: priority class name, if None - all
+               classes.
+
+        :rtype: int
+        """
+
+        if priority is not None:
+            cls = self._classes.get(priority)
+            return len(cls.waiters) if cls is not None else 0
+
+        return sum(len(cls.waiters) for cls in self._classes.values())
+
+    def _dispatch(self):
+
+        while self.in_flight < self.max_concurrency:
+            active = [cls for cls in self._classes.values() if cls.waiters]
+            if not active:
+                break
+
+            # Ties go to the heavier class.
+            cls = min(active, key=lambda c: (c.position, -c.weight))
+            future = cls.waiters.popleft()
+            self._virtual_time = cls.position
+            cls.position += 1.0 / cls.weight
+
+            if future.done():
+                continue  # waiter has gone
+
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _get_class(self, priority):
+
+        name = DEF_PRIORITY if priority is None else priority
+        cls = self._classes.get(name)
+        if cls is None:
+            cls = PriorityClass(name, self._default_weight, self._max_queue)
+            self._classes[name] = cls
+
+        return cls
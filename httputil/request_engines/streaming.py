@@ -0,0 +1,164 @@
+"""Streaming response bodies."""
+
+__author__ = 'vovanec@gmail.com'
+
+import http.client
+
+from .. import httputil
+from . import download as downloads
+
+
+class ResumableBodyStream(object):
+
+    """Pass response body to the caller, decoding it if compressed, and
+    keep track of the raw bytes received, so that interrupted transfer may
+    be resumed with a Range request validated by If-Range.
+
+    The engine feeds raw, still encoded, body bytes to the stream. The
+    decompressor persists across resumed attempts, so resumption at the raw
+    byte offset keeps its state valid.
+
+    """
+
+    def __init__(self, streaming_callback, header_callback=None,
+                 resumable=True, decode=True):
+        """Constructor.
+
+        :param bytes -> None streaming_callback: body consumer.
+        :param (int, collections.Mapping) -> None header_callback: called
+               with HTTP code and headers of the first successful response.
+        :param bool resumable: whether transfer may be resumed, callers
+               requesting ranges themselves should not resume.
+        :param bool decode: whether to decompress body according to
+               Content-Encoding.
+        """
+
+        self.offset = 0
+        self.validator = None
+        self.expected_offset = None
+
+        self._streaming_callback = streaming_callback
+        self._header_callback = header_callback
+        self._resumable = resumable
+        self._decode = decode
+        self._decompressor = None
+
+    @property
+    def can_resume(self):
+        """Whether interrupted transfer may be resumed.
+
+        :rtype: bool
+        """
+
+        return self._resumable and self.validator is not None
+
+    @property
+    def started(self):
+        """Whether any body bytes have been received.
+
+        :rtype: bool
+        """
+
+        return self.offset > 0
+
+    @property
+    def complete(self):
+        """Whether all the body bytes announced by Content-Length have been
+        received.
+
+        :rtype: bool
+        """
+
+        return self.expected_offset is None or \
+            self.offset >= self.expected_offset
+
+    def request_headers(self, headers):
+        """Make headers for the next request attempt.
+
+        :param dict|None headers: original request headers.
+
+        :rtype: dict|None
+        """
+
+        if not self.started:
+            return headers
+
+        headers = dict(headers or {})
+        headers['Range'] = downloads.range_header(self.offset)
+        headers['If-Range'] = self.validator
+
+        return headers
+
+    def on_headers(self, code, headers):
+        """Process headers of successful response.
+
+        :param int code: HTTP code.
+        :param collections.Mapping headers: response headers.
+
+        :raise: RangeError, TypeError
+        """
+
+        try:
+            self.expected_offset = self.offset + int(
+                headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.expected_offset = None
+
+        if self.started:
+            downloads.check_range_response(self.offset, code, headers)
+            return
+
+        if self._resumable and code == http.client.OK and \
+                headers.get('Accept-Ranges', '').strip().lower() == 'bytes':
+            self.validator = strong_validator(headers)
+
+        if self._decode:
+            compression = httputil.compression_from_header(
+                headers.get('Content-Encoding'))
+            if compression is not None:
+                self._decompressor = httputil.StreamDecompressor(compression)
+
+        if self._header_callback is not None:
+            self._header_callback(code, headers)
+
+    def on_chunk(self, chunk):
+        """Process raw body block.
+
+        :param bytes chunk: body block.
+
+        :raise: BodyStreamError
+        """
+
+        self.offset += len(chunk)
+        if self._decompressor is not None:
+            chunk = self._decompressor.decompress(chunk)
+
+        if chunk:
+            self._streaming_callback(chunk)
+
+    def finish(self):
+        """Process the end of body.
+
+        :raise: BodyStreamError
+        """
+
+        if self._decompressor is not None:
+            chunk = self._decompressor.flush()
+            if chunk:
+                self._streaming_callback(chunk)
+
+
+def strong_validator(headers):
+    """Get validator usable in If-Range header: strong ETag or, failing
+    that, Last-Modified date.
+
+    :param collections.Mapping headers: response headers.
+
+    :rtype: str|None
+    """
+
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return headers.get('Last-Modified')
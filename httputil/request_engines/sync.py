@@ -3,15 +3,45 @@
 __author__ = 'vovanec@gmail.com'
 
 
+import functools
+import http.client
+import io
+import os
 import requests.adapters
+import requests.certs
 import requests.exceptions
 import requests.models
+import socket
+import threading
 import time
 
+from concurrent import futures
+
+from requests.packages.urllib3 import connection as urllib3_connection
+from requests.packages.urllib3 import connectionpool
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+from requests.packages.urllib3 import response as urllib3_response
+
+from . import body
+from . import dns
+from . import download as downloads
+from . import limits
+from . import response as responses
+from . import streaming
+from . import tls
+from . import transport
+from .. import httputil
+from ..httputil import CHUNK_SIZE
+from .base import OVERLOAD_CODES
+from .base import SLASH
 from .base import BaseRequestEngine
 from .errors import ClientError
 from .errors import CommunicationError
+from .errors import ContentChangedError
 from .errors import MalformedResponse
+from .errors import QueueFullError
+from .errors import RangeError
+from .errors import RequestCancelled
 from .errors import ServerError
 
 
@@ -26,7 +56,7 @@ class SyncRequestEngine(BaseRequestEngine):
     def __init__(self, api_base_url, connect_timeout, request_timeout,
                  conn_retries, username=None, password=None,
                  client_cert=None, client_key=None, verify_cert=True,
-                 ca_certs=None):
+                 ca_certs=None, **kwargs):
         """Constructor.
 
         :param str api_base_url: API base URL.
@@ -40,57 +70,276 @@ class SyncRequestEngine(BaseRequestEngine):
         :param str|None client_key: client key.
         :param bool verify_cert: whether to verify server cert.
         :param str|None ca_certs: path to CA certificate chain.
+        :param kwargs: other options, see BaseRequestEngine.
         """
 
         super().__init__(
             api_base_url, connect_timeout, request_timeout, conn_retries,
             username=username, password=password,
             client_cert=client_cert, client_key=client_key,
-            verify_cert=verify_cert, ca_certs=ca_certs)
+            verify_cert=verify_cert, ca_certs=ca_certs, **kwargs)
+
+        self._adapters = None
+        self._adapters_lock = threading.Lock()
+        self._ssl_context = None
+        self._ssl_verify = None
+        self.reload_certs()
+
+        self._limit_gate = None
+        if self._concurrency_limit is not None:
+            self._limit_gate = limits.LimitGate(self._concurrency_limit)
+
+    def reload_certs(self):
+        """Build SSL context shared by all connections of the engine, so
+        that certificate files are read once and TLS sessions are resumed.
+        Connections opened with the previous context are dropped.
+
+        :raise: OSError, ssl.SSLError
+        """
+
+        verify = self._tls_kwargs()['verify']
+        if verify is True:
+            # Same CA bundle as requests picks for the default verify.
+            verify = os.environ.get('REQUESTS_CA_BUNDLE') or \
+                os.environ.get('CURL_CA_BUNDLE') or True
+
+        # urllib3 matches host names against certificate itself, IP
+        # addresses included, so ssl module is not asked to.
+        self._ssl_context = tls.make_ssl_context(
+            self._client_cert, self._client_key, self._verify_cert,
+            requests.certs.where() if verify is True else verify,
+            check_hostname=False)
+        self._ssl_verify = verify
+
+        with self._adapters_lock:
+            adapters, self._adapters = self._adapters, None
+
+        # Requests in flight return their connections to the closed pools,
+        # which close them.
+        for adapter in {adapter for _, adapter in adapters or ()}:
+            adapter.close()
+
+    def warm_up(self, n_connections=1):
+        """Open connections to every API endpoint in a background thread and
+        put them into connection pools.
+
+        :param int n_connections: the number of connections per endpoint,
+               up to connection pool size.
+
+        :return: future resolved with the number of connections opened.
+        :rtype: concurrent.futures.Future
+        """
+
+        self._check_fork()
+
+        executor = futures.ThreadPoolExecutor(1)
+        future = executor.submit(self._warm_up, n_connections)
+        executor.shutdown(wait=False)
+
+        return future
+
+    def _warm_up(self, n_connections):
+        """Open connections with concurrent HEAD requests to base URLs, any
+        HTTP response will do. Requests go the same way as any other
+        request, so connections land in the pools later requests use. Each
+        request holds its connection until all of them are done, so that
+        connections are not reused between them.
+
+        :param int n_connections: the number of connections per endpoint.
+
+        :return: the number of connections opened.
+        :rtype: int
+        """
+
+        urls = [base_url + SLASH for base_url in self._warm_up_urls()
+                for _ in range(min(n_connections,
+                                   requests.adapters.DEFAULT_POOLSIZE))]
+        if not urls:
+            return 0
+
+        session = self._make_session()
+        barrier = threading.Barrier(len(urls))
+
+        def open_connection(url):
+            response = None
+            try:
+                response = session.head(url, timeout=self._connect_timeout,
+                                        stream=True, **self._tls_kwargs())
+            except requests.exceptions.RequestException as err:
+                self._log.warning('Could not open connection to %s: %s',
+                                  url, err)
+
+            try:
+                barrier.wait(self._connect_timeout)
+            except threading.BrokenBarrierError:
+                pass
+
+            if response is None:
+                return False
+
+            response.content  # release connection to the pool
+
+            return True
+
+        with futures.ThreadPoolExecutor(len(urls)) as executor:
+            return sum(executor.map(open_connection, urls))
+
+    def _tls_kwargs(self):
+        """Get certificate options of requests.
+
+        :return: verify and cert keyword arguments.
+        :rtype: dict
+        """
+
+        cert = None
+        if self._client_cert and self._client_key:
+            cert = (self._client_cert, self._client_key)
+        elif self._client_cert:
+            cert = self._client_cert
+
+        if self._verify_cert:
+            verify = True
+            if self._ca_certs:
+                verify = self._ca_certs
+        else:
+            verify = False
+
+        return {'verify': verify, 'cert': cert}
+
+    def _after_fork(self):
+
+        # Connections are shared with the parent, so they are left open.
+        self._adapters = None
+        self._adapters_lock = threading.Lock()
+        self.reload_certs()
+
+        if self._limit_gate is not None:
+            self._limit_gate = limits.LimitGate(self._concurrency_limit)
 
     def _request(self, url, *,
-                 method='GET', headers=None, data=None, result_callback=None):
+                 method='GET', headers=None, data=None, result_callback=None,
+                 streaming_callback=None, header_callback=None,
+                 return_response=False, priority=None, cancel_token=None):
         """Perform synchronous request.
 
-        :param str url: request URL.
+        :param str url: request URL relative to API base URL.
         :param str method: request method.
-        :param object data: JSON-encodable object.
+        :param object data: request body: bytes, file object or iterator of
+               bytes. Files and iterators are streamed.
         :param object -> object result_callback: result callback.
+        :param bytes -> None streaming_callback: if set, response body is
+               passed to it in blocks as they arrive instead of being
+               returned. Request is not retried once a block was passed.
+        :param (int, collections.Mapping) -> None header_callback: called
+               with HTTP code and headers of successful response before
+               its body is processed.
+        :param bool return_response: whether to return response.Response
+               rather than body. Its body is read undecoded, in one go.
+        :param str|None priority: ignored, requests are not queued by the
+               engine.
+        :param cancel.CancelToken|None cancel_token: token to cancel the
+               request with, from another thread or from streaming
+               callback. Cancellation shuts down the connection response
+               body is read from and stops retries. It does not interrupt
+               connect or the wait for response headers, which are bound
+               by connect and request timeouts only.
 
-        :rtype: dict
-        :raise: APIError
+        :rtype: dict|response.Response
+        :raise: APIError, QueueFullError, RequestCancelled
         """
 
+        stream = None
+        if body.is_streaming(data):
+            stream = body.StreamingBody(data)
+
+        extra_kw = {}
+        if return_response or cancel_token is not None:
+            # Body is read after the request returns, so that reading can
+            # be aborted.
+            extra_kw['stream'] = True
+
+        body_stream = None
+        if streaming_callback is not None:
+            extra_kw['stream'] = True
+            body_stream = streaming.ResumableBodyStream(
+                streaming_callback, header_callback,
+                resumable='Range' not in (headers or {}))
+
         retries_left = self._conn_retries
+        tried = set()
 
         while True:
+            if cancel_token is not None:
+                cancel_token.check()
+
+            delay = self._rate_limit_delay(url)
+            if delay:
+                _sleep(delay, cancel_token)
+
+            if stream is not None:
+                # requests sends files with Content-Length when size is
+                # known, iterators with chunked transfer encoding.
+                data = stream.source if stream.seekable else iter(stream)
+
+            request_headers = headers
+            if body_stream is not None:
+                request_headers = body_stream.request_headers(headers)
+
             s = self._make_session()
-            try:
-                cert = None
-                if self._client_cert and self._client_key:
-                    cert = (self._client_cert, self._client_key)
-                elif self._client_cert:
-                    cert = self._client_cert
-
-                if self._verify_cert:
-                    verify = True
-                    if self._ca_certs:
-                        verify = self._ca_certs
-                else:
-                    verify = False
 
+            if self._limit_gate is not None and \
+                    not self._limit_gate.acquire(self._request_timeout):
+                raise QueueFullError(
+                    'No request slot freed within %s seconds, %d requests '
+                    'in flight.' % (self._request_timeout,
+                                    self._limit_gate.in_flight))
+
+            # Endpoint is selected once the request may be sent, so that
+            # every selection is matched by balancer.finish().
+            endpoint = None
+            response = None
+            abort_handle = None
+            dropped = False
+            started_at = time.time()
+            started = time.monotonic()
+            try:
                 auth = None
                 if self._username and self._password:
                     auth = (self._username, self._password)
 
-                response = s.request(method, url, data=data,
-                                     timeout=self._connect_timeout,
-                                     cert=cert,
-                                     headers=headers,
-                                     verify=verify,
-                                     auth=auth)
-                """:type: requests.models.Response
-                """
+                failed = False
+                try:
+                    endpoint = self._balancer.select(tried)
+                    tried.add(endpoint)
+                    full_url = self._make_full_url(url, endpoint.base_url)
+
+                    response = s.request(method, full_url, data=data,
+                                         timeout=self._connect_timeout,
+                                         headers=request_headers,
+                                         auth=auth,
+                                         **dict(self._tls_kwargs(),
+                                                **extra_kw))
+                    """:type: requests.models.Response
+                    """
+                except (requests.exceptions.RequestException,
+                        requests.exceptions.BaseHTTPError):
+                    failed = True
+                    raise
+                finally:
+                    if endpoint is not None:
+                        self._balancer.finish(
+                            endpoint, time.monotonic() - started, failed)
+
+                if cancel_token is not None:
+                    abort_handle = cancel_token.add_callback(
+                        functools.partial(_abort_response, response))
+                    if body_stream is None and not return_response:
+                        response.content  # read body, it is cached
+                        cancel_token.check()
+
+                self._update_rate_limit(
+                    url, response.status_code, response.headers)
+
                 if 400 <= response.status_code < 500:
                     raise ClientError(
                         response.status_code, response.content)
@@ -98,6 +347,20 @@ class SyncRequestEngine(BaseRequestEngine):
                     raise ServerError(
                         response.status_code, response.content)
 
+                if body_stream is not None:
+                    self._stream_response(response, body_stream, cancel_token)
+                    return None
+
+                if header_callback is not None:
+                    header_callback(response.status_code, response.headers)
+
+                if return_response:
+                    result = self._make_response(response, started_at,
+                                                 started)
+                    if cancel_token is not None:
+                        cancel_token.check()
+                    return result
+
                 try:
                     if result_callback:
                         return result_callback(response.content)
@@ -108,27 +371,514 @@ class SyncRequestEngine(BaseRequestEngine):
 
             except (requests.exceptions.RequestException,
                     requests.exceptions.BaseHTTPError) as exc:
-                if self._conn_retries is None or retries_left <= 0:
+                dropped = True
+                if cancel_token is not None and cancel_token.cancelled:
+                    raise RequestCancelled() from None
+                elif self._conn_retries is None or retries_left <= 0 or \
+                        (body_stream is not None and body_stream.started and
+                         not body_stream.can_resume) or \
+                        (stream is not None and not stream.rewind()):
                     raise CommunicationError(exc) from None
                 else:
                     retries_left -= 1
-                    retry_in = (self._conn_retries - retries_left) * 2
+                    retry_in = self._retry_in(retries_left, tried)
+                    if body_stream is not None and body_stream.started:
+                        # Connection was fine, no need to back off.
+                        retry_in = 0
+                        self._log.warning('Resuming response body at byte '
+                                          '%d.', body_stream.offset)
                     self._log.warning('Server communication error: %s. '
                                       'Retrying in %s seconds.', exc, retry_in)
-                    time.sleep(retry_in)
-                    continue
             finally:
-                s.close()
+                if abort_handle is not None:
+                    cancel_token.remove_callback(abort_handle)
+
+                # Return streamed response connection to pool, or close it if
+                # body was not read to the end.
+                if response is not None and extra_kw.get('stream'):
+                    response.close()
+
+                # Slot is held until the body is read, but not over retry
+                # back-off. Cancelled request tells nothing of upstream.
+                if self._limit_gate is not None:
+                    if cancel_token is not None and cancel_token.cancelled:
+                        self._limit_gate.release()
+                    else:
+                        self._limit_gate.release(
+                            time.monotonic() - started, dropped or (
+                                response is not None and
+                                response.status_code in OVERLOAD_CODES))
+
+            _sleep(retry_in, cancel_token)
 
     @staticmethod
-    def _make_session():
-        """Create session object.
+    def _stream_response(response, body_stream, cancel_token=None):
+        """Pass raw response body to the body stream.
+
+        :param requests.models.Response response: response.
+        :param streaming.ResumableBodyStream body_stream: body stream.
+        :param cancel.CancelToken|None cancel_token: cancellation token,
+               checked before each block.
+
+        :raise: requests.exceptions.RequestException, MalformedResponse,
+                RangeError, RequestCancelled
+        """
+
+        try:
+            body_stream.on_headers(response.status_code, response.headers)
+            for block in response.raw.stream(CHUNK_SIZE,
+                                             decode_content=False):
+                if cancel_token is not None:
+                    cancel_token.check()
+                body_stream.on_chunk(block)
+
+            if cancel_token is not None:
+                cancel_token.check()
+
+            if not body_stream.complete:
+                raise requests.exceptions.ConnectionError(
+                    'Connection closed after %d of %d body bytes' %
+                    (body_stream.offset, body_stream.expected_offset))
+
+            body_stream.finish()
+        except urllib3_exceptions.HTTPError as err:
+            raise requests.exceptions.ConnectionError(err) from None
+        except (httputil.BodyStreamError, TypeError) as err:
+            raise MalformedResponse(err) from None
+
+    @staticmethod
+    def _make_response(response, started_at, started):
+        """Read response body, leaving it encoded, and make Response.
+
+        :param requests.models.Response response: streamed response.
+        :param float started_at: UNIX time the request was sent at.
+        :param float started: monotonic time the request was sent at.
+
+        :rtype: response.Response
+        :raise: requests.exceptions.RequestException
+        """
+
+        try:
+            raw = response.raw.read(decode_content=False)
+        except urllib3_exceptions.HTTPError as err:
+            raise requests.exceptions.ConnectionError(err) from None
+
+        remaining = getattr(response.raw, 'length_remaining', None)
+        if remaining:
+            raise requests.exceptions.ConnectionError(
+                'Connection closed with %d body bytes missing' % remaining)
+
+        return responses.Response(
+            response.status_code, response.headers, raw, url=response.url,
+            started=started_at, elapsed=time.monotonic() - started)
+
+    def download(self, url, dest, *, segments=downloads.DEF_SEGMENTS,
+                 segment_size=None, headers=None):
+        """Download content into file, fetching segments in threads.
+        Segments are validated by If-Range against ETag or Last-Modified
+        date of content, content without either is downloaded in one go.
+
+        :param str url: request URL.
+        :param str dest: destination file path.
+        :param int segments: the number of segments to download in parallel.
+        :param int|None segment_size: segment size, takes precedence over the
+               number of segments.
+        :param dict headers: request headers.
+
+        :return: the number of bytes downloaded.
+        :rtype: int
+        :raise: APIError, ContentChangedError
+        """
+
+        probe = {}
+        self.request(
+            url, method='HEAD', headers=self._download_headers(headers),
+            header_callback=lambda _, hdrs: probe.update(headers=hdrs))
+        size, accepts_ranges = downloads.probe_ranges(probe['headers'])
+        # Segments must be taken from the same version of content.
+        validator = streaming.strong_validator(probe['headers'])
+
+        if not accepts_ranges or not size or segments <= 1 or \
+                validator is None:
+            with open(dest, 'wb') as fh:
+                writer = downloads.FileWriter(fh)
+                self.request(url, headers=self._download_headers(headers),
+                             streaming_callback=writer.write)
+            return writer.position
+
+        downloads.preallocate(dest, size)
+        ranges = downloads.plan_segments(size, segments, segment_size)
+        with open(dest, 'r+b') as fh:
+            with futures.ThreadPoolExecutor(min(segments, len(ranges))) as ex:
+                for future in [ex.submit(self._download_segment, url, fh,
+                                         start, end, headers, validator)
+                               for start, end in ranges]:
+                    future.result()
+
+        return size
+
+    def _download_segment(self, url, fh, start, end, headers, validator):
+        """Download byte range into file, resuming from the last byte
+        written on errors.
+
+        :param str url: request URL.
+        :param file fh: destination file.
+        :param int start: first byte position.
+        :param int end: last byte position.
+        :param dict headers: request headers.
+        :param str validator: ETag or Last-Modified date of content.
+
+        :raise: APIError, ContentChangedError
+        """
+
+        writer = downloads.FileWriter(fh, start)
+        retries_left = self._conn_retries or 0
+
+        while writer.position <= end:
+            position = writer.position
+            try:
+                self.request(
+                    url, headers=self._download_headers(
+                        headers, position, end, validator),
+                    header_callback=functools.partial(
+                        downloads.check_range_response, position),
+                    streaming_callback=writer.write)
+                if writer.position <= end:
+                    raise RangeError('Segment %d-%d ended at %d' %
+                                     (start, end, writer.position))
+            except ContentChangedError:
+                raise
+            except ClientError as err:
+                if err.code == http.client.PRECONDITION_FAILED:
+                    raise ContentChangedError(str(err)) from None
+                raise
+            except (CommunicationError, RangeError) as err:
+                if retries_left <= 0:
+                    raise
+                retries_left -= 1
+                self._log.warning('Segment %d-%d download error: %s. '
+                                  'Resuming at %d.', start, end, err,
+                                  writer.position)
+
+    def _make_session(self):
+        """Create session object. Sessions are not reused, so that cookies
+        don't leak between requests, but share the engine's adapters and
+        their connection pools.
 
         :rtype: requests.Session
         """
 
         sess = requests.Session()
-        sess.mount('http://', requests.adapters.HTTPAdapter(max_retries=False))
-        sess.mount('https://', requests.adapters.HTTPAdapter(max_retries=False))
+        for prefix, adapter in self._get_adapters():
+            sess.mount(prefix, adapter)
 
         return sess
+
+    def _get_adapters(self):
+        """Get transport adapters of the current process.
+
+        :return: list of (URL prefix, adapter) tuples.
+        :rtype: list[tuple]
+        """
+
+        adapters = self._adapters
+        if adapters is not None:
+            return adapters
+
+        with self._adapters_lock:
+            if self._adapters is None:
+                tls_kw = {'ssl_context': self._ssl_context,
+                          'verify': self._ssl_verify,
+                          'cert': self._tls_kwargs()['cert']}
+                if self._resolver is not None:
+                    adapter = ResolvingHTTPAdapter(
+                        self._resolver, max_retries=False, **tls_kw)
+                else:
+                    adapter = TLSHTTPAdapter(max_retries=False, **tls_kw)
+
+                adapters = [('http://', adapter), ('https://', adapter),
+                            (transport.UNIX_SCHEME + '://',
+                             UnixHTTPAdapter(max_retries=False))]
+                if self._memory_transport is not None:
+                    adapters.append((transport.MEMORY_SCHEME + '://',
+                                     MemoryHTTPAdapter(
+                                         self._memory_transport)))
+                self._adapters = adapters
+
+            return self._adapters
+
+
+class TLSHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    """HTTP adapter whose HTTPS connections use the given SSL context rather
+    than loading certificate files for every connection.
+
+    """
+
+    def __init__(self, ssl_context=None, verify=True, cert=None, **kwargs):
+        """Constructor.
+
+        :param ssl.SSLContext|None ssl_context: SSL context. If None -
+               requests default behaviour.
+        :param bool|str verify: verify setting of requests the context
+               was built for.
+        :param str|tuple|None cert: client certificate the context was
+               built with.
+        :param kwargs: HTTPAdapter keyword arguments.
+        """
+
+        self._ssl_context = ssl_context
+        self._verify = verify
+        self._cert = cert
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+
+        if self._ssl_context is not None:
+            kwargs['ssl_context'] = self._ssl_context
+
+        super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+
+        if self._ssl_context is None or not url.lower().startswith('https'):
+            super().cert_verify(conn, url, verify, cert)
+            return
+
+        if verify != self._verify or cert != self._cert:
+            # Request is verified against other certificates, e.g. CA
+            # bundle set by environment after the context was built, so
+            # urllib3 makes context of its own for its connections.
+            conn.conn_kw['ssl_context'] = None
+            super().cert_verify(conn, url, verify, cert)
+            return
+
+        conn.conn_kw['ssl_context'] = self._ssl_context
+
+        # Certificates are already loaded into the context, urllib3 would
+        # load them into it again on every connection if paths were set.
+        conn.cert_reqs = 'CERT_REQUIRED' if verify else 'CERT_NONE'
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+        conn.cert_file = None
+        conn.key_file = None
+
+
+class ResolvingHTTPAdapter(TLSHTTPAdapter):
+
+    """HTTP adapter which resolves host names with the caching resolver and
+    races connection attempts to the resolved addresses.
+
+    """
+
+    def __init__(self, resolver, **kwargs):
+        """Constructor.
+
+        :param dns.CachingResolver resolver: resolver to use.
+        :param kwargs: HTTPAdapter keyword arguments.
+        """
+
+        self._resolver = resolver
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+
+        super().init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _make_pool_cls(connectionpool.HTTPConnectionPool,
+                                   self._resolver),
+            'https': _make_pool_cls(connectionpool.HTTPSConnectionPool,
+                                    self._resolver)}
+
+
+class UnixHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    """HTTP adapter sending requests to http+unix URLs over Unix domain
+    sockets.
+
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor.
+
+        :param kwargs: HTTPAdapter keyword arguments.
+        """
+
+        self._unix_pools = {}
+        super().__init__(**kwargs)
+
+    def get_connection(self, url, proxies=None):
+
+        socket_path, _ = transport.split_unix_url(url)
+        pool = self._unix_pools.get(socket_path)
+        if pool is None:
+            pool = UnixHTTPConnectionPool(socket_path,
+                                          maxsize=self._pool_maxsize,
+                                          block=self._pool_block)
+            self._unix_pools[socket_path] = pool
+
+        return pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                        cert=None):
+
+        return self.get_connection(request.url, proxies)
+
+    def request_url(self, request, proxies):
+
+        return request.path_url
+
+    def close(self):
+
+        super().close()
+        for pool in self._unix_pools.values():
+            pool.close()
+        self._unix_pools.clear()
+
+
+class UnixHTTPConnection(urllib3_connection.HTTPConnection):
+
+    """HTTP connection over Unix domain socket."""
+
+    def __init__(self, *args, socket_path, **kwargs):
+
+        self._socket_path = socket_path
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(self.timeout)
+            sock.connect(self._socket_path)
+        except socket.timeout:
+            sock.close()
+            raise urllib3_exceptions.ConnectTimeoutError(
+                self, 'Connection to %s timed out. (connect timeout=%s)' %
+                (self._socket_path, self.timeout))
+        except OSError as err:
+            sock.close()
+            raise urllib3_exceptions.NewConnectionError(
+                self, 'Failed to establish a new connection: %s' % err)
+
+        return sock
+
+
+class UnixHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+
+    """Pool of connections to Unix domain socket."""
+
+    ConnectionCls = UnixHTTPConnection
+
+    def __init__(self, socket_path, **kwargs):
+        """Constructor.
+
+        :param str socket_path: Unix domain socket path.
+        :param kwargs: HTTPConnectionPool keyword arguments.
+        """
+
+        super().__init__(transport.UNIX_HOST, **kwargs)
+        self.conn_kw['socket_path'] = socket_path
+
+
+class MemoryHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    """HTTP adapter serving requests to memory URLs with in-memory
+    transport.
+
+    """
+
+    def __init__(self, memory_transport, **kwargs):
+        """Constructor.
+
+        :param transport.MemoryTransport memory_transport: transport.
+        :param kwargs: HTTPAdapter keyword arguments.
+        """
+
+        self._memory_transport = memory_transport
+        super().__init__(**kwargs)
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+
+        try:
+            response = self._memory_transport.handle(
+                request.method, request.url, request.headers, request.body)
+        except OSError as err:
+            raise requests.exceptions.ConnectionError(
+                err, request=request) from None
+
+        return self.build_response(request, urllib3_response.HTTPResponse(
+            body=io.BytesIO(response.body), headers=response.headers,
+            status=response.code, reason=response.reason,
+            preload_content=False, decode_content=False))
+
+
+def _make_pool_cls(pool_cls, resolver):
+    """Make connection pool class whose connections use given resolver.
+
+    :param type pool_cls: urllib3 connection pool class.
+    :param dns.CachingResolver resolver: resolver to use.
+
+    :rtype: type
+    """
+
+    class ResolvingConnection(pool_cls.ConnectionCls):
+
+        def _new_conn(self):
+
+            extra_kw = {}
+            if self.source_address:
+                extra_kw['source_address'] = self.source_address
+            if getattr(self, 'socket_options', None):
+                extra_kw['socket_options'] = self.socket_options
+
+            try:
+                return dns.create_connection(
+                    resolver, (getattr(self, '_dns_host', self.host),
+                               self.port), self.timeout, **extra_kw)
+            except socket.timeout:
+                raise urllib3_exceptions.ConnectTimeoutError(
+                    self, 'Connection to %s timed out. (connect timeout=%s)' %
+                    (self.host, self.timeout))
+            except OSError as err:
+                raise urllib3_exceptions.NewConnectionError(
+                    self, 'Failed to establish a new connection: %s' % err)
+
+    return type('Resolving' + pool_cls.__name__, (pool_cls,),
+                {'ConnectionCls': ResolvingConnection})
+
+
+def _sleep(seconds, cancel_token):
+    """Sleep unless request is cancelled meanwhile.
+
+    :param int|float seconds: time to sleep.
+    :param cancel.CancelToken|None cancel_token: cancellation token.
+
+    :raise: RequestCancelled
+    """
+
+    if cancel_token is None:
+        time.sleep(seconds)
+    else:
+        cancel_token.sleep(seconds)
+
+
+def _abort_response(response):
+    """Shut down connection of streamed response, so that body read blocked
+    in another thread returns right away.
+
+    :param requests.models.Response response: streamed response.
+    """
+
+    # Connection is only available until the body is read.
+    sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock is None:
+        return
+
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # already closed
@@ -0,0 +1,196 @@
+"""Shared TLS configuration: SSL context with session resumption and
+certificate file watching.
+"""
+
+__author__ = 'vovanec@gmail.com'
+
+import os
+import ssl
+import threading
+import time
+
+
+DEF_CERT_WATCH_INTERVAL = 30
+
+# ssl module supports client side session reuse since Python 3.6.
+SESSION_RESUMPTION_SUPPORTED = hasattr(ssl.SSLSocket, 'session')
+
+
+class ResumingSSLSocket(ssl.SSLSocket):
+
+    """Client socket of ResumingSSLContext. TLS 1.3 servers send session
+    tickets after the handshake, and they are processed as data is read,
+    so session is saved again once data was first read.
+
+    """
+
+    _session_key = None
+
+    def read(self, *args, **kwargs):
+
+        data = super().read(*args, **kwargs)
+
+        key, self._session_key = self._session_key, None
+        if key is not None:
+            self.context._save_session(key, self)
+
+        return data
+
+
+class ResumingSSLContext(ssl.SSLContext):
+
+    """SSL context which remembers TLS session of the last connection to
+    each server and resumes it on the next connection, saving full
+    handshake.
+
+    """
+
+    # Python 3.6 has no socket class hook, see wrap_socket().
+    sslsocket_class = ResumingSSLSocket
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__()
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def wrap_socket(self, sock, *args, server_hostname=None, **kwargs):
+
+        key = None
+        if SESSION_RESUMPTION_SUPPORTED and not kwargs.get('server_side'):
+            try:
+                address = sock.getpeername()
+                key = (server_hostname or address[0], address[1])
+            except (OSError, IndexError, TypeError):
+                pass  # not connected or not an IP socket
+
+            if key is not None and kwargs.get('session') is None:
+                with self._sessions_lock:
+                    kwargs['session'] = self._sessions.get(key)
+
+        ssl_sock = super().wrap_socket(
+            sock, *args, server_hostname=server_hostname, **kwargs)
+
+        if key is not None:
+            if not isinstance(ssl_sock, ResumingSSLSocket):
+                ssl_sock.__class__ = ResumingSSLSocket
+            ssl_sock._session_key = key
+            self._save_session(key, ssl_sock)
+
+        return ssl_sock
+
+    def _save_session(self, key, ssl_sock):
+
+        # None once connection is closed.
+        session = ssl_sock.session
+        if session is not None:
+            with self._sessions_lock:
+                self._sessions[key] = session
+
+    def clear_sessions(self):
+        """Forget remembered sessions."""
+
+        with self._sessions_lock:
+            self._sessions.clear()
+
+
+def make_ssl_context(client_cert=None, client_key=None, verify_cert=True,
+                     ca_certs=None, check_hostname=True):
+    """Make client SSL context. Certificate files are read once here rather
+    than on every new connection.
+
+    :param str|None client_cert: client certificate.
+    :param str|None client_key: client key.
+    :param bool verify_cert: whether to verify server cert.
+    :param str|None ca_certs: path to CA certificate chain or directory, if
+           None - system default CA certificates.
+    :param bool check_hostname: whether ssl module is to match server
+           certificate against host name, rather than the HTTP client.
+
+    :rtype: ResumingSSLContext
+    :raise: OSError, ssl.SSLError
+    """
+
+    if hasattr(ssl, 'PROTOCOL_TLS_CLIENT'):
+        context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    else:
+        context = ResumingSSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= (ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 |
+                            ssl.OP_NO_COMPRESSION)
+
+    if verify_cert:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = check_hostname
+        if ca_certs and os.path.isdir(ca_certs):
+            context.load_verify_locations(capath=ca_certs)
+        elif ca_certs:
+            context.load_verify_locations(ca_certs)
+        else:
+            context.load_default_certs()
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    if client_cert:
+        context.load_cert_chain(client_cert, client_key)
+
+    return context
+
+
+class CertWatcher(object):
+
+    """Detect changes of certificate files by their modification time.
+    Files are checked at most once per interval.
+
+    """
+
+    def __init__(self, paths, interval=DEF_CERT_WATCH_INTERVAL):
+        """Constructor.
+
+        :param list[str|None] paths: files to watch, None entries are
+               skipped.
+        :param int|float interval: minimum time between checks.
+        """
+
+        self.paths = [path for path in paths if path]
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._checked = self._time()
+        self._stamps = self._stat()
+
+    def changed(self):
+        """Check if any of files changed since the last check.
+
+        :rtype: bool
+        """
+
+        now = self._time()
+        with self._lock:
+            if now - self._checked < self.interval:
+                return False
+
+            self._checked = now
+            stamps = self._stat()
+            if stamps == self._stamps:
+                return False
+
+            self._stamps = stamps
+            return True
+
+    def _stat(self):
+
+        stamps = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stamps.append((st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                stamps.append(None)
+
+        return stamps
+
+    @staticmethod
+    def _time():
+
+        return time.monotonic()
@@ -0,0 +1,151 @@
+"""Non-TCP transports, selected by API base URL scheme.
+
+* ``http+unix://`` - HTTP over Unix domain socket. Socket path is the
+  percent-encoded host part of the URL, e.g.
+  ``http+unix://%2Frun%2Fproxy.sock/api/v1``.
+* ``memory://`` - requests are served in process by a Python handler, with
+  no network involved, e.g. ``memory://api/v1``.
+
+Any other base URL is requested over TCP by the engine's HTTP client.
+"""
+
+__author__ = 'vovanec@gmail.com'
+
+import collections
+import functools
+import http.client
+import urllib.parse
+
+from ..httputil import CHUNK_SIZE
+
+
+UNIX_SCHEME = 'http+unix'
+MEMORY_SCHEME = 'memory'
+
+# Host name put into requests sent over Unix domain socket.
+UNIX_HOST = 'localhost'
+
+
+MemoryRequest = collections.namedtuple(
+    'MemoryRequest', ['method', 'url', 'path', 'headers', 'body'])
+
+MemoryResponse = collections.namedtuple(
+    'MemoryResponse', ['code', 'reason', 'headers', 'body'])
+
+
+def scheme(url):
+    """Get URL scheme.
+
+    :param str url: absolute URL.
+
+    :rtype: str
+    """
+
+    return urllib.parse.urlsplit(url).scheme.lower()
+
+
+def is_tcp(url):
+    """Check if URL is requested over TCP.
+
+    :param str url: absolute URL.
+
+    :rtype: bool
+    """
+
+    return scheme(url) not in (UNIX_SCHEME, MEMORY_SCHEME)
+
+
+def split_unix_url(url):
+    """Split http+unix URL into socket path and URL to request over the
+    socket.
+
+    :param str url: http+unix URL.
+
+    :return: (socket path, http URL) tuple.
+    :rtype: tuple[str, str]
+    :raise: ValueError
+    """
+
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme.lower() != UNIX_SCHEME or not parsed.netloc:
+        raise ValueError('Not a Unix domain socket URL: %s' % (url,))
+
+    return (urllib.parse.unquote(parsed.netloc),
+            urllib.parse.urlunsplit(('http', UNIX_HOST, parsed.path,
+                                     parsed.query, '')))
+
+
+def unix_url(socket_path, path=''):
+    """Make http+unix URL.
+
+    :param str socket_path: Unix domain socket path.
+    :param str path: URL path.
+
+    :rtype: str
+    """
+
+    return '%s://%s%s' % (UNIX_SCHEME,
+                          urllib.parse.quote(socket_path, safe=''), path)
+
+
+def read_all(data):
+    """Read whole request body.
+
+    :param object data: bytes, str, file object or iterable of bytes.
+
+    :rtype: bytes
+    """
+
+    if data is None:
+        return b''
+    elif isinstance(data, str):
+        return data.encode()
+    elif isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    elif hasattr(data, 'read'):
+        data = iter(functools.partial(data.read, CHUNK_SIZE), data.read(0))
+
+    return b''.join(chunk.encode() if isinstance(chunk, str) else chunk
+                    for chunk in data)
+
+
+class MemoryTransport(object):
+
+    """Serve requests with a Python handler, without network. Lets engine
+    overhead be measured apart from the network and servers be faked in
+    tests.
+
+    Handler is called with MemoryRequest and returns (code, headers, body)
+    tuple. Raising OSError from handler simulates connection failure.
+
+    """
+
+    def __init__(self, handler):
+        """Constructor.
+
+        :param MemoryRequest -> tuple handler: request handler.
+        """
+
+        self._handler = handler
+
+    def handle(self, method, url, headers, body):
+        """Serve request.
+
+        :param str method: request method.
+        :param str url: request URL.
+        :param collections.Mapping headers: request headers.
+        :param object body: request body.
+
+        :rtype: MemoryResponse
+        :raise: OSError
+        """
+
+        parsed = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parsed.path or '/',
+                                        parsed.query, ''))
+
+        code, resp_headers, resp_body = self._handler(MemoryRequest(
+            method, url, path, dict(headers or {}), read_all(body)))
+
+        return MemoryResponse(code, http.client.responses.get(code, ''),
+                              dict(resp_headers or {}), read_all(resp_body))
@@ -0,0 +1,103 @@
+"""Unit test for httputil.aio module. Asynchronous generators are a
+syntax error before Python 3.6, so test_aio imports this module only on
+Python 3.6+.
+"""
+
+__author__ = 'vovanec@gmail.com'
+
+
+import asyncio
+import os
+import unittest
+
+import httputil
+from httputil import aio
+from httputil import records
+
+from test_httputil import CONTENT_FILES
+from test_httputil import MY_DIR
+from test_httputil import split_pieces
+
+
+class TestAsyncHTTPUtil(unittest.TestCase):
+
+    def setUp(self):
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def _read(self, *args, **kwargs):
+
+        async def read():
+            return b''.join([block async for block in
+                             aio.aread_body_stream(*args, **kwargs)])
+
+        return self.loop.run_until_complete(read())
+
+    def test_aread_stream_reader(self):
+
+        for fname, chunked, compression in CONTENT_FILES:
+            file_path = os.path.join(MY_DIR, 'http_content', fname)
+            with self.subTest(fname):
+                with open(file_path, 'rb') as fh:
+                    reader = asyncio.StreamReader(loop=self.loop)
+                    reader.feed_data(fh.read())
+                    reader.feed_eof()
+                with open(file_path + '.expected', 'rb') as fh:
+                    expected = fh.read()
+
+                self.assertEqual(self._read(reader, chunked=chunked,
+                                            compression=compression),
+                                 expected)
+
+    def test_aread_async_iterator(self):
+
+        async def pieces(data, size=101):
+            for i in range(0, len(data), size):
+                await asyncio.sleep(0)
+                yield data[i:i + size]
+
+        for fname, chunked, compression in CONTENT_FILES:
+            file_path = os.path.join(MY_DIR, 'http_content', fname)
+            with self.subTest(fname):
+                with open(file_path, 'rb') as fh:
+                    data = fh.read()
+                with open(file_path + '.expected', 'rb') as fh:
+                    expected = fh.read()
+
+                # decompress every block in executor
+                self.assertEqual(self._read(pieces(data), chunked=chunked,
+                                            compression=compression,
+                                            offload_size=1),
+                                 expected)
+
+    def test_aread_errors(self):
+
+        async def truncated():
+            yield b'a\r\n01234'
+
+        with self.assertRaises(httputil.DechunkError):
+            self._read(truncated(), chunked=True)
+
+        with self.assertRaises(TypeError):
+            self._read([b'data'])
+
+    def test_aparse_records(self):
+
+        async def pieces():
+            for piece in split_pieces(b'{"a": 1}\n{"a": 2}\n{"a": 3}\n', 5):
+                await asyncio.sleep(0)
+                yield piece
+
+        async def parse():
+            return [batch async for batch in aio.aparse_records(
+                aio.aread_body_stream(pieces()),
+                records.NDJSONParser(), batch_size=2)]
+
+        self.assertEqual(self.loop.run_until_complete(parse()),
+                         [[{'a': 1}, {'a': 2}], [{'a': 3}]])
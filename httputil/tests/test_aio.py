@@ -0,0 +1,19 @@
+"""Unit test for httputil.aio module, Python 3.6+ only.
+"""
+
+__author__ = 'vovanec@gmail.com'
+
+
+import sys
+import unittest
+
+
+if sys.version_info < (3, 6):
+    raise unittest.SkipTest('requires Python 3.6+')
+
+
+from aio_cases import TestAsyncHTTPUtil  # noqa
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,11 +4,15 @@
 __author__ = 'vovanec@gmail.com'
 
 
+import gzip
 import inspect
+import io
 import os
 import unittest
+import zlib
 
 import httputil
+from httputil import records
 
 
 MY_DIR = os.path.dirname(os.path.abspath(
@@ -51,6 +55,173 @@ class TestHTTPUtil(unittest.TestCase):
                 fh, chunked=False, compression=None))
             self.assertEqual(expected_content, content)
 
+    def test_encode_body_stream(self):
+
+        for fname, chunked, compression in CONTENT_FILES:
+            file_path = os.path.join(MY_DIR, 'http_content', fname)
+            with self.subTest(fname):
+                with open(file_path + '.expected', 'rb') as fh:
+                    expected = fh.read()
+
+                with open(file_path + '.expected', 'rb') as fh:
+                    encoded = b''.join(httputil.encode_body_stream(
+                        fh, chunked=chunked, compression=compression))
+
+                content = b''.join(httputil.read_body_stream(
+                    io.BytesIO(encoded), chunked=chunked,
+                    compression=compression))
+                self.assertEqual(content, expected)
+
+    def test_encode_coalesce(self):
+
+        blocks = list(httputil.encode_body_stream(
+            [b'x'] * 1000, chunked=True, compression=None, chunk_size=300))
+
+        self.assertEqual(blocks, [b'12c\r\n' + b'x' * 300 + b'\r\n'] * 3 +
+                         [b'64\r\n' + b'x' * 100 + b'\r\n', b'0\r\n\r\n'])
+
+    def test_encode_flush(self):
+
+        def chunks():
+            yield b'hello'
+            yield httputil.FLUSH
+            yield b'world'
+
+        encoder = httputil.encode_body_stream(
+            chunks(), chunked=False, compression=httputil.DEFLATE)
+
+        decompressor = zlib.decompressobj()
+        self.assertEqual(decompressor.decompress(next(encoder)), b'hello')
+        self.assertEqual(decompressor.decompress(b''.join(encoder)),
+                         b'world')
+
+    def test_stream_decompressor(self):
+
+        file_path = os.path.join(MY_DIR, 'http_content', 'gzipped')
+        with open(file_path, 'rb') as fh:
+            compressed = fh.read()
+        with open(file_path + '.expected', 'rb') as fh:
+            expected = fh.read()
+
+        compression = httputil.compression_from_header('x-gzip')
+        decompressor = httputil.StreamDecompressor(compression)
+        content = b''.join(decompressor.decompress(compressed[i:i + 100])
+                           for i in range(0, len(compressed), 100))
+        self.assertEqual(content + decompressor.flush(), expected)
+
+        with self.assertRaises(httputil.DecompressError):
+            httputil.StreamDecompressor(httputil.GZIP).decompress(b'garbage')
+
+        # raw deflate with the first block shorter than zlib header
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        compressed = compressor.compress(expected) + compressor.flush()
+        decompressor = httputil.StreamDecompressor(httputil.DEFLATE)
+        content = decompressor.decompress(compressed[:1])
+        content += decompressor.decompress(compressed[1:])
+        self.assertEqual(content + decompressor.flush(), expected)
+
+    def test_compression_from_header(self):
+
+        self.assertIsNone(httputil.compression_from_header(None))
+        self.assertIsNone(httputil.compression_from_header('identity'))
+        self.assertEqual(httputil.compression_from_header('Deflate'),
+                         httputil.DEFLATE)
+        with self.assertRaises(TypeError):
+            httputil.compression_from_header('br')
+
+
+def split_pieces(data, size):
+
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestRecords(unittest.TestCase):
+
+    NDJSON = ('{"id": 1, "name": "\u00e9t\u00e9"}\n\n{"id": 2}\r\n'
+              '{"id": 3}').encode()
+
+    def test_ndjson(self):
+
+        expected = [{'id': 1, 'name': '\u00e9t\u00e9'}, {'id': 2},
+                    {'id': 3}]
+
+        # records and multi-byte characters split across blocks
+        for size in (1, 3, 7, len(self.NDJSON)):
+            with self.subTest(size):
+                self.assertEqual(list(records.parse_records(
+                    split_pieces(self.NDJSON, size),
+                    records.NDJSONParser())), expected)
+
+    def test_read_ndjson(self):
+
+        stream = io.BytesIO(gzip.compress(self.NDJSON))
+        self.assertEqual(
+            list(records.read_ndjson(stream, compression=httputil.GZIP,
+                                     batch_size=2)),
+            [[{'id': 1, 'name': '\u00e9t\u00e9'}, {'id': 2}], [{'id': 3}]])
+
+    def test_json_seq(self):
+
+        data = b'\x1e{"a": 1}\n\x1e[1, 2]\n\x1e"text"\n'
+        for size in (1, 5, len(data)):
+            with self.subTest(size):
+                self.assertEqual(list(records.parse_records(
+                    split_pieces(data, size), records.JSONSeqParser())),
+                    [{'a': 1}, [1, 2], 'text'])
+
+    def test_csv(self):
+
+        data = (b'id,comment\r\n1,"multi\r\nline, ""quoted"""\r\n'
+                b'2,plain\r\n3,"last"')
+        for size in (1, 4, 9, len(data)):
+            with self.subTest(size):
+                self.assertEqual(list(records.parse_records(
+                    split_pieces(data, size),
+                    records.CSVParser(header=True))),
+                    [{'id': '1', 'comment': 'multi\r\nline, "quoted"'},
+                     {'id': '2', 'comment': 'plain'},
+                     {'id': '3', 'comment': 'last'}])
+
+        self.assertEqual(list(records.read_csv(io.BytesIO(b'a;b\nc;d\n'),
+                                               delimiter=';')),
+                         [['a', 'b'], ['c', 'd']])
+
+        data = b"1,'multi\nline'\n2,\"x\n"
+        for size in (1, 4, len(data)):
+            with self.subTest(size):
+                self.assertEqual(list(records.parse_records(
+                    split_pieces(data, size),
+                    records.CSVParser(quotechar="'"))),
+                    [['1', 'multi\nline'], ['2', '"x']])
+
+    def test_errors(self):
+
+        with self.assertRaises(records.RecordError):
+            list(records.parse_records([b'{"a": 1}\n{"a"\n'],
+                                       records.NDJSONParser()))
+
+        parser = records.NDJSONParser(max_record_size=4)
+        parser.feed(b'{"a"')
+        with self.assertRaises(records.RecordError):
+            parser.feed(b': 1')
+
+        parser = records.NDJSONParser(max_record_size=4)
+        with self.assertRaises(records.RecordError):
+            parser.feed(b'1\n{"a": 1')
+
+    def test_record_callback(self):
+
+        batches = []
+        callback = records.RecordCallback(records.NDJSONParser(),
+                                          batches.append, batch_size=2)
+        for piece in split_pieces(b'1\n2\n3\n4\n5', 3):
+            callback(piece)
+        self.assertEqual(batches, [[1, 2], [3, 4]])
+
+        callback.close()
+        self.assertEqual(batches, [[1, 2], [3, 4], [5]])
+        self.assertEqual(callback.count, 5)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,9 +5,27 @@ These tests require VMock library to be installed.
 
 __author__ = 'vovanec@gmail.com'
 
+import asyncio
+import errno
+import gzip
+import http.server
+import io
 import json
 import http.client
+import os
+import pycurl
+import random
+import re
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import time
+import threading
 import unittest
+import unittest.mock
 import vmock
 import vmock.matchers
 from urllib.parse import urljoin
@@ -16,15 +34,36 @@ import requests.exceptions
 import requests.models
 import requests.sessions
 import tornado.testing
+import tornado.concurrent
+import tornado.gen
 import tornado.httpclient
 import tornado.curl_httpclient
+import tornado.ioloop
+import tornado.iostream
+from tornado.platform import asyncio as tornado_asyncio
 
+from httputil import request_engines
+from httputil import records
 from httputil.request_engines import async
+from httputil.request_engines import balancer
 from httputil.request_engines import base
+from httputil.request_engines import body
+from httputil.request_engines import cancel
+from httputil.request_engines import dns
 from httputil.request_engines import errors
+from httputil.request_engines import limits
+from httputil.request_engines import ratelimit
+from httputil.request_engines import response
+from httputil.request_engines import scheduler
 from httputil.request_engines import sync
+from httputil.request_engines import tls
+from httputil.request_engines import transport
 
 
+CERTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'certs')
+CERT_FILE = os.path.join(CERTS_DIR, 'cert.pem')
+KEY_FILE = os.path.join(CERTS_DIR, 'key.pem')
+
 CURL_ERROR = 599
 BASE_URL = 'http://api.com/'
 CONNECT_TIMEOUT = 3
@@ -35,10 +74,11 @@ class FakeResponse(object):
 
     """Fake requests.Response."""
 
-    def __init__(self, status_code, content=None):
+    def __init__(self, status_code, content=None, headers=None):
 
         self.status_code = status_code
         self.content = content
+        self.headers = headers or {}
 
 
 class TestMakeURL(unittest.TestCase):
@@ -57,6 +97,378 @@ class TestMakeURL(unittest.TestCase):
                 self._engine._make_full_url(rel_url), expected_full_url)
 
 
+class FakeResolver(dns.CachingResolver):
+
+    """Resolver with fake clock and address lookup."""
+
+    def __init__(self, results, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.now = 0
+        self.lookups = 0
+        self._results = results
+
+    def _getaddrinfo(self, host, port, family, sock_type):
+
+        self.lookups += 1
+        result = self._results[host]
+        if isinstance(result, Exception):
+            raise result
+
+        return [(family, sock_type, 0, '', (addr, port))
+                for family, addr in result]
+
+    def _time(self):
+
+        return self.now
+
+
+class TestCachingResolver(unittest.TestCase):
+
+    def setUp(self):
+
+        self.resolver = FakeResolver(
+            {'api.com': [(socket.AF_INET, '10.0.0.1'),
+                         (socket.AF_INET, '10.0.0.2'),
+                         (socket.AF_INET6, '::1')],
+             'bad.com': socket.gaierror('Name or service not known')},
+            ttl=10, negative_ttl=2)
+
+    def test_ttl(self):
+
+        expected = [(socket.AF_INET, ('10.0.0.1', 80)),
+                    (socket.AF_INET6, ('::1', 80)),
+                    (socket.AF_INET, ('10.0.0.2', 80))]
+
+        self.assertEqual(self.resolver.resolve('api.com', 80), expected)
+        self.resolver.now = 9
+        self.assertEqual(self.resolver.resolve('api.com', 80), expected)
+        self.assertEqual(self.resolver.lookups, 1)
+
+        self.resolver.now = 10
+        self.assertIsNone(self.resolver.cached('api.com', 80))
+        self.resolver.resolve('api.com', 80)
+        self.assertEqual(self.resolver.lookups, 2)
+
+    def test_negative_ttl(self):
+
+        for now in (0, 1, 2):
+            self.resolver.now = now
+            with self.assertRaises(socket.gaierror):
+                self.resolver.resolve('bad.com', 80)
+
+        self.assertEqual(self.resolver.lookups, 2)
+
+    def test_invalidate(self):
+
+        self.resolver.resolve('api.com', 80)
+        self.resolver.invalidate('api.com')
+        self.resolver.resolve('api.com', 80)
+        self.assertEqual(self.resolver.lookups, 2)
+
+    def test_create_connection(self):
+
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        good_port = server.getsockname()[1]
+
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        bad_port = closed.getsockname()[1]
+        closed.close()
+
+        resolver = dns.CachingResolver()
+        resolver.resolve = lambda host, port: [
+            (socket.AF_INET, ('127.0.0.1', bad_port)),
+            (socket.AF_INET, ('127.0.0.1', good_port))]
+
+        sock = dns.create_connection(resolver, ('api.com', good_port), 3)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', good_port))
+        self.assertEqual(sock.gettimeout(), 3)
+
+    def test_create_connection_immediate_failure(self):
+
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+
+        connect_ex = socket.socket.connect_ex
+
+        def fail_unroutable(sock, sockaddr):
+            if sockaddr[0] == '192.0.2.1':
+                return errno.ENETUNREACH
+            return connect_ex(sock, sockaddr)
+
+        resolver = dns.CachingResolver()
+        resolver.resolve = lambda host, port: [
+            (socket.AF_INET, ('192.0.2.1', port)),
+            (socket.AF_INET, ('127.0.0.1', port))]
+
+        with unittest.mock.patch.object(dns.socket.socket, 'connect_ex',
+                                        fail_unroutable):
+            sock = dns.create_connection(resolver, ('api.com', port), 3)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', port))
+
+
+class TestEngineRegistry(unittest.TestCase):
+
+    def test_get_engine_class(self):
+
+        self.assertIs(request_engines.get_engine_class('sync'),
+                      sync.SyncRequestEngine)
+        self.assertIs(request_engines.get_engine_class('async'),
+                      async.AsyncRequestEngine)
+
+    def test_create_engine(self):
+
+        request_engines.register_engine(
+            'base', 'httputil.request_engines.base.BaseRequestEngine')
+        self.addCleanup(request_engines.ENGINES.pop, 'base')
+
+        engine = request_engines.create_engine('base', BASE_URL, 3, 3, None)
+        self.assertIsInstance(engine, base.BaseRequestEngine)
+
+        with self.assertRaises(KeyError):
+            request_engines.create_engine('unknown', BASE_URL, 3, 3, None)
+
+    def test_no_side_effects(self):
+
+        self.assertIsNot(tornado.httpclient.AsyncHTTPClient.configured_class(),
+                         tornado.curl_httpclient.CurlAsyncHTTPClient)
+
+
+class TestBalancers(unittest.TestCase):
+
+    BASE_URLS = ['http://api1.com', 'http://api2.com', 'http://api3.com']
+
+    def test_round_robin(self):
+
+        bal = balancer.RoundRobinBalancer(self.BASE_URLS)
+        selected = []
+        for _ in range(6):
+            endpoint = bal.select()
+            bal.finish(endpoint, 0.1)
+            selected.append(endpoint.base_url)
+
+        self.assertEqual(selected, self.BASE_URLS * 2)
+
+    def test_least_outstanding(self):
+
+        bal = balancer.LeastOutstandingBalancer(self.BASE_URLS)
+        busy = [bal.select(), bal.select()]
+        self.assertEqual(bal.select().base_url, 'http://api3.com')
+
+        bal.finish(busy[1], 0.1)
+        self.assertEqual(bal.select().base_url, 'http://api2.com')
+
+    def test_power_of_two_choices(self):
+
+        bal = balancer.PowerOfTwoChoicesBalancer(self.BASE_URLS[:2])
+        slow, fast = bal.endpoints
+        bal.finish(bal.select(), 0)
+        bal.finish(bal.select(), 0)
+        slow.ewma, fast.ewma = 1.0, 0.01
+
+        for _ in range(10):
+            endpoint = bal.select()
+            self.assertIs(endpoint, fast)
+            bal.finish(endpoint, 0.01)
+
+    def test_exclude(self):
+
+        bal = balancer.RoundRobinBalancer(self.BASE_URLS[:2])
+        tried = {bal.endpoints[0]}
+        for _ in range(3):
+            self.assertIs(bal.select(tried), bal.endpoints[1])
+
+        tried = set(bal.endpoints)
+        self.assertFalse(bal.has_alternative(tried))
+        self.assertIn(bal.select(tried), bal.endpoints)
+
+    def test_cancelled(self):
+
+        bal = balancer.PowerOfTwoChoicesBalancer(self.BASE_URLS[:1],
+                                                 eject_after=2)
+        endpoint, = bal.endpoints
+        bal.finish(bal.select(), failed=True)
+        bal.finish(bal.select())
+
+        self.assertEqual((endpoint.outstanding, endpoint.failures), (0, 1))
+        self.assertIsNone(endpoint.last_update)
+
+    def test_ejection(self):
+
+        bal = balancer.RoundRobinBalancer(self.BASE_URLS[:2], eject_after=2,
+                                          eject_for=10)
+        bad, good = bal.endpoints
+        for _ in range(2):
+            bal.finish(bal.select({good}), failed=True)
+
+        for _ in range(4):
+            self.assertIs(bal.select(), good)
+
+        bad.ejected_until = 0
+        self.assertEqual({bal.select(), bal.select()}, {bad, good})
+
+
+class FakeClock(object):
+
+    """Fake monotonic clock."""
+
+    def __init__(self):
+
+        self.now = 0
+
+    def __call__(self):
+
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+
+        self.clock = FakeClock()
+        patcher = unittest.mock.patch.object(
+            ratelimit.TokenBucket, '_time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+
+        bucket = ratelimit.TokenBucket(10, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(), 0.2)
+
+        self.clock.now = 10
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_block(self):
+
+        bucket = ratelimit.TokenBucket(10, burst=5)
+        bucket.block(3)
+        self.assertEqual(bucket.reserve(), 3)
+        self.assertAlmostEqual(bucket.reserve(), 3.1)
+
+    def test_routes(self):
+
+        limiter = ratelimit.RateLimiter(
+            100, routes={'/search': (1, 1), '/search/fast': 50})
+
+        self.assertEqual(limiter.reserve('search'), 0)
+        self.assertEqual(limiter.reserve('/search'), 1)
+        self.assertEqual(limiter.reserve('/search/fast'), 0)
+        self.assertEqual(limiter.reserve('/other'), 0)
+
+    def test_routes_path_normalised(self):
+
+        for url in ('search', 'search?q=1', 'http://localhost:80/search/a',
+                    '//localhost/search'):
+            limiter = ratelimit.RateLimiter(routes={'/search': (1, 1)})
+            self.assertEqual(limiter.reserve(url), 0, url)
+            self.assertEqual(limiter.reserve(url), 1, url)
+
+        limiter = ratelimit.RateLimiter(routes={'/search': (1, 1)})
+        self.assertEqual(limiter.reserve('http://localhost/other'), 0)
+        self.assertEqual(limiter.reserve('http://localhost/other'), 0)
+
+    def test_adaptive_retry_after(self):
+
+        limiter = ratelimit.RateLimiter(10, adaptive=True)
+        limiter.update('/blah', http.client.TOO_MANY_REQUESTS,
+                       {'Retry-After': '5'})
+        self.assertEqual(limiter.reserve('/blah'), 5)
+
+    def test_adaptive_window(self):
+
+        limiter = ratelimit.RateLimiter(100, burst=1, adaptive=True)
+        limiter.reserve('/blah')
+        limiter.update('/blah', http.client.OK,
+                       {'X-RateLimit-Remaining': '20',
+                        'X-RateLimit-Reset': '2'})
+        self.assertAlmostEqual(limiter.reserve('/blah'), 0.1)
+
+        limiter.update('/blah', http.client.OK, {})
+        self.assertAlmostEqual(limiter.reserve('/blah'), 0.1)
+
+    def test_parse_retry_after(self):
+
+        self.assertEqual(ratelimit.parse_retry_after('120'), 120)
+        self.assertEqual(ratelimit.parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470), 10)
+        self.assertIsNone(ratelimit.parse_retry_after('soon'))
+
+
+class TestResponse(unittest.TestCase):
+
+    def test_header_lines(self):
+
+        resp = response.Response(200, [
+            'HTTP/1.1 301 Moved Permanently\r\n', 'Location: /new\r\n',
+            '\r\n', 'HTTP/1.1 200 OK\r\n', 'Content-Type: text/plain\r\n',
+            '\r\n'], b'body')
+
+        self.assertEqual(resp.headers['content-type'], 'text/plain')
+        self.assertIsNone(resp.headers.get('Location'))
+        self.assertEqual(resp.body, b'body')
+        self.assertIsInstance(resp.body, memoryview)
+
+    def test_decode(self):
+
+        resp = response.Response(
+            200, {'Content-Encoding': 'gzip'}, gzip.compress(b'body'))
+        self.assertEqual(resp.body, b'body')
+
+        resp = response.Response(200, {'Content-Encoding': 'br'}, b'body')
+        self.assertEqual(resp.raw, b'body')
+        with self.assertRaises(errors.MalformedResponse):
+            resp.body
+
+
+class TestStreamingBody(unittest.TestCase):
+
+    def test_file(self):
+
+        fh = io.BytesIO(b'skip' + b'x' * 100)
+        fh.read(4)
+        self.assertTrue(body.is_streaming(fh))
+
+        stream = body.StreamingBody(fh)
+        self.assertEqual(stream.size, 100)
+        self.assertTrue(stream.seekable)
+        self.assertEqual(b''.join(stream), b'x' * 100)
+
+        self.assertTrue(stream.rewind())
+        self.assertEqual(stream.read(10), b'x' * 10)
+
+    def test_iterator(self):
+
+        chunks = iter([b'abc', b'', 'def', b'ghij'])
+        self.assertTrue(body.is_streaming(chunks))
+
+        stream = body.StreamingBody(chunks)
+        self.assertIsNone(stream.size)
+        self.assertTrue(stream.rewind())
+        self.assertEqual([stream.read(2) for _ in range(6)],
+                         [b'ab', b'c', b'de', b'f', b'gh', b'ij'])
+        self.assertEqual(stream.read(2), b'')
+        self.assertFalse(stream.rewind())
+
+    def test_not_streaming(self):
+
+        for data in (None, b'data', 'data', {'key': 'value'}, [1, 2]):
+            self.assertFalse(body.is_streaming(data))
+
+
 class TestSyncClient(unittest.TestCase):
 
     """Test synchronous client."""
@@ -83,7 +495,8 @@ class TestSyncClient(unittest.TestCase):
                           **self.request_kwargs).returns(response)
 
         self.assertDictEqual(
-            self._engine.request('/blah', result_callback=json.loads), expected)
+            self._engine.request('/blah', result_callback=json.loads),
+            expected)
 
     def test_with_headers(self):
 
@@ -136,16 +549,45 @@ class TestSyncClient(unittest.TestCase):
         with self.assertRaises(errors.CommunicationError):
             self._engine.request('/blah', result_callback=json.loads)
 
+    def test_stream_file(self):
+
+        fh = io.BytesIO(b'data' * 1024)
+        self.request_kwargs['data'] = fh
+        self.mock_request('POST', urljoin(BASE_URL, '/blah'),
+                          **self.request_kwargs).returns(
+            FakeResponse(http.client.OK, b'ok'))
+
+        self.assertEqual(
+            self._engine.request('/blah', method='POST', data=fh), b'ok')
+
+    def test_retry_other_endpoint(self):
+
+        expected = {'status': 'ok'}
+        engine = sync.SyncRequestEngine(
+            ['http://api1.com', 'http://api2.com'], CONNECT_TIMEOUT,
+            REQUEST_TIMEOUT, 1)
+
+        self.mock_request('GET', 'http://api1.com/blah',
+                          **self.request_kwargs).raises(
+            requests.exceptions.ConnectionError('Connection refused'))
+        self.mock_request('GET', 'http://api2.com/blah',
+                          **self.request_kwargs).returns(
+            FakeResponse(http.client.OK, json.dumps(expected)))
+
+        self.assertDictEqual(
+            engine.request('/blah', result_callback=json.loads), expected)
+
 
 class FakeHTTPResponse(object):
 
     """Fake tornado.httpclient.HTTPResponse."""
 
-    def __init__(self, code, body=None, error=None):
+    def __init__(self, code, body=None, error=None, headers=None):
 
         self.code = code
         self.body = body
         self.error = error
+        self.headers = headers or {}
 
 
 def make_fetch_impl(code, body=None):
@@ -205,7 +647,8 @@ class TestAsyncClient(tornado.testing.AsyncTestCase):
             make_fetch_impl(http.client.OK, '--asdasd---'))
 
         with self.assertRaises(errors.MalformedResponse):
-            yield from self._engine.request('/blah', result_callback=json.loads)
+            yield from self._engine.request(
+                '/blah', result_callback=json.loads)
 
     @tornado.testing.gen_test
     def test_client_error(self):
@@ -228,7 +671,8 @@ class TestAsyncClient(tornado.testing.AsyncTestCase):
             make_fetch_impl(http.client.SERVICE_UNAVAILABLE))
 
         with self.assertRaises(errors.ServerError):
-            yield from self._engine.request('/blah', result_callback=json.loads)
+            yield from self._engine.request(
+                '/blah', result_callback=json.loads)
 
     @tornado.testing.gen_test
     def test_communication_error(self):
@@ -238,7 +682,1562 @@ class TestAsyncClient(tornado.testing.AsyncTestCase):
             make_fetch_impl(CURL_ERROR, 'No route to host'))
 
         with self.assertRaises(errors.CommunicationError):
-            yield from self._engine.request('/blah', result_callback=json.loads)
+            yield from self._engine.request(
+                '/blah', result_callback=json.loads)
+
+
+class FakeCurl(object):
+
+    """Fake pycurl.Curl recording options."""
+
+    def __init__(self):
+
+        self.options = {}
+
+    def setopt(self, option, value):
+
+        self.options[option] = value
+
+    def unsetopt(self, option):
+
+        self.options.pop(option, None)
+
+
+class TestCurlSetup(tornado.testing.AsyncTestCase):
+
+    @unittest.skipUnless(async.HTTP2_SUPPORTED, 'libcurl lacks HTTP/2')
+    def test_http2(self):
+
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None, http2=True)
+        self.assertIsNot(engine._client,
+                         tornado.curl_httpclient.CurlAsyncHTTPClient())
+
+        request = engine._prepare_request(BASE_URL, 'GET', None, None)
+        curl = FakeCurl()
+        request.prepare_curl_callback(curl)
+
+        self.assertEqual(curl.options[pycurl.HTTP_VERSION],
+                         pycurl.CURL_HTTP_VERSION_2_0)
+        self.assertEqual(curl.options[pycurl.PIPEWAIT], 1)
+
+    @unittest.skipUnless(async.HTTP2_SUPPORTED, 'libcurl lacks HTTP/2')
+    def test_http2_prior_knowledge(self):
+
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None, http2=True,
+                                          http2_prior_knowledge=True)
+
+        for url, version in [
+                (BASE_URL, pycurl.CURL_HTTP_VERSION_2_PRIOR_KNOWLEDGE),
+                ('https://api.com/', pycurl.CURL_HTTP_VERSION_2_0)]:
+            request = engine._prepare_request(url, 'GET', None, None)
+            curl = FakeCurl()
+            request.prepare_curl_callback(curl)
+            self.assertEqual(curl.options[pycurl.HTTP_VERSION], version)
+
+    def test_curl_multi(self):
+
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None)
+        self.assertIsInstance(async._curl_multi(engine._client),
+                              pycurl.CurlMulti)
+        with self.assertRaises(RuntimeError):
+            async._curl_multi(object())
+
+    def test_share_tls_sessions(self):
+
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None)
+        share = engine._curl_share
+
+        request = engine._prepare_request(BASE_URL, 'GET', None, None)
+        curl = FakeCurl()
+        request.prepare_curl_callback(curl)
+        self.assertIs(curl.options[pycurl.SHARE], share)
+
+        engine.reload_certs()
+        request = engine._prepare_request(BASE_URL, 'GET', None, None)
+        request.prepare_curl_callback(curl)
+        self.assertIsNot(curl.options[pycurl.SHARE], share)
+
+    @tornado.testing.gen_test
+    def test_pinned_addresses(self):
+
+        resolver = dns.CachingResolver()
+        resolver.cached = lambda host, port: [
+            (socket.AF_INET, ('10.0.0.1', port)),
+            (socket.AF_INET6, ('::1', port, 0, 0))]
+
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None,
+                                          resolver=resolver)
+        self.assertIsNot(engine._client,
+                         tornado.curl_httpclient.CurlAsyncHTTPClient())
+
+        request = engine._prepare_request(BASE_URL, 'GET', None, None)
+        yield from engine._pin_addresses(request)
+
+        curl = FakeCurl()
+        request.prepare_curl_callback(curl)
+        self.assertEqual(curl.options[pycurl.RESOLVE],
+                         ['api.com:80:10.0.0.1,[::1]'])
+
+        # Handle is reused by request which does not pin addresses.
+        request = engine._prepare_request(BASE_URL, 'GET', None, None)
+        request.prepare_curl_callback(curl)
+        self.assertEqual(curl.options[pycurl.RESOLVE], [])
+
+
+@unittest.skipUnless(async.HTTP2_SUPPORTED and shutil.which('nghttpd'),
+                     'libcurl lacks HTTP/2 or nghttpd is not installed')
+class TestHTTP2(tornado.testing.AsyncTestCase):
+
+    """Test HTTP/2 multiplexing against local nghttpd server."""
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.htdocs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.htdocs)
+        with open(os.path.join(self.htdocs, 'data'), 'wb') as fh:
+            fh.write(b'data')
+
+    def serve(self, *tls_files):
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        log = tempfile.TemporaryFile()
+        self.addCleanup(log.close)
+        args = ['nghttpd', '-v', '-d', self.htdocs]
+        if not tls_files:
+            args.append('--no-tls')
+        server = subprocess.Popen(args + [str(port)] + list(tls_files),
+                                  stdout=log, stderr=subprocess.STDOUT)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        return port, server, log
+
+    @staticmethod
+    def connections(server, log):
+
+        server.terminate()
+        server.wait()
+        log.seek(0)
+
+        # Connections requests were received on.
+        return set(re.findall(br'^\[id=(\d+)\][^\n]* recv HEADERS frame',
+                              log.read(), re.M))
+
+    @tornado.testing.gen_test
+    def test_prior_knowledge(self):
+
+        port, server, log = self.serve()
+        engine = async.AsyncRequestEngine(
+            'http://127.0.0.1:%d' % port, 3, 3, None, http2=True,
+            http2_prior_knowledge=True)
+
+        request = tornado.gen.coroutine(engine.request)
+        results = yield [request('/data') for _ in range(5)]
+
+        self.assertEqual(results, [b'data'] * 5)
+        self.assertEqual(len(self.connections(server, log)), 1)
+
+    @tornado.testing.gen_test
+    def test_tls(self):
+
+        port, server, log = self.serve(KEY_FILE, CERT_FILE)
+        engine = async.AsyncRequestEngine(
+            'https://127.0.0.1:%d' % port, 3, 3, None, http2=True,
+            ca_certs=CERT_FILE)
+
+        request = tornado.gen.coroutine(engine.request)
+        results = yield [request('/data') for _ in range(5)]
+
+        self.assertEqual(results, [b'data'] * 5)
+        self.assertEqual(len(self.connections(server, log)), 1)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    """Serve server.content supporting byte ranges if server.ranges is set.
+    Drop connection after server.fail_after bytes of full content response.
+    Change ETag to server.next_etag after HEAD request. Delay response to
+    server.held_range.
+    """
+
+    def do_HEAD(self):
+
+        self._respond(head=True)
+
+    def do_GET(self):
+
+        self._respond()
+
+    def _respond(self, head=False):
+
+        content = self.server.content
+        start, end = 0, len(content) - 1
+
+        range_value = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range != self.server.etag:
+            range_value = None
+
+        if self.server.ranges and range_value:
+            self.server.range_requests.append(range_value)
+            if range_value == self.server.held_range:
+                time.sleep(0.5)
+                self.server.range_requests.append('released')
+            first, _, last = range_value[len('bytes='):].partition('-')
+            start, end = int(first), int(last or end)
+            self.send_response(http.client.PARTIAL_CONTENT)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end, len(content)))
+        else:
+            self.send_response(self.server.code)
+
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if self.server.content_encoding:
+            self.send_header('Content-Encoding', self.server.content_encoding)
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if head:
+            if self.server.next_etag:
+                self.server.etag = self.server.next_etag
+            return
+
+        if start == 0 and self.server.fail_after:
+            self.wfile.write(content[:self.server.fail_after])
+            self.wfile.flush()
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # client has gone already
+            return
+
+        self.wfile.write(content[start:end + 1])
+
+    def log_message(self, *args):
+
+        pass
+
+
+class TestDownload(tornado.testing.AsyncTestCase):
+
+    """Test segmented downloads against local HTTP server."""
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), RangeRequestHandler)
+        self.server.daemon_threads = True
+        self.server.content = bytes(random.getrandbits(8)
+                                    for _ in range(10000))
+        self.server.code = http.client.OK
+        self.server.ranges = True
+        self.server.range_requests = []
+        self.server.held_range = None
+        self.server.etag = '"v1"'
+        self.server.next_etag = None
+        self.server.content_encoding = None
+        self.server.fail_after = None
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+        fd, self.dest = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.dest)
+
+    def assert_downloaded(self, size):
+
+        self.assertEqual(size, len(self.server.content))
+        with open(self.dest, 'rb') as fh:
+            self.assertEqual(fh.read(), self.server.content)
+
+    def test_sync_segments(self):
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+        self.assert_downloaded(engine.download(
+            '/file', self.dest, segments=3, segment_size=1000))
+        self.assertEqual(len(self.server.range_requests), 10)
+
+    def test_sync_no_ranges(self):
+
+        self.server.ranges = False
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+        self.assert_downloaded(engine.download('/file', self.dest))
+
+    def test_sync_no_validator(self):
+
+        self.server.etag = None
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+        self.assert_downloaded(engine.download(
+            '/file', self.dest, segments=3, segment_size=1000))
+        self.assertEqual(self.server.range_requests, [])
+
+    def test_sync_changed(self):
+
+        self.server.next_etag = '"v2"'
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+        with self.assertRaises(errors.ContentChangedError):
+            engine.download('/file', self.dest, segments=3,
+                            segment_size=1000)
+        self.assertEqual(self.server.range_requests, [])
+
+    def prepare_resume(self):
+
+        self.original = self.server.content
+        self.server.content = gzip.compress(self.original)
+        self.server.content_encoding = 'gzip'
+        self.server.fail_after = len(self.server.content) // 2
+
+    def test_sync_resume(self):
+
+        self.prepare_resume()
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+
+        blocks = []
+        engine.request('/file', streaming_callback=blocks.append)
+        self.assertEqual(b''.join(blocks), self.original)
+        self.assertEqual(self.server.range_requests,
+                         ['bytes=%d-' % self.server.fail_after])
+
+    def test_sync_resume_changed(self):
+
+        self.prepare_resume()
+        self.server.etag = None
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+
+        with self.assertRaises(errors.CommunicationError):
+            engine.request('/file', streaming_callback=lambda block: None)
+
+    @tornado.testing.gen_test
+    def test_async_resume(self):
+
+        self.prepare_resume()
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+
+        blocks = []
+        yield from engine.request('/file', streaming_callback=blocks.append)
+        self.assertEqual(b''.join(blocks), self.original)
+        self.assertEqual(self.server.range_requests,
+                         ['bytes=%d-' % self.server.fail_after])
+
+    def test_sync_error_body(self):
+
+        self.prepare_resume()
+        self.server.fail_after = None
+        self.server.code = http.client.NOT_FOUND
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+
+        with self.assertRaises(errors.ClientError) as ctx:
+            engine.request('/file', streaming_callback=lambda block: None)
+        self.assertEqual(ctx.exception.body, self.original)
+
+    @tornado.testing.gen_test
+    def test_async_error_body(self):
+
+        self.prepare_resume()
+        self.server.fail_after = None
+        self.server.code = http.client.NOT_FOUND
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+
+        with self.assertRaises(errors.ClientError) as ctx:
+            yield from engine.request('/file',
+                                      streaming_callback=lambda block: None)
+        self.assertEqual(ctx.exception.body, self.original)
+
+    def test_sync_response(self):
+
+        self.prepare_resume()
+        self.server.fail_after = None
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+
+        resp = engine.request('/file', return_response=True)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers['content-encoding'], 'gzip')
+        self.assertEqual(resp.raw, self.server.content)
+        self.assertEqual(resp.body, self.original)
+        self.assertGreater(resp.elapsed, 0)
+
+    @tornado.testing.gen_test
+    def test_async_response(self):
+
+        self.prepare_resume()
+        self.server.fail_after = None
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+
+        resp = yield from engine.request('/file', return_response=True)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers['content-encoding'], 'gzip')
+        self.assertEqual(resp.raw, self.server.content)
+        self.assertEqual(resp.body, self.original)
+        self.assertGreater(resp.elapsed, 0)
+
+    def test_sync_response_error(self):
+
+        self.prepare_resume()
+        self.server.fail_after = None
+        self.server.code = http.client.SERVICE_UNAVAILABLE
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, 1)
+
+        with self.assertRaises(errors.ServerError) as ctx:
+            engine.request('/file', return_response=True)
+        self.assertEqual(ctx.exception.body, self.original)
+
+    @tornado.testing.gen_test
+    def test_async_response_error(self):
+
+        self.prepare_resume()
+        self.server.fail_after = None
+        self.server.code = http.client.SERVICE_UNAVAILABLE
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+
+        with self.assertRaises(errors.ServerError) as ctx:
+            yield from engine.request('/file', return_response=True)
+        self.assertEqual(ctx.exception.body, self.original)
+
+    @tornado.testing.gen_test
+    def test_async_segments(self):
+
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+        self.assert_downloaded((yield from engine.download(
+            '/file', self.dest, segments=3, segment_size=1000)))
+        self.assertEqual(len(self.server.range_requests), 10)
+
+    @tornado.testing.gen_test
+    def test_async_segment_window(self):
+
+        self.server.held_range = 'bytes=0-999'
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+        self.assert_downloaded((yield from engine.download(
+            '/file', self.dest, segments=2, segment_size=1000)))
+
+        # The other segments were all fetched while the first one was held.
+        self.assertEqual(len(self.server.range_requests), 11)
+        self.assertEqual(self.server.range_requests[-1], 'released')
+
+    @tornado.testing.gen_test
+    def test_async_no_ranges(self):
+
+        self.server.ranges = False
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+        self.assert_downloaded((yield from engine.download(
+            '/file', self.dest)))
+
+    @tornado.testing.gen_test
+    def test_async_changed(self):
+
+        self.server.next_etag = '"v2"'
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, 1)
+        with self.assertRaises(errors.ContentChangedError):
+            yield from engine.download('/file', self.dest, segments=3,
+                                       segment_size=1000)
+        self.assertEqual(self.server.range_requests, [])
+
+
+class EchoRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    """Respond with JSON describing the request."""
+
+    def do_GET(self):
+
+        self._respond()
+
+    def do_POST(self):
+
+        self._respond()
+
+    def do_PUT(self):
+
+        self._respond()
+
+    def _respond(self):
+
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = self._read_chunked()
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            data = self.rfile.read(length)
+
+        content = json.dumps({
+            'method': self.command, 'path': self.path,
+            'host': self.headers.get('Host'),
+            'chunked': 'Content-Length' not in self.headers,
+            'body': data.decode()}).encode()
+
+        self.send_response(http.client.OK)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_chunked(self):
+
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if not size:
+                break
+
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+        while self.rfile.readline().strip():
+            pass  # trailers
+
+        return b''.join(chunks)
+
+    def log_message(self, *args):
+
+        pass
+
+
+def echo_handler(request):
+
+    if request.path == '/down':
+        raise ConnectionRefusedError('down')
+    elif request.path == '/missing':
+        return http.client.NOT_FOUND, {}, b'no such thing'
+
+    return http.client.OK, {'Content-Type': 'application/json'}, json.dumps({
+        'method': request.method, 'path': request.path,
+        'body': request.body.decode()})
+
+
+class TestTransports(tornado.testing.AsyncTestCase):
+
+    """Test Unix domain socket and in-memory transports."""
+
+    def setUp(self):
+
+        super().setUp()
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, tmp_dir)
+        socket_path = os.path.join(tmp_dir, 'api.sock')
+
+        server = socketserver.ThreadingUnixStreamServer(
+            socket_path, EchoRequestHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(os.unlink, socket_path)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.unix_url = transport.unix_url(socket_path, '/api')
+
+    def test_split_unix_url(self):
+
+        self.assertEqual(transport.split_unix_url(
+            'http+unix://%2Frun%2Fapi.sock/v1/items?a=1'),
+            ('/run/api.sock', 'http://localhost/v1/items?a=1'))
+        self.assertEqual(transport.unix_url('/run/api.sock', '/v1'),
+                         'http+unix://%2Frun%2Fapi.sock/v1')
+        with self.assertRaises(ValueError):
+            transport.split_unix_url('http://localhost/v1')
+
+    def test_sync_unix(self):
+
+        engine = sync.SyncRequestEngine(self.unix_url, 3, 3, 1)
+        self.assertEqual(
+            engine.request('/items?a=1', method='POST', data=b'data',
+                           result_callback=json.loads),
+            {'method': 'POST', 'path': '/api/items?a=1', 'body': 'data',
+             'host': 'localhost', 'chunked': False})
+
+    @tornado.testing.gen_test
+    def test_async_unix(self):
+
+        engine = async.AsyncRequestEngine(self.unix_url, 3, 3, 1)
+        result = yield from engine.request(
+            '/items', method='POST', data=b'data',
+            result_callback=json.loads)
+        self.assertEqual(result, {'method': 'POST', 'path': '/api/items',
+                                  'body': 'data', 'host': 'localhost',
+                                  'chunked': False})
+
+    def test_sync_memory(self):
+
+        engine = sync.SyncRequestEngine(
+            'memory://api', 3, 3, 0, memory_handler=echo_handler)
+
+        self.assertEqual(
+            engine.request('/items', method='POST', data=iter([b'da', b'ta']),
+                           result_callback=json.loads),
+            {'method': 'POST', 'path': '/items', 'body': 'data'})
+
+        blocks = []
+        engine.request('/items', streaming_callback=blocks.append)
+        self.assertEqual(json.loads(b''.join(blocks).decode())['method'],
+                         'GET')
+
+        with self.assertRaises(errors.ClientError) as ctx:
+            engine.request('/missing')
+        self.assertEqual(ctx.exception.body, b'no such thing')
+
+        with self.assertRaises(errors.CommunicationError):
+            engine.request('/down')
+
+    @tornado.testing.gen_test
+    def test_async_memory(self):
+
+        engine = async.AsyncRequestEngine(
+            'memory://api', 3, 3, 0, memory_handler=echo_handler)
+
+        result = yield from engine.request(
+            '/items', method='POST', data=io.BytesIO(b'data'),
+            result_callback=json.loads)
+        self.assertEqual(result, {'method': 'POST', 'path': '/items',
+                                  'body': 'data'})
+
+        blocks = []
+        yield from engine.request('/items', streaming_callback=blocks.append)
+        self.assertEqual(json.loads(b''.join(blocks).decode())['method'],
+                         'GET')
+
+        with self.assertRaises(errors.ClientError) as ctx:
+            yield from engine.request('/missing')
+        self.assertEqual(ctx.exception.body, b'no such thing')
+
+        with self.assertRaises(errors.CommunicationError):
+            yield from engine.request('/down')
+
+    @tornado.testing.gen_test
+    def test_memory_records(self):
+
+        def handler(_):
+            return http.client.OK, {'Content-Type': 'application/x-ndjson'}, \
+                b''.join(b'{"id": %d}\n' % (i,) for i in range(5))
+
+        expected = [[{'id': 0}, {'id': 1}], [{'id': 2}, {'id': 3}],
+                    [{'id': 4}]]
+
+        batches = []
+        on_body = records.RecordCallback(records.NDJSONParser(),
+                                         batches.append, batch_size=2)
+        engine = sync.SyncRequestEngine(
+            'memory://api', 3, 3, 0, memory_handler=handler)
+        engine.request('/export', streaming_callback=on_body)
+        on_body.close()
+        self.assertEqual(batches, expected)
+
+        batches = []
+        on_body = records.RecordCallback(records.NDJSONParser(),
+                                         batches.append, batch_size=2)
+        engine = async.AsyncRequestEngine(
+            'memory://api', 3, 3, 0, memory_handler=handler)
+        yield from engine.request('/export', streaming_callback=on_body)
+        on_body.close()
+        self.assertEqual(batches, expected)
+
+    def test_memory_handler_required(self):
+
+        with self.assertRaises(ValueError):
+            sync.SyncRequestEngine('memory://api', 3, 3, 1)
+
+
+class AsyncBlocks(object):
+
+    """Async iterator over data blocks."""
+
+    def __init__(self, blocks, loop):
+
+        self.blocks = list(blocks)
+        self.loop = loop
+
+    def __aiter__(self):
+
+        return self
+
+    def __anext__(self):
+
+        future = asyncio.Future(loop=self.loop)
+        if self.blocks:
+            self.loop.call_later(0.01, future.set_result, self.blocks.pop(0))
+        else:
+            future.set_exception(StopAsyncIteration())
+
+        return future
+
+
+class TestStreamingUpload(tornado.testing.AsyncTestCase):
+
+    """Test request bodies streamed by async engine."""
+
+    def setUp(self):
+
+        super().setUp()
+
+        server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), EchoRequestHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.engine = async.AsyncRequestEngine(
+            'http://127.0.0.1:%d' % server.server_address[1], 3, 3, None)
+
+    def get_new_ioloop(self):
+
+        return tornado_asyncio.AsyncIOLoop()
+
+    def upload(self, data, method='POST'):
+
+        return self.engine.request('/upload', method=method, data=data,
+                                   result_callback=json.loads)
+
+    @tornado.testing.gen_test
+    def test_file(self):
+
+        result = yield from self.upload(io.BytesIO(b'x' * 100000), 'PUT')
+        self.assertEqual((result['method'], result['chunked']),
+                         ('PUT', False))
+        self.assertEqual(result['body'], 'x' * 100000)
+
+    @tornado.testing.gen_test
+    def test_iterator(self):
+
+        result = yield from self.upload(iter([b'da', 'ta', b'']))
+        self.assertEqual((result['body'], result['chunked']), ('data', True))
+
+    @tornado.testing.gen_test
+    def test_producer(self):
+
+        @tornado.gen.coroutine
+        def producer(write):
+            for block in (b'da', b'ta'):
+                # Curl transfer is paused until the block is written.
+                yield tornado.gen.sleep(0.05)
+                yield write(block)
+
+        result = yield from self.upload(producer, 'PUT')
+        self.assertEqual((result['body'], result['chunked']), ('data', True))
+
+    @tornado.testing.gen_test
+    def test_producer_aborted(self):
+
+        token = cancel.CancelToken()
+        ended = tornado.concurrent.Future()
+
+        @tornado.gen.coroutine
+        def producer(write):
+            try:
+                for n in range(1000):
+                    yield write(b'x' * 1000)
+                    if n == 10:
+                        token.cancel()
+            except tornado.iostream.StreamClosedError as err:
+                ended.set_result(err)
+                raise
+
+        with self.assertRaises(errors.RequestCancelled):
+            yield from self.engine.request('/upload', method='PUT',
+                                           data=producer, cancel_token=token)
+
+        yield tornado.gen.with_timeout(self.io_loop.time() + 1, ended)
+
+    @tornado.testing.gen_test
+    def test_async_iterable(self):
+
+        result = yield from self.upload(
+            AsyncBlocks([b'da', 'ta'], self.io_loop.asyncio_loop))
+        self.assertEqual((result['body'], result['chunked']), ('data', True))
+
+    def test_async_iterable_requires_asyncio(self):
+
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+        self.addCleanup(io_loop.close)
+        self.addCleanup(self.io_loop.make_current)
+
+        with self.assertRaises(TypeError):
+            next(self.upload(AsyncBlocks([], self.io_loop.asyncio_loop)))
+
+
+class KeepAliveRequestHandler(EchoRequestHandler):
+
+    """Echo handler keeping connections alive and counting them."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+
+        super().setup()
+        self.server.connections.append(self.client_address)
+
+    def do_HEAD(self):
+
+        self.send_response(http.client.OK)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class TestWarmUp(tornado.testing.AsyncTestCase):
+
+    """Test connection pre-warming and fork detection."""
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), KeepAliveRequestHandler)
+        self.server.daemon_threads = True
+        self.server.connections = []
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def wait_connections(self, count, timeout=3):
+
+        # Connection is established before server thread handles it.
+        deadline = time.monotonic() + timeout
+        while len(self.server.connections) < count and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        return len(self.server.connections)
+
+    def test_sync_warm_up(self):
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, None)
+        self.assertEqual(engine.warm_up(3).result(), 3)
+        self.assertEqual(self.wait_connections(3), 3)
+
+        for _ in range(3):
+            engine.request('/')
+        self.assertEqual(len(self.server.connections), 3)
+
+    @tornado.testing.gen_test
+    def test_async_warm_up(self):
+
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, None,
+                                          max_clients=3)
+        opened = yield engine.warm_up(3)
+        self.assertEqual(opened, 3)
+        self.assertEqual(len(self.server.connections), 3)
+
+        for _ in range(3):
+            yield from engine.request('/')
+        self.assertEqual(len(self.server.connections), 3)
+
+    def test_sync_fork(self):
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, None)
+        engine.request('/')
+        adapters, context = engine._adapters, engine._ssl_context
+
+        with unittest.mock.patch.object(base.os, 'getpid',
+                                        return_value=os.getpid() + 1):
+            engine.request('/')
+
+        self.assertIsNot(engine._ssl_context, context)
+        self.assertIsNot(engine._adapters, adapters)
+        self.assertEqual(len(self.server.connections), 2)
+
+    @tornado.testing.gen_test
+    def test_async_fork(self):
+
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, None)
+        yield from engine.request('/')
+        client = engine._client
+
+        with unittest.mock.patch.object(base.os, 'getpid',
+                                        return_value=os.getpid() + 1):
+            yield from engine.request('/')
+
+        self.assertIsNot(engine._client, client)
+        self.assertIsNot(engine._client,
+                         tornado.curl_httpclient.CurlAsyncHTTPClient())
+        self.assertEqual(len(self.server.connections), 2)
+
+
+class TLSEchoRequestHandler(EchoRequestHandler):
+
+    """Echo handler recording whether TLS session was resumed."""
+
+    def _respond(self):
+
+        self.server.reused.append(self.connection.session_reused)
+        self.server.versions.append(self.connection.version())
+        super()._respond()
+
+
+class TestTLS(tornado.testing.AsyncTestCase):
+
+    """Test shared SSL context against local HTTPS server."""
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.server = self._serve(ssl.OP_NO_TLSv1_3)
+        self.base_url = 'https://127.0.0.1:%d' % self.server.server_address[1]
+
+    def _serve(self, options=0):
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.options |= options
+        context.load_cert_chain(CERT_FILE, KEY_FILE)
+
+        server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), TLSEchoRequestHandler)
+        server.daemon_threads = True
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        server.reused = []
+        server.versions = []
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        return server
+
+    @unittest.skipUnless(tls.SESSION_RESUMPTION_SUPPORTED,
+                         'ssl module lacks session reuse')
+    def test_sync_session_resumption(self):
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, None,
+                                        ca_certs=CERT_FILE)
+        for _ in range(2):
+            self.assertEqual(engine.request(
+                '/', result_callback=json.loads)['path'], '/')
+
+        self.assertEqual(self.server.reused, [False, True])
+
+        adapter = engine._adapters[0][1]
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+        engine.reload_certs()
+        self.assertEqual(len(adapter.poolmanager.pools), 0)
+        engine.request('/')
+        self.assertEqual(self.server.reused[-1], False)
+
+    @unittest.skipUnless(tls.SESSION_RESUMPTION_SUPPORTED and getattr(
+        ssl, 'HAS_TLSv1_3', ssl.OPENSSL_VERSION_INFO >= (1, 1, 1)),
+        'ssl module lacks TLS 1.3 session reuse')
+    def test_sync_session_resumption_tls13(self):
+
+        server = self._serve()
+        engine = sync.SyncRequestEngine(
+            'https://127.0.0.1:%d' % server.server_address[1], 3, 3, None,
+            ca_certs=CERT_FILE)
+        for _ in range(2):
+            engine.request('/')
+
+        self.assertEqual(server.versions, ['TLSv1.3', 'TLSv1.3'])
+        self.assertEqual(server.reused, [False, True])
+
+    def test_sync_verify(self):
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, None)
+        with self.assertRaises(errors.CommunicationError):
+            engine.request('/')
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, None,
+                                        verify_cert=False)
+        self.assertEqual(engine.request(
+            '/', result_callback=json.loads)['path'], '/')
+
+    def test_sync_ca_bundle_env(self):
+
+        with unittest.mock.patch.dict(os.environ,
+                                      {'REQUESTS_CA_BUNDLE': CERT_FILE}):
+            engine = sync.SyncRequestEngine(self.base_url, 3, 3, None)
+            self.assertEqual(engine.request(
+                '/', result_callback=json.loads)['path'], '/')
+
+        # Set after the context was built.
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, None)
+        with unittest.mock.patch.dict(os.environ,
+                                      {'REQUESTS_CA_BUNDLE': CERT_FILE}):
+            self.assertEqual(engine.request(
+                '/', result_callback=json.loads)['path'], '/')
+
+    @tornado.testing.gen_test
+    def test_async(self):
+
+        engine = async.AsyncRequestEngine(self.base_url, 3, 3, None,
+                                          ca_certs=CERT_FILE)
+        result = yield from engine.request('/', result_callback=json.loads)
+        self.assertEqual(result['path'], '/')
+
+    def test_cert_watcher(self):
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+
+        watcher = tls.CertWatcher([path, None], interval=0)
+        self.assertFalse(watcher.changed())
+
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertTrue(watcher.changed())
+        self.assertFalse(watcher.changed())
+
+    def test_watch_reload(self):
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        with open(CERT_FILE, 'rb') as src, open(path, 'wb') as dst:
+            dst.write(src.read())
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 3, None,
+                                        ca_certs=path, cert_watch_interval=0)
+        context = engine._ssl_context
+
+        engine.request('/')
+        self.assertIs(engine._ssl_context, context)
+
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        engine.request('/')
+        self.assertIsNot(engine._ssl_context, context)
+
+
+class TestFairScheduler(tornado.testing.AsyncTestCase):
+
+    """Test weighted fair scheduling of requests."""
+
+    def test_weighted_order(self):
+
+        sched = scheduler.FairScheduler(1, {'user': 3, 'batch': (1, 2)})
+        self.assertTrue(sched.acquire('batch').done())
+
+        waiters = [('batch', sched.acquire('batch')),
+                   ('batch', sched.acquire('batch'))]
+        with self.assertRaises(errors.QueueFullError):
+            sched.acquire('batch')
+
+        waiters += [('user', sched.acquire('user')) for _ in range(4)]
+        self.assertEqual(sched.queued(), 6)
+        self.assertEqual(sched.queued('user'), 4)
+
+        granted = []
+        for _ in range(len(waiters)):
+            sched.release()
+            granted.extend(name for name, future in waiters
+                           if future.done() and name is not None)
+            waiters = [(None if future.done() else name, future)
+                       for name, future in waiters]
+
+        self.assertEqual(granted,
+                         ['user', 'batch', 'user', 'user', 'user', 'batch'])
+        self.assertEqual(sched.in_flight, 1)
+        self.assertEqual(sched.queued(), 0)
+
+    def test_idle_class_no_credit(self):
+
+        sched = scheduler.FairScheduler(1)
+        sched.acquire('a')
+
+        for _ in range(3):
+            waiter = sched.acquire('a')
+            sched.release()
+            self.assertTrue(waiter.done())
+
+        # Class b was idle, it does not get three slots in a row now.
+        a_waiters = [sched.acquire('a') for _ in range(2)]
+        b_waiters = [sched.acquire('b') for _ in range(2)]
+        sched.release()
+        sched.release()
+        self.assertEqual([f.done() for f in a_waiters + b_waiters],
+                         [True, False, True, False])
+
+    def test_unknown_class_queue_limit(self):
+
+        sched = scheduler.FairScheduler(1, max_queue=0)
+        sched.acquire('tenant-1')
+        with self.assertRaises(errors.QueueFullError):
+            sched.acquire('tenant-2')
+
+        with self.assertRaises(ValueError):
+            scheduler.FairScheduler(0)
+
+    @tornado.testing.gen_test
+    def test_engine(self):
+
+        sched = scheduler.FairScheduler(2, {'user': 10})
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None,
+                                          scheduler=sched)
+        fetched = []
+
+        def fetch(request, data, cancel_token=None):
+            fetched.append(request.url.rpartition('/')[2])
+            self.assertLessEqual(sched.in_flight, 2)
+            yield tornado.gen.moment
+            return FakeHTTPResponse(http.client.OK, b'{}')
+
+        request = tornado.gen.coroutine(engine.request)
+        with unittest.mock.patch.object(engine, '_fetch', fetch):
+            yield ([request('/batch%d' % (i,), priority='batch')
+                    for i in range(6)] +
+                   [request('/user%d' % (i,), priority='user')
+                    for i in range(2)])
+
+        # Queued batch requests don't delay user requests behind them.
+        self.assertEqual(fetched, ['batch0', 'batch1', 'user0', 'batch2',
+                                   'user1', 'batch3', 'batch4', 'batch5'])
+        self.assertEqual(sched.in_flight, 0)
+
+    @tornado.testing.gen_test
+    def test_engine_rejected_not_outstanding(self):
+
+        sched = scheduler.FairScheduler(1, max_queue=1)
+        engine = async.AsyncRequestEngine(
+            BASE_URL, 3, 3, None, scheduler=sched,
+            balancer=balancer.LeastOutstandingBalancer)
+        endpoint, = engine._balancer.endpoints
+        release = tornado.concurrent.Future()
+
+        def fetch(request, data, cancel_token=None):
+            yield release
+            return FakeHTTPResponse(http.client.OK, b'{}')
+
+        request = tornado.gen.coroutine(engine.request)
+        token = cancel.CancelToken()
+        with unittest.mock.patch.object(engine, '_fetch', fetch):
+            running = request('/')
+            queued = request('/', cancel_token=token)
+            with self.assertRaises(errors.QueueFullError):
+                yield request('/')
+
+            token.cancel()
+            with self.assertRaises(errors.RequestCancelled):
+                yield queued
+            self.assertEqual(endpoint.outstanding, 1)
+
+            release.set_result(None)
+            yield running
+
+        self.assertEqual(endpoint.outstanding, 0)
+
+
+    @tornado.testing.gen_test
+    def test_engine_fork(self):
+
+        sched = scheduler.FairScheduler(1)
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None,
+                                          scheduler=sched)
+
+        def fetch(request, data, cancel_token=None):
+            return FakeHTTPResponse(http.client.OK, b'{}')
+            yield
+
+        # Requests of the parent process.
+        sched.acquire()
+        sched.acquire()
+
+        with unittest.mock.patch.object(base.os, 'getpid',
+                                        return_value=os.getpid() + 1):
+            with unittest.mock.patch.object(engine, '_fetch', fetch):
+                yield from engine.request('/')
+
+        self.assertEqual((sched.in_flight, sched.queued()), (0, 0))
+
+
+class TestAdaptiveLimit(tornado.testing.AsyncTestCase):
+
+    """Test adaptive concurrency limits."""
+
+    def test_aimd(self):
+
+        limit = limits.AIMDLimit(initial_limit=10, max_limit=12)
+        self.assertEqual(limit.sample(0.1, 10, False), 11)
+        self.assertEqual(limit.sample(0.1, 11, False), 12)
+        self.assertEqual(limit.sample(0.1, 12, False), 12)
+
+        # limit which is not reached does not grow
+        self.assertEqual(limit.sample(0.1, 1, False), 12)
+
+        self.assertEqual(limit.sample(0.1, 12, True), 10)
+        self.assertEqual(limit.sample(0.5, 10, False), 9)
+
+    def test_gradient(self):
+
+        limit = limits.GradientLimit(initial_limit=20)
+        for _ in range(20):
+            limit.sample(0.1, limit.limit, False)
+        grown = limit.limit
+        self.assertGreater(grown, 20)
+
+        for _ in range(20):
+            limit.sample(1.0, limit.limit, False)
+        self.assertLess(limit.limit, grown / 2)
+
+        self.assertEqual(limits.GradientLimit(initial_limit=20,
+                                              min_limit=19).sample(
+            0.1, 20, True), 19)
+
+    def test_gate(self):
+
+        gate = limits.LimitGate(limits.AIMDLimit(initial_limit=1))
+        self.assertTrue(gate.acquire())
+        self.assertFalse(gate.acquire(timeout=0.01))
+
+        gate.release(0.1, False)
+        self.assertEqual(gate.limit.limit, 2)
+        self.assertTrue(gate.acquire(timeout=0.01))
+        self.assertTrue(gate.acquire(timeout=0.01))
+        self.assertEqual(gate.in_flight, 2)
+
+        gate.release()
+        self.assertEqual((gate.in_flight, gate.limit.limit), (1, 2))
+
+    def test_sync_engine(self):
+
+        codes = iter([http.client.OK, http.client.SERVICE_UNAVAILABLE])
+
+        def handler(_):
+            return next(codes), {}, b'{}'
+
+        engine = sync.SyncRequestEngine(
+            'memory://api', 3, 3, None, memory_handler=handler,
+            concurrency_limit=limits.AIMDLimit(initial_limit=2))
+
+        engine.request('/')
+        self.assertEqual(engine.concurrency_limit, 3)
+        with self.assertRaises(errors.ServerError):
+            engine.request('/')
+        self.assertEqual(engine.concurrency_limit, 2)
+        self.assertEqual(engine._limit_gate.in_flight, 0)
+
+        self.assertIsNone(sync.SyncRequestEngine(
+            BASE_URL, 3, 3, None).concurrency_limit)
+
+    def test_sync_engine_streaming(self):
+
+        limit = limits.AIMDLimit(initial_limit=2)
+        engine = sync.SyncRequestEngine(
+            'memory://api', 3, 3, None, memory_handler=echo_handler,
+            concurrency_limit=limit)
+
+        in_flight = []
+
+        def consume(block):
+            in_flight.append(engine._limit_gate.in_flight)
+            time.sleep(0.05)
+
+        for kwargs in ({'streaming_callback': consume},
+                       {'return_response': True}):
+            engine.request('/', **kwargs)
+        self.assertEqual(in_flight, [1])
+        self.assertEqual(engine._limit_gate.in_flight, 0)
+        # Body read time is part of the sample.
+        self.assertGreater(limit.baseline_rtt, 0.04)
+
+    def test_async_max_clients(self):
+
+        limit = limits.AIMDLimit(initial_limit=20, max_limit=50)
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None,
+                                          concurrency_limit=limit)
+        self.assertEqual(len(engine._client._curls), 50)
+        self.assertIsNot(engine._client,
+                         tornado.curl_httpclient.CurlAsyncHTTPClient())
+
+        # limit above max_clients is capped
+        limit = limits.AIMDLimit(initial_limit=20, max_limit=50)
+        engine = async.AsyncRequestEngine(BASE_URL, 3, 3, None,
+                                          max_clients=8,
+                                          concurrency_limit=limit)
+        self.assertEqual(len(engine._client._curls), 8)
+        self.assertEqual((limit.max_limit, limit.limit), (8, 8))
+        self.assertEqual(engine._scheduler.max_concurrency, 8)
+
+        for _ in range(10):
+            limit.sample(0.1, 8, False)
+        self.assertEqual(engine.concurrency_limit, 8)
+
+    def test_sync_gate_timeout(self):
+
+        engine = sync.SyncRequestEngine(
+            'memory://api', 3, 0.05, None, memory_handler=echo_handler,
+            balancer=balancer.LeastOutstandingBalancer,
+            concurrency_limit=limits.AIMDLimit(initial_limit=1))
+        endpoint, = engine._balancer.endpoints
+
+        engine._limit_gate.acquire()
+        with self.assertRaises(errors.QueueFullError):
+            engine.request('/')
+        self.assertEqual(endpoint.outstanding, 0)
+
+        engine._limit_gate.release(0.01, False)
+        engine.request('/')
+        self.assertEqual(endpoint.outstanding, 0)
+
+    @tornado.testing.gen_test
+    def test_async_engine(self):
+
+        engine = async.AsyncRequestEngine(
+            BASE_URL, 3, 3, None,
+            concurrency_limit=limits.AIMDLimit(initial_limit=2))
+        in_flight = []
+
+        def fetch(request, data, cancel_token=None):
+            in_flight.append(engine._scheduler.in_flight)
+            yield tornado.gen.moment
+            if request.url.endswith('busy'):
+                raise tornado.httpclient.HTTPError(
+                    http.client.SERVICE_UNAVAILABLE)
+            return FakeHTTPResponse(http.client.OK, b'{}')
+
+        request = tornado.gen.coroutine(engine.request)
+        with unittest.mock.patch.object(engine, '_fetch', fetch):
+            yield [request('/') for _ in range(4)]
+            self.assertEqual(max(in_flight), 2)
+            grown = engine.concurrency_limit
+            self.assertGreater(grown, 2)
+            self.assertEqual(engine._scheduler.max_concurrency, grown)
+
+            with self.assertRaises(errors.ServerError):
+                yield request('/busy')
+            self.assertEqual(engine.concurrency_limit, int(grown * 0.9))
+            self.assertEqual(engine._scheduler.max_concurrency,
+                             int(grown * 0.9))
+
+
+class HangingRequestHandler(EchoRequestHandler):
+
+    """Send the first part of body and hang until the server is released,
+    except for /fast requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        if self.path == '/fast':
+            return self._respond()
+
+        self.send_response(http.client.OK)
+        self.send_header('Content-Length', '10')
+        self.end_headers()
+        self.wfile.write(b'first')
+        self.wfile.flush()
+
+        self.server.release.wait(10)
+        self.wfile.write(b'-last')
+
+
+def refused_handler(_):
+
+    raise ConnectionRefusedError('down')
+
+
+class TestCancellation(tornado.testing.AsyncTestCase):
+
+    """Test cancellation of requests."""
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), HangingRequestHandler)
+        self.server.daemon_threads = True
+        self.server.release = threading.Event()
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.release.set)
+
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def test_token(self):
+
+        token = cancel.CancelToken()
+        called = []
+        token.remove_callback(token.add_callback(lambda: called.append(1)))
+        token.add_callback(lambda: called.append(2))
+        token.check()
+
+        token.cancel()
+        token.cancel()
+        self.assertTrue(token.cancelled)
+        self.assertEqual(called, [2])
+
+        token.add_callback(lambda: called.append(3))
+        self.assertEqual(called, [2, 3])
+        with self.assertRaises(errors.RequestCancelled):
+            token.sleep(10)
+
+    def assert_cancelled(self, futures):
+
+        for future in futures:
+            self.assertTrue(future.done())
+            self.assertIsInstance(future.exception(), errors.RequestCancelled)
+
+    @tornado.testing.gen_test
+    def test_async_mass_cancel(self):
+
+        engine = async.AsyncRequestEngine(self.base_url, 3, 10, None,
+                                          max_clients=4)
+        client = engine._client
+
+        tokens = [cancel.CancelToken() for _ in range(20)]
+        request = tornado.gen.coroutine(engine.request)
+        futures = [request('/slow', cancel_token=token) for token in tokens]
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual(len(client._free_list), 0)
+        self.assertEqual(len(client._requests), 16)
+
+        started = time.monotonic()
+        for token in tokens:
+            token.cancel()
+        yield tornado.gen.sleep(0.05)
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assert_cancelled(futures)
+        self.assertEqual(len(client._free_list), 4)
+        self.assertEqual(len(client._requests), 0)
+
+        result = yield from engine.request('/fast', result_callback=json.loads)
+        self.assertEqual(result['path'], '/fast')
+
+    @tornado.testing.gen_test
+    def test_async_cancel_unsupported_client(self):
+
+        engine = async.AsyncRequestEngine(
+            self.base_url, 3, 10, None,
+            balancer=balancer.LeastOutstandingBalancer)
+        endpoint, = engine._balancer.endpoints
+        client = engine._client
+
+        token = cancel.CancelToken()
+        future = tornado.gen.coroutine(engine.request)(
+            '/slow', cancel_token=token)
+        yield tornado.gen.sleep(0.1)
+
+        with unittest.mock.patch.object(async, 'CURL_CLIENT_INTERNALS',
+                                        ('_missing',)):
+            token.cancel()
+            yield tornado.gen.sleep(0.05)
+
+        self.assert_cancelled([future])
+        self.assertEqual(endpoint.outstanding, 0)
+        self.assertIsNone(endpoint.last_update)
+
+        # Transfer goes on until server responds, its result is dropped.
+        self.assertEqual(len(client._free_list), len(client._curls) - 1)
+        self.server.release.set()
+        yield tornado.gen.sleep(0.1)
+        self.assertEqual(len(client._free_list), len(client._curls))
+
+    @tornado.testing.gen_test
+    def test_async_cancel_queued(self):
+
+        sched = scheduler.FairScheduler(2)
+        engine = async.AsyncRequestEngine(self.base_url, 3, 10, None,
+                                          max_clients=4, scheduler=sched)
+
+        token = cancel.CancelToken()
+        request = tornado.gen.coroutine(engine.request)
+        futures = [request('/slow', cancel_token=token) for _ in range(10)]
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual((sched.in_flight, sched.queued()), (2, 8))
+
+        token.cancel()
+        yield tornado.gen.sleep(0.05)
+
+        self.assert_cancelled(futures)
+        self.assertEqual((sched.in_flight, sched.queued()), (0, 0))
+        self.assertEqual(len(engine._client._free_list), 4)
+
+    @tornado.testing.gen_test
+    def test_async_cancel_retries(self):
+
+        engine = async.AsyncRequestEngine(
+            'memory://api', 3, 3, 5, memory_handler=refused_handler)
+
+        token = cancel.CancelToken()
+        future = tornado.gen.coroutine(engine.request)(
+            '/', cancel_token=token)
+        yield tornado.gen.sleep(0.1)
+
+        token.cancel()
+        yield tornado.gen.sleep(0.05)
+        self.assert_cancelled([future])
+
+    def test_sync_cancel_stream(self):
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 10, None)
+        token = cancel.CancelToken()
+        threading.Timer(0.2, token.cancel).start()
+
+        started = time.monotonic()
+        with self.assertRaises(errors.RequestCancelled):
+            engine.request('/slow', streaming_callback=lambda _: None,
+                           cancel_token=token)
+        self.assertLess(time.monotonic() - started, 1)
+
+        with self.assertRaises(errors.RequestCancelled):
+            engine.request('/fast', cancel_token=token)
+
+    def test_sync_cancel_body(self):
+
+        engine = sync.SyncRequestEngine(self.base_url, 3, 10, None)
+        token = cancel.CancelToken()
+        threading.Timer(0.2, token.cancel).start()
+
+        started = time.monotonic()
+        with self.assertRaises(errors.RequestCancelled):
+            engine.request('/slow', cancel_token=token)
+        self.assertLess(time.monotonic() - started, 1)
+
+        self.assertEqual(json.loads(engine.request(
+            '/fast', cancel_token=cancel.CancelToken()).decode())['path'],
+            '/fast')
+
+    def test_sync_cancel_retries(self):
+
+        engine = sync.SyncRequestEngine(
+            'memory://api', 3, 3, 5, memory_handler=refused_handler)
+        token = cancel.CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+
+        started = time.monotonic()
+        with self.assertRaises(errors.RequestCancelled):
+            engine.request('/', cancel_token=token)
+        self.assertLess(time.monotonic() - started, 1)
+        endpoint, = engine._balancer.endpoints
+        self.assertEqual(endpoint.outstanding, 0)
 
 
 if __name__ == '__main__':